@@ -0,0 +1,611 @@
+"""Offline NFO Sync benchmark.
+
+Runs the tasks of service.py against a simulated Kodi: a synthetic library
+served over an in-process JSON-RPC transport with per-call latency, and SMB-like
+shares held in memory with per-operation latency. No Kodi install is needed.
+
+    python benchmark.py --scale 0.1
+    python benchmark.py --scenario smart-sync --json results.json
+    python benchmark.py --baseline results.json
+
+Each scenario runs in its own process and reports wall time, JSON-RPC and file
+access counts, log volume, peak memory and the phase timings recorded by the
+service. With --baseline the run fails if a scenario got slower than the
+recorded one by more than --tolerance.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import remote
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCENARIOS = ('smart-sync', 'full-refresh', 'clean')
+
+SOURCES = [
+    {'file': 'smb://nas/media/Movies/', 'label': 'Movies'},
+    {'file': 'smb://nas/media/TV/', 'label': 'TV Shows'},
+    {'file': 'smb://nas2/music/Videos/', 'label': 'Music Videos'},
+]
+
+class SimulatedShares:
+    """In-memory network shares with a fixed latency per file operation.
+
+    Paths are stored without a trailing separator. NFO content is generated from
+    the path and a revision number, so touching a file changes its size as well.
+    Shares on an offline host answer nothing after `offline_latency`.
+    """
+    def __init__(self, latency=0.002, offline_latency=2.0):
+        self.latency = latency
+        self.offline_latency = offline_latency
+        self.offline = set()
+        self.files = {}
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def add_file(self, path, mtime, size=None):
+        # size None marks an NFO, whose size follows from its content
+        self.files[path] = [mtime, 0, size]
+        directory, name = path.rsplit('/', 1)
+        self.add_dir(directory, mtime)
+        self.dirs[directory][2].add(name)
+
+    def add_dir(self, path, mtime):
+        while path not in self.dirs and '/' in path.split('://', 1)[-1]:
+            self.dirs[path] = [mtime, set(), set()]
+            parent, name = path.rsplit('/', 1)
+            if parent in self.dirs:
+                self.dirs[parent][1].add(name)
+                break
+            self.dirs[parent] = [mtime, {name}, set()]
+            path = parent
+
+    def content(self, path, revision):
+        title = path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        return f'<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<movie>\n    <title>{title}</title>\n    <!-- revision {revision} -->\n</movie>\n'.encode('utf-8')
+
+    def peek(self, path):
+        # (mtime, size) without latency, for setting up the recorded state
+        mtime, revision, size = self.files[path]
+        return mtime, len(self.content(path, revision)) if size is None else size
+
+    def touch(self, path, mtime):
+        entry = self.files[path]
+        entry[0] = mtime
+        entry[1] += 1
+
+    def access(self, op, path):
+        # Counts the call and waits like a round trip to the share would
+        with self.lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+        host = path.split('://', 1)[-1].split('/', 1)[0]
+        if host in self.offline:
+            time.sleep(self.offline_latency)
+            return False
+        if self.latency:
+            time.sleep(self.latency)
+        return True
+
+    def stat(self, path):
+        path = path.rstrip('/')
+        if not self.access('stat', path):
+            return None
+        if path in self.files:
+            return self.peek(path)
+        if path in self.dirs:
+            return self.dirs[path][0], 0
+        return None
+
+    def exists(self, path):
+        path = path.rstrip('/')
+        return self.access('exists', path) and (path in self.files or path in self.dirs)
+
+    def listdir(self, path):
+        path = path.rstrip('/')
+        if not self.access('listdir', path) or path not in self.dirs:
+            return [], []
+        _, dirs, files = self.dirs[path]
+        return sorted(dirs), sorted(files)
+
+    def read(self, path):
+        if not self.access('read', path) or path not in self.files:
+            raise IOError(f"No such file: {path}")
+        _, revision, size = self.files[path]
+        return self.content(path, revision) if size is None else b''
+
+    def write(self, path, data):
+        self.access('write', path)
+        self.add_file(path, int(time.time()))
+
+class SimulatedKodi:
+    """JSON-RPC transport answering from a synthetic library.
+
+    Every request waits `latency` plus `item_latency` per batch entry. Refreshes,
+    scans and cleans are queued on a single worker, like Kodi's job queue, and
+    announce themselves through the same notifications Kodi sends. A refresh
+    resets the item's watched status to the (unwatched) NFO, which is what
+    Preserve Watched Status has to undo.
+    """
+    notifications = True
+    LISTS = {
+        'VideoLibrary.GetMovies': ('movies', 'movieid'),
+        'VideoLibrary.GetMusicVideos': ('musicvideos', 'musicvideoid'),
+        'VideoLibrary.GetTVShows': ('tvshows', 'tvshowid'),
+        'VideoLibrary.GetEpisodes': ('episodes', 'episodeid'),
+    }
+    DETAILS = {
+        'movie': ('movies', 'movieid', 'moviedetails'),
+        'musicvideo': ('musicvideos', 'musicvideoid', 'musicvideodetails'),
+        'tvshow': ('tvshows', 'tvshowid', 'tvshowdetails'),
+        'episode': ('episodes', 'episodeid', 'episodedetails'),
+    }
+
+    def __init__(self, on_notification, latency=0.001, item_latency=0.00005, refresh_cost=0.002, job_cost=0.00002):
+        self.on_notification = on_notification
+        self.latency = latency
+        self.item_latency = item_latency
+        self.refresh_cost = refresh_cost
+        self.job_cost = job_cost
+        self.library = {key: [] for key, _ in self.LISTS.values()}
+        self.by_id = {key: {} for key in self.library}
+        self.episodes_by_show = {}
+        self.lock = threading.Lock()
+        self.version = 0
+        self.filtered = {}
+        self.calls = {}
+        self.round_trips = 0
+        self.jobs = 0
+        self.jobs_done = threading.Condition()
+        self.heap = []
+        self.sequence = 0
+        self.busy_until = 0
+        self.worker = threading.Thread(target=self.work, name='kodi-jobs', daemon=True)
+        self.worker.start()
+
+    def add(self, key, item):
+        self.library[key].append(item)
+        self.by_id[key][item[key[:-1] + 'id']] = item
+        if key == 'episodes':
+            self.episodes_by_show.setdefault(item['tvshowid'], []).append(item)
+
+    def total(self):
+        return sum(len(items) for items in self.library.values())
+
+    def send(self, payload):
+        requests = payload if isinstance(payload, list) else [payload]
+        with self.lock:
+            self.round_trips += 1
+            for request in requests:
+                self.calls[request['method']] = self.calls.get(request['method'], 0) + 1
+        delay = self.latency + self.item_latency * (len(requests) - 1)
+        if delay:
+            time.sleep(delay)
+        responses = []
+        for request in requests:
+            try:
+                result = self.handle(request['method'], request.get('params') or {})
+                responses.append({'jsonrpc': '2.0', 'id': request.get('id'), 'result': result})
+            except KeyError as e:
+                responses.append({'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': -32602, 'message': f"Invalid params: {e}"}})
+            except NotImplementedError:
+                responses.append({'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': -32601, 'message': 'Method not found.'}})
+        return responses if isinstance(payload, list) else responses[0]
+
+    def close(self):
+        pass
+
+    def handle(self, method, params):
+        if method in self.LISTS:
+            return self.get_items(method, params)
+        if method == 'Files.GetSources':
+            return {'sources': SOURCES}
+        if method == 'XBMC.GetInfoBooleans':
+            return {condition: condition == 'Library.IsScanningVideo' and self.jobs > 0 for condition in params['booleans']}
+        if method == 'Player.GetActivePlayers':
+            return []
+        if method in ('GUI.ShowNotification', 'VideoLibrary.Export'):
+            return 'OK'
+        if method in ('VideoLibrary.Scan', 'VideoLibrary.Clean'):
+            kind = 'Scan' if method == 'VideoLibrary.Scan' else 'Clean'
+            # Cost in proportion to the part of the library the job covers
+            directory = params.get('directory', '')
+            items = sum(1 for entries in self.library.values() for item in entries if item['file'].startswith(directory))
+            self.schedule_job(kind, items * self.job_cost)
+            return 'OK'
+        if method.startswith('VideoLibrary.Refresh'):
+            media_type = method[len('VideoLibrary.Refresh'):].lower()
+            key, id_key, _ = self.DETAILS[media_type]
+            self.schedule_refresh(media_type, self.by_id[key][params[id_key]])
+            return 'OK'
+        if method.startswith('VideoLibrary.Get') and method.endswith('Details'):
+            key, id_key, result_key = self.DETAILS[method[len('VideoLibrary.Get'):-len('Details')].lower()]
+            item = self.by_id[key][params[id_key]]
+            return {result_key: self.project(item, id_key, params.get('properties', []))}
+        if method.startswith('VideoLibrary.Set') and method.endswith('Details'):
+            key, id_key, _ = self.DETAILS[method[len('VideoLibrary.Set'):-len('Details')].lower()]
+            item = self.by_id[key][params[id_key]]
+            with self.lock:
+                item.update({field: value for field, value in params.items() if field != id_key})
+                self.version += 1
+            return 'OK'
+        raise NotImplementedError(method)
+
+    def project(self, item, id_key, properties):
+        result = {id_key: item[id_key], 'label': item['label']}
+        for name in properties:
+            if name in item:
+                result[name] = item[name]
+        return result
+
+    def get_items(self, method, params):
+        key, id_key = self.LISTS[method]
+        items = self.library[key]
+        if 'filter' in params:
+            # The only filter the service uses selects watched or in-progress items
+            with self.lock:
+                cached = self.filtered.get(key)
+                if cached is None or cached[0] != self.version:
+                    cached = self.filtered[key] = (self.version, [item for item in items if item.get('playcount', 0) > 0 or item.get('resume', {}).get('position', 0) > 0])
+            items = cached[1]
+        limits = params.get('limits', {})
+        start = limits.get('start', 0)
+        end = min(limits.get('end', len(items)), len(items))
+        properties = params.get('properties', [])
+        return {
+            key: [self.project(item, id_key, properties) for item in items[start:end]],
+            'limits': {'start': start, 'end': end, 'total': len(items)},
+        }
+
+    def schedule(self, due, action):
+        with self.jobs_done:
+            self.sequence += 1
+            heapq.heappush(self.heap, (due, self.sequence, action))
+            self.jobs_done.notify()
+
+    def schedule_refresh(self, media_type, item):
+        self.busy_until = max(time.time(), self.busy_until) + self.refresh_cost
+        self.schedule(self.busy_until, lambda: self.refreshed(media_type, item))
+
+    def refreshed(self, media_type, item):
+        with self.lock:
+            for entry in self.episodes_by_show.get(item['tvshowid'], []) if media_type == 'tvshow' else [item]:
+                entry.update(playcount=0, resume={'position': 0.0, 'total': 0.0}, lastplayed='')
+            self.version += 1
+        id_key = self.DETAILS[media_type][1]
+        self.on_notification('xbmc', 'VideoLibrary.OnUpdate', {'item': {'type': media_type, 'id': item[id_key]}})
+
+    def schedule_job(self, kind, cost):
+        with self.lock:
+            self.jobs += 1
+        self.on_notification('xbmc', f'VideoLibrary.On{kind}Started', None)
+        self.busy_until = max(time.time(), self.busy_until) + cost
+        self.schedule(self.busy_until, lambda: self.job_finished(kind))
+
+    def job_finished(self, kind):
+        with self.lock:
+            self.jobs -= 1
+        self.on_notification('xbmc', f'VideoLibrary.On{kind}Finished', None)
+
+    def work(self):
+        while True:
+            with self.jobs_done:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.jobs_done.wait(None if not self.heap else self.heap[0][0] - time.time())
+                _, _, action = heapq.heappop(self.heap)
+            action()
+
+def build_library(kodi, shares, args, rng):
+    # Movies and TV on one host, music videos on another
+    mtime = int(time.time()) - 30 * 86400
+    counts = {
+        'movies': int(args.movies * args.scale),
+        'shows': int(args.shows * args.scale),
+        'musicvideos': int(args.musicvideos * args.scale),
+    }
+
+    def watched_state():
+        if rng.random() >= args.watched:
+            return {'playcount': 0, 'resume': {'position': 0.0, 'total': 0.0}, 'lastplayed': ''}
+        if rng.random() < 0.2:
+            return {'playcount': 0, 'resume': {'position': 600.0, 'total': 5400.0}, 'lastplayed': '2024-01-01 20:00:00'}
+        return {'playcount': rng.randint(1, 3), 'resume': {'position': 0.0, 'total': 0.0}, 'lastplayed': '2024-01-01 20:00:00'}
+
+    for number in range(1, counts['movies'] + 1):
+        name = f"Movie {number:06d} ({1950 + number % 70})"
+        base = f"{SOURCES[0]['file']}{name}/{name}"
+        shares.add_file(base + '.mkv', mtime, 4 << 30)
+        shares.add_file(base + '.nfo', mtime)
+        kodi.add('movies', dict(movieid=number, label=name, file=base + '.mkv', **watched_state()))
+
+    episode_id = 0
+    for number in range(1, counts['shows'] + 1):
+        name = f"Show {number:05d}"
+        folder = f"{SOURCES[1]['file']}{name}/"
+        shares.add_file(folder + 'tvshow.nfo', mtime)
+        kodi.add('tvshows', {'tvshowid': number, 'label': name, 'file': folder})
+        for episode in range(args.episodes_per_show):
+            season, index = episode // 10 + 1, episode % 10 + 1
+            base = f"{folder}Season {season:02d}/{name} S{season:02d}E{index:02d}"
+            shares.add_file(base + '.mkv', mtime, 1 << 30)
+            shares.add_file(base + '.nfo', mtime)
+            episode_id += 1
+            kodi.add('episodes', dict(episodeid=episode_id, tvshowid=number, label=f"{name} S{season:02d}E{index:02d}", file=base + '.mkv', **watched_state()))
+
+    for number in range(1, counts['musicvideos'] + 1):
+        name = f"Track {number:06d}"
+        base = f"{SOURCES[2]['file']}Artist {number // 10:05d}/{name}"
+        shares.add_file(base + '.mkv', mtime, 200 << 20)
+        shares.add_file(base + '.nfo', mtime)
+        kodi.add('musicvideos', dict(musicvideoid=number, label=name, file=base + '.mkv', **watched_state()))
+
+def simulated_vfs(xbmcvfs, shares):
+    # Network paths go to the simulated shares, the profile stays on local disk
+    local = {name: getattr(xbmcvfs, name) for name in ('exists', 'listdir', 'Stat', 'File')}
+
+    def exists(path):
+        return shares.exists(path) if '://' in path else local['exists'](path)
+    xbmcvfs.exists = exists
+
+    def listdir(path):
+        return shares.listdir(path) if '://' in path else local['listdir'](path)
+    xbmcvfs.listdir = listdir
+
+    class Stat:
+        def __init__(self, path):
+            self.stat = shares.stat(path) if '://' in path else None
+            self.local = None if '://' in path else local['Stat'](path)
+
+        def st_mtime(self):
+            if self.local is not None:
+                return self.local.st_mtime()
+            return self.stat[0] if self.stat else 0
+
+        def st_size(self):
+            if self.local is not None:
+                return self.local.st_size()
+            return self.stat[1] if self.stat else 0
+    xbmcvfs.Stat = Stat
+
+    class File:
+        def __init__(self, path, mode='r'):
+            self.path = path
+            self.mode = mode
+            self.local = None if '://' in path else local['File'](path, mode)
+
+        def readBytes(self, count=-1):
+            if self.local is not None:
+                return self.local.readBytes(count)
+            return bytearray(shares.read(self.path))
+
+        def read(self, count=-1):
+            return bytes(self.readBytes(count)).decode('utf-8', 'replace')
+
+        def write(self, data):
+            if self.local is not None:
+                return self.local.write(data)
+            shares.write(self.path, data)
+            return True
+
+        def close(self):
+            if self.local is not None:
+                self.local.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+    xbmcvfs.File = File
+
+def seed_state(service, shares, kodi, state_dir, last_run):
+    # Steady state of earlier imports: every NFO and library folder already recorded
+    index = service.NFOStateIndex(os.path.join(state_dir, 'nfo_state.db'))
+    for key, media_type, id_key in (('movies', 'movie', 'movieid'), ('musicvideos', 'musicvideo', 'musicvideoid'), ('episodes', 'episode', 'episodeid')):
+        for item in kodi.library[key]:
+            nfo_path = item['file'].rsplit('.', 1)[0] + '.nfo'
+            index.record(media_type, item[id_key], item['file'], nfo_path, *shares.peek(nfo_path))
+    for show in kodi.library['tvshows']:
+        nfo_path = show['file'] + 'tvshow.nfo'
+        index.record('tvshow', show['tvshowid'], show['file'], nfo_path, *shares.peek(nfo_path))
+    index.commit()
+    index.close()
+
+    directories = service.DirectoryStateIndex(os.path.join(state_dir, 'scan_state.db'))
+    roots = [source['file'].rstrip('/') for source in SOURCES]
+    for path, (mtime, _, _) in shares.dirs.items():
+        if any(path == root or path.startswith(root + '/') for root in roots):
+            directories.record(path, mtime)
+    directories.commit()
+    directories.close()
+    service.set_last_run('last_run_import', last_run)
+
+def peak_memory():
+    # Peak resident set size of this process in bytes, None where unavailable
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_scenario(name, args):
+    rng = random.Random(args.seed)
+    state_dir = tempfile.mkdtemp(prefix='nfosync-bench-') + os.sep
+    try:
+        runtime = remote.HeadlessRuntime(None, remote.PathMap([]), state_dir, os.path.join(state_dir, 'settings.json'), args.verbose)
+        remote.RUNTIME = runtime
+        kodi = SimulatedKodi(runtime.queue_notification, args.rpc_latency / 1000.0, args.rpc_item_latency / 1000.0,
+                             args.refresh_cost / 1000.0, args.job_cost / 1000.0)
+        shares = SimulatedShares(args.vfs_latency / 1000.0, args.offline_latency / 1000.0)
+        runtime.transport = kodi
+        build_library(kodi, shares, args, rng)
+
+        modules = remote.kodi_modules(runtime)
+        simulated_vfs(modules['xbmcvfs'], shares)
+        log_lines = {}
+
+        def log(msg, level=1):
+            log_lines[level] = log_lines.get(level, 0) + 1
+            if args.verbose:
+                remote.runtime_log(msg, level)
+        modules['xbmc'].log = log
+        sys.modules.update(modules)
+        sys.path.insert(0, remote.ADDON_DIR)
+        import service
+
+        settings = {'show_notifications': 'false', 'import_preserve_watched': 'false', 'import_type': 'Full Refresh'}
+        if name == 'full-refresh':
+            settings.update(import_smart_sync='false', import_preserve_watched='true')
+        elif name == 'clean':
+            settings.update(clean_check_sources='true')
+            shares.offline.add(SOURCES[2]['file'].split('://', 1)[1].split('/', 1)[0])
+        runtime.settings.update(settings)
+
+        seed_state(service, shares, kodi, state_dir, time.time() - 3600)
+        if name == 'smart-sync':
+            nfos = [path for path, entry in shares.files.items() if entry[2] is None]
+            for path in rng.sample(nfos, int(len(nfos) * args.changed)):
+                shares.touch(path, int(time.time()))
+
+        sync = service.NFOSyncService()
+        shares.calls.clear()
+        kodi.calls.clear()
+        kodi.round_trips = 0
+        log_lines.clear()
+        if args.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        started = time.perf_counter()
+        if name == 'clean':
+            sync.run_clean()
+        else:
+            sync.run_import()
+        wall = time.perf_counter() - started
+        heap_peak = None
+        if args.trace_memory:
+            heap_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        stats = service.load_sync_stats()
+        run = stats[-1] if stats else {}
+        return {
+            'scenario': name,
+            'items': kodi.total(),
+            'wall': wall,
+            'rpc_round_trips': kodi.round_trips,
+            'rpc_calls': dict(kodi.calls),
+            'vfs_calls': dict(shares.calls),
+            'log_lines': {remote.HeadlessRuntime.LEVELS[level]: count for level, count in sorted(log_lines.items())},
+            'peak_rss': peak_memory(),
+            'heap_peak': heap_peak,
+            'phases': run.get('phases', {}),
+            'counts': run.get('counts', {}),
+        }
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+def format_bytes(value):
+    if value is None:
+        return 'n/a'
+    return f"{value / (1 << 20):.0f} MB"
+
+def format_result(result):
+    lines = [f"== {result['scenario']}: {result['items']} items, {result['wall']:.1f}s"]
+    memory = f"peak RSS {format_bytes(result['peak_rss'])}"
+    if result['heap_peak'] is not None:
+        memory += f", Python heap peak {format_bytes(result['heap_peak'])}"
+    lines.append(f"   {memory}")
+    lines.append(f"   JSON-RPC: {result['rpc_round_trips']} round trips, {sum(result['rpc_calls'].values())} calls")
+    for method, count in sorted(result['rpc_calls'].items(), key=lambda entry: -entry[1]):
+        lines.append(f"     {method:<36} {count:8d}")
+    lines.append(f"   File access: {sum(result['vfs_calls'].values())} calls (" + ', '.join(f"{op} {count}" for op, count in sorted(result['vfs_calls'].items())) + ")")
+    lines.append("   Log lines: " + (', '.join(f"{level} {count}" for level, count in result['log_lines'].items()) or 'none'))
+    if result['phases']:
+        lines.append("   Phases: " + ', '.join(f"{phase} {seconds:.1f}s" for phase, seconds in sorted(result['phases'].items(), key=lambda phase: -phase[1])))
+    if result['counts']:
+        lines.append("   Items: " + ', '.join(f"{name} {count}" for name, count in sorted(result['counts'].items())))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark NFO Sync against a simulated Kodi library.")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="may be repeated (default: all)")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the library size")
+    parser.add_argument('--movies', type=int, default=20000)
+    parser.add_argument('--shows', type=int, default=1500)
+    parser.add_argument('--episodes-per-show', type=int, default=50)
+    parser.add_argument('--musicvideos', type=int, default=5000)
+    parser.add_argument('--watched', type=float, default=0.3, help="fraction of watched or in-progress items")
+    parser.add_argument('--changed', type=float, default=0.01, help="fraction of NFOs touched for smart-sync")
+    parser.add_argument('--rpc-latency', type=float, default=1.0, help="ms per JSON-RPC request")
+    parser.add_argument('--rpc-item-latency', type=float, default=0.05, help="ms per additional batch entry")
+    parser.add_argument('--vfs-latency', type=float, default=2.0, help="ms per file operation on a share")
+    parser.add_argument('--offline-latency', type=float, default=2000.0, help="ms until an offline share fails")
+    parser.add_argument('--refresh-cost', type=float, default=2.0, help="ms Kodi spends on each refresh")
+    parser.add_argument('--job-cost', type=float, default=0.02, help="ms per item covered by a scan or clean")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--trace-memory', action='store_true', help="also trace the Python heap peak (slows the run)")
+    parser.add_argument('--json', metavar='FILE', help="write the results to FILE")
+    parser.add_argument('--baseline', metavar='FILE', help="compare wall times with an earlier --json result")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument('--verbose', action='store_true', help="print the service log")
+    parser.add_argument('--worker', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_scenario(args.worker, args)))
+        return 0
+
+    # A fresh process per scenario keeps the peak memory figures apart
+    passthrough = sys.argv[1:] if argv is None else argv
+    results = []
+    for name in args.scenario or SCENARIOS:
+        worker_args = []
+        skip = False
+        for arg in passthrough:
+            if skip:
+                skip = False
+            elif arg in ('--scenario', '--json', '--baseline', '--tolerance'):
+                skip = True
+            elif not arg.startswith(('--scenario=', '--json=', '--baseline=', '--tolerance=')):
+                worker_args.append(arg)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', name] + worker_args,
+                                 stdout=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            sys.stderr.write(f"Scenario {name} failed\n")
+            return 1
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        print(format_result(result), flush=True)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = {result['scenario']: result for result in json.load(f)}
+        for result in results:
+            previous = baseline.get(result['scenario'])
+            if previous is None:
+                continue
+            change = result['wall'] / max(previous['wall'], 0.001) - 1
+            verdict = 'REGRESSION' if change > args.tolerance else 'ok'
+            print(f"{result['scenario']}: {previous['wall']:.1f}s -> {result['wall']:.1f}s ({change:+.0%}) {verdict}")
+            if change > args.tolerance:
+                status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,6 +20,7 @@ set FILES_TO_COPY=
 set FILES_TO_COPY=%FILES_TO_COPY% addon.xml
 set FILES_TO_COPY=%FILES_TO_COPY% service.py
 set FILES_TO_COPY=%FILES_TO_COPY% script.py
+set FILES_TO_COPY=%FILES_TO_COPY% remote.py
 set FILES_TO_COPY=%FILES_TO_COPY% LICENSE
 set FILES_TO_COPY=%FILES_TO_COPY% README.md
 set FILES_TO_COPY=%FILES_TO_COPY% icon.png
@@ -33,7 +33,7 @@ mkdir "%BUILD_ROOT%"
 
 echo Copying whitelisted content...
 
-set "FILES_TO_COPY=addon.xml service.py script.py LICENSE README.md icon.png"
+set "FILES_TO_COPY=addon.xml service.py script.py remote.py LICENSE README.md icon.png"
 set "DIRS_TO_COPY=resources"
 
 :: Copy Files
@@ -0,0 +1,545 @@
+"""Headless NFO Sync runner.
+
+Runs the tasks of service.py outside Kodi, on the machine that holds the NFO
+files, and drives a Kodi instance remotely over its JSON-RPC interface. NFOs
+are probed on local disk; Kodi only receives the library calls.
+
+    python remote.py --host kodi.lan --path-map smb://nas/media/=/volume1/media/ import
+
+Kodi must allow remote control (Settings > Services > Control). Settings are
+read from the addon defaults and overridden by <state dir>/settings.json, which
+also receives the last run times.
+"""
+import argparse
+import base64
+import codecs
+import http.client
+import json
+import os
+import queue
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+import types
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class HTTPTransport:
+    """Kodi's HTTP JSON-RPC endpoint over a pool of keep-alive connections.
+
+    Batches larger than SPLIT_SIZE are split and sent on several pooled
+    connections at once, so Kodi works on them in parallel.
+    """
+    SPLIT_SIZE = 50
+    notifications = False
+
+    def __init__(self, host, port=8080, username=None, password=None, pool_size=4, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pool_size = max(1, pool_size)
+        self.pool = queue.LifoQueue()
+        self.headers = {'Content-Type': 'application/json'}
+        if username:
+            token = base64.b64encode(f"{username}:{password or ''}".encode('utf-8')).decode('ascii')
+            self.headers['Authorization'] = f"Basic {token}"
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+
+    def post(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        for attempt in (1, 2):
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request('POST', '/jsonrpc', body, self.headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                # A pooled connection may have been closed by Kodi, retry on a new one
+                if attempt == 2:
+                    raise
+                continue
+            if response.status != 200:
+                conn.close()
+                raise IOError(f"Kodi JSON-RPC returned HTTP {response.status}")
+            self.pool.put(conn)
+            return json.loads(data.decode('utf-8')) if data else None
+
+    def send(self, payload):
+        if isinstance(payload, list) and len(payload) > self.SPLIT_SIZE and self.pool_size > 1:
+            size = max(self.SPLIT_SIZE, -(-len(payload) // self.pool_size))
+            chunks = [payload[start:start + size] for start in range(0, len(payload), size)]
+            responses = []
+            for result in self.executor.map(self.post, chunks):
+                responses.extend(result or [])
+            return responses
+        return self.post(payload)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+class TCPTransport:
+    """Kodi's raw TCP JSON-RPC interface (port 9090, shared with its WebSocket).
+
+    Requests are pipelined over one socket without waiting for each other and
+    matched to their responses by id. Notifications, which plain HTTP cannot
+    deliver, are handed to `on_notification(sender, method, data)`.
+    """
+    notifications = True
+
+    def __init__(self, host, port=9090, timeout=60, on_notification=None):
+        self.timeout = timeout
+        self.on_notification = on_notification
+        self.sock = socket.create_connection((host, port), timeout=10)
+        self.sock.settimeout(None)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_loop, name='nfosync-jsonrpc', daemon=True)
+        self.reader.start()
+
+    def read_loop(self):
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')()
+        buffer = ''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            buffer += text.decode(data)
+            while True:
+                buffer = buffer.lstrip()
+                if not buffer:
+                    break
+                try:
+                    message, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    # Incomplete object, wait for more data
+                    break
+                buffer = buffer[end:]
+                self.dispatch(message)
+        with self.lock:
+            self.closed = True
+            for waiter in self.pending.values():
+                waiter[0].set()
+
+    def dispatch(self, message):
+        if isinstance(message, list):
+            for entry in message:
+                self.dispatch(entry)
+            return
+        if 'id' in message and message['id'] is not None:
+            with self.lock:
+                waiter = self.pending.get(message['id'])
+            if waiter is not None:
+                waiter[1].append(message)
+                waiter[0].set()
+        elif 'method' in message and self.on_notification is not None:
+            params = message.get('params', {})
+            self.on_notification(params.get('sender', 'xbmc'), message['method'], params.get('data'))
+
+    def send(self, payload):
+        requests = payload if isinstance(payload, list) else [payload]
+        waiters = []
+        lines = []
+        with self.lock:
+            for request in requests:
+                # Our own ids, so callers on other threads cannot collide
+                self.next_id += 1
+                waiter = (threading.Event(), [])
+                if self.closed:
+                    # Nothing will answer, fail right away instead of timing out
+                    waiter[0].set()
+                self.pending[self.next_id] = waiter
+                waiters.append((self.next_id, request.get('id'), waiter))
+                lines.append(json.dumps(dict(request, id=self.next_id)))
+        try:
+            try:
+                with self.send_lock:
+                    self.sock.sendall(''.join(lines).encode('utf-8'))
+            except OSError:
+                self.closed = True
+                for _, _, (event, _) in waiters:
+                    event.set()
+            responses = []
+            deadline = time.time() + self.timeout
+            for request_id, original_id, (event, result) in waiters:
+                if not event.wait(max(0, deadline - time.time())) or not result:
+                    error = 'connection closed' if self.closed else 'timed out'
+                    result = [{'jsonrpc': '2.0', 'error': {'code': -32000, 'message': error}}]
+                responses.append(dict(result[0], id=original_id))
+        finally:
+            with self.lock:
+                for request_id, _, _ in waiters:
+                    self.pending.pop(request_id, None)
+        return responses if isinstance(payload, list) else responses[0]
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class PathMap:
+    """Maps Kodi paths (smb://nas/media/...) to where the runner sees them."""
+    def __init__(self, mappings):
+        # Longest prefix first
+        self.mappings = sorted(mappings, key=lambda mapping: len(mapping[0]), reverse=True)
+        self.warned = set()
+
+    def local(self, path):
+        for kodi_prefix, local_prefix in self.mappings:
+            if path.startswith(kodi_prefix):
+                rest = path[len(kodi_prefix):].replace('/', os.sep)
+                return local_prefix + rest
+        if '://' in path:
+            prefix = path.split('://', 1)[0]
+            if prefix not in self.warned:
+                self.warned.add(prefix)
+                runtime_log(f"No --path-map for {path}, treating {prefix}:// paths as missing", 2)
+            return None
+        return path
+
+class HeadlessRuntime:
+    """State behind the xbmc* modules the runner provides to service.py."""
+    LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+    def __init__(self, transport, paths, state_dir, settings_file, verbose=False):
+        self.transport = transport
+        self.paths = paths
+        self.state_dir = state_dir
+        self.settings_file = settings_file
+        self.verbose = verbose
+        self.abort = threading.Event()
+        self.notifications = queue.Queue()
+        self.monitors = []
+        self.players = []
+        self.properties = {}
+        self.settings = self.load_settings()
+
+    def load_settings(self):
+        settings = {}
+        tree = ET.parse(os.path.join(ADDON_DIR, 'resources', 'settings.xml'))
+        for setting in tree.iter('setting'):
+            if setting.get('id'):
+                settings[setting.get('id')] = setting.get('default', '')
+        if os.path.exists(self.settings_file):
+            with open(self.settings_file, encoding='utf-8') as f:
+                settings.update({key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in json.load(f).items()})
+        return settings
+
+    def save_settings(self):
+        os.makedirs(os.path.dirname(self.settings_file), exist_ok=True)
+        with open(self.settings_file, 'w', encoding='utf-8') as f:
+            json.dump(self.settings, f, indent=2, sort_keys=True)
+
+    def call(self, method, params=None):
+        response = self.transport.send({'jsonrpc': '2.0', 'method': method, 'params': params or {}, 'id': 1})
+        return (response or {}).get('result')
+
+    def queue_notification(self, sender, method, data):
+        self.notifications.put((sender, method, data))
+
+    def deliver_notifications(self):
+        # Kodi calls Monitor/Player callbacks on the script thread while it waits
+        callbacks = {
+            'VideoLibrary.OnScanStarted': 'onScanStarted', 'VideoLibrary.OnScanFinished': 'onScanFinished',
+            'VideoLibrary.OnCleanStarted': 'onCleanStarted', 'VideoLibrary.OnCleanFinished': 'onCleanFinished',
+        }
+        player_callbacks = {'Player.OnPlay': 'onPlayBackStarted', 'Player.OnAVStart': 'onAVStarted', 'Player.OnStop': 'onPlayBackStopped'}
+        while True:
+            try:
+                sender, method, data = self.notifications.get_nowait()
+            except queue.Empty:
+                return
+            for monitor in self.monitors:
+                monitor.onNotification(sender, method, json.dumps(data))
+                if method in callbacks:
+                    getattr(monitor, callbacks[method])('video')
+            if method in player_callbacks:
+                for player in self.players:
+                    getattr(player, player_callbacks[method])()
+
+    def builtin(self, command):
+        match = re.match(r'(\w+)\((.*)\)$', command.strip())
+        name, args = (match.group(1), [arg.strip() for arg in match.group(2).split(',')]) if match else (command, [])
+        if name == 'UpdateLibrary':
+            params = {'directory': ','.join(args[1:])} if len(args) > 1 else {}
+            self.call('VideoLibrary.Scan', params)
+        elif name == 'CleanLibrary':
+            params = {'showdialogs': len(args) > 1 and args[1] == 'true'}
+            if len(args) > 2:
+                params['directory'] = ','.join(args[2:])
+            self.call('VideoLibrary.Clean', params)
+        elif name == 'ExportLibrary':
+            self.call('VideoLibrary.Export', {'options': {'overwrite': True, 'images': True, 'actorthumbs': True}})
+        else:
+            runtime_log(f"Builtin not supported by the headless runner: {command}", 2)
+
+def runtime_log(msg, level=1):
+    if level >= (0 if RUNTIME is not None and RUNTIME.verbose else 1):
+        name = HeadlessRuntime.LEVELS[min(max(level, 0), 3)]
+        sys.stderr.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {name:7} {msg}\n")
+        sys.stderr.flush()
+
+RUNTIME = None
+
+def kodi_modules(runtime):
+    # Minimal xbmc, xbmcaddon, xbmcgui and xbmcvfs backed by the runtime
+    xbmc = types.ModuleType('xbmc')
+    xbmc.LOGDEBUG, xbmc.LOGINFO, xbmc.LOGWARNING, xbmc.LOGERROR = 0, 1, 2, 3
+    xbmc.log = runtime_log
+    xbmc.executeJSONRPC = lambda request: json.dumps(runtime.transport.send(json.loads(request)))
+    xbmc.executebuiltin = lambda command, wait=False: runtime.builtin(command)
+    xbmc.sleep = lambda ms: time.sleep(ms / 1000.0)
+
+    def get_cond_visibility(condition):
+        result = runtime.call('XBMC.GetInfoBooleans', {'booleans': [condition]}) or {}
+        return bool(result.get(condition))
+    xbmc.getCondVisibility = get_cond_visibility
+
+    class Monitor:
+        def __init__(self):
+            runtime.monitors.append(self)
+
+        def abortRequested(self):
+            return runtime.abort.is_set()
+
+        def waitForAbort(self, timeout=None):
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                runtime.deliver_notifications()
+                remaining = 0.1 if deadline is None else min(0.1, deadline - time.time())
+                if remaining <= 0 or runtime.abort.wait(remaining):
+                    runtime.deliver_notifications()
+                    return runtime.abort.is_set()
+
+        def onNotification(self, sender, method, data): pass
+        def onSettingsChanged(self): pass
+        def onScanStarted(self, library): pass
+        def onScanFinished(self, library): pass
+        def onCleanStarted(self, library): pass
+        def onCleanFinished(self, library): pass
+    xbmc.Monitor = Monitor
+
+    class Player:
+        def __init__(self):
+            runtime.players.append(self)
+
+        def isPlaying(self):
+            return bool(runtime.call('Player.GetActivePlayers'))
+
+        def onPlayBackStarted(self): pass
+        def onAVStarted(self): pass
+        def onPlayBackStopped(self): pass
+        def onPlayBackEnded(self): pass
+        def onPlayBackError(self): pass
+    xbmc.Player = Player
+
+    xbmcaddon = types.ModuleType('xbmcaddon')
+
+    class Addon:
+        def __init__(self, id=None):
+            pass
+
+        def getAddonInfo(self, key):
+            return {'id': 'service.library.nfosync', 'name': 'NFO Sync', 'path': ADDON_DIR, 'profile': runtime.state_dir}.get(key, '')
+
+        def getSetting(self, key):
+            return runtime.settings.get(key, '')
+
+        def getSettingBool(self, key):
+            return self.getSetting(key).lower() == 'true'
+
+        def getSettingInt(self, key):
+            return int(float(self.getSetting(key) or 0))
+
+        def getSettingString(self, key):
+            return self.getSetting(key)
+
+        def setSetting(self, key, value):
+            runtime.settings[key] = str(value)
+            runtime.save_settings()
+
+        def setSettingBool(self, key, value):
+            self.setSetting(key, 'true' if value else 'false')
+
+        def setSettingInt(self, key, value):
+            self.setSetting(key, int(value))
+
+        def setSettingString(self, key, value):
+            self.setSetting(key, value)
+    xbmcaddon.Addon = Addon
+
+    xbmcgui = types.ModuleType('xbmcgui')
+    xbmcgui.NOTIFICATION_INFO, xbmcgui.NOTIFICATION_WARNING, xbmcgui.NOTIFICATION_ERROR = 'info', 'warning', 'error'
+
+    class Dialog:
+        def notification(self, heading, message, icon='info', time=5000, sound=True):
+            runtime.call('GUI.ShowNotification', {'title': heading, 'message': message, 'image': icon, 'displaytime': time})
+    xbmcgui.Dialog = Dialog
+
+    class Window:
+        # Properties stay local to the runner, JSON-RPC cannot set them in Kodi
+        def __init__(self, window_id=0):
+            self.values = runtime.properties.setdefault(window_id, {})
+
+        def getProperty(self, key):
+            return self.values.get(key, '')
+
+        def setProperty(self, key, value):
+            self.values[key] = value
+
+        def clearProperty(self, key):
+            self.values.pop(key, None)
+    xbmcgui.Window = Window
+
+    xbmcvfs = types.ModuleType('xbmcvfs')
+    xbmcvfs.translatePath = lambda path: path
+
+    def exists(path):
+        local = runtime.paths.local(path)
+        return local is not None and os.path.exists(local)
+    xbmcvfs.exists = exists
+    xbmcvfs.mkdirs = lambda path: os.makedirs(runtime.paths.local(path), exist_ok=True) or True
+
+    def listdir(path):
+        local = runtime.paths.local(path)
+        dirs, files = [], []
+        if local is not None and os.path.isdir(local):
+            for entry in os.scandir(local):
+                (dirs if entry.is_dir() else files).append(entry.name)
+        return dirs, files
+    xbmcvfs.listdir = listdir
+
+    def delete(path):
+        local = runtime.paths.local(path)
+        try:
+            os.remove(local)
+            return True
+        except (OSError, TypeError):
+            return False
+    xbmcvfs.delete = delete
+
+    class Stat:
+        def __init__(self, path):
+            local = runtime.paths.local(path)
+            try:
+                self.stat = os.stat(local) if local is not None else None
+            except OSError:
+                self.stat = None
+
+        def st_mtime(self):
+            return int(self.stat.st_mtime) if self.stat else 0
+
+        def st_size(self):
+            return self.stat.st_size if self.stat else 0
+    xbmcvfs.Stat = Stat
+
+    class File:
+        def __init__(self, path, mode='r'):
+            local = runtime.paths.local(path)
+            if local is None:
+                raise IOError(f"No --path-map for {path}")
+            self.file = open(local, 'wb' if mode == 'w' else 'rb')
+
+        def readBytes(self, count=-1):
+            return bytearray(self.file.read(count))
+
+        def read(self, count=-1):
+            return self.file.read(count).decode('utf-8', 'replace')
+
+        def write(self, data):
+            self.file.write(data.encode('utf-8') if isinstance(data, str) else data)
+            return True
+
+        def close(self):
+            self.file.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+    xbmcvfs.File = File
+
+    return {'xbmc': xbmc, 'xbmcaddon': xbmcaddon, 'xbmcgui': xbmcgui, 'xbmcvfs': xbmcvfs}
+
+def connect(args, runtime_notifications):
+    if args.transport == 'tcp':
+        try:
+            return TCPTransport(args.host, args.tcp_port, on_notification=runtime_notifications)
+        except OSError as e:
+            runtime_log(f"Could not connect to {args.host}:{args.tcp_port} ({e}), using HTTP without notifications", 2)
+    return HTTPTransport(args.host, args.http_port, args.username, args.password, pool_size=args.connections)
+
+def main(argv=None):
+    global RUNTIME
+    parser = argparse.ArgumentParser(description="Run NFO Sync tasks against a remote Kodi instance.")
+    parser.add_argument('task', choices=['import', 'export', 'export-all', 'clean'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--http-port', type=int, default=8080)
+    parser.add_argument('--tcp-port', type=int, default=9090)
+    parser.add_argument('--transport', choices=['tcp', 'http'], default='tcp',
+                        help="tcp pipelines requests and receives notifications, http pools connections")
+    parser.add_argument('--connections', type=int, default=4, help="HTTP connection pool size")
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--path-map', action='append', default=[], metavar='KODI=LOCAL',
+                        help="e.g. smb://nas/media/=/volume1/media/, may be repeated")
+    parser.add_argument('--state-dir', default=os.path.join(os.path.expanduser('~'), '.nfosync'))
+    parser.add_argument('--settings', help="JSON settings file (default: <state dir>/settings.json)")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    mappings = []
+    for mapping in args.path_map:
+        if '=' not in mapping:
+            parser.error(f"--path-map expects KODI=LOCAL, got {mapping}")
+        mappings.append(tuple(mapping.split('=', 1)))
+
+    state_dir = os.path.abspath(args.state_dir) + os.sep
+    os.makedirs(state_dir, exist_ok=True)
+    RUNTIME = HeadlessRuntime(None, PathMap(mappings), state_dir,
+                              args.settings or os.path.join(state_dir, 'settings.json'), args.verbose)
+    transport = RUNTIME.transport = connect(args, RUNTIME.queue_notification)
+    sys.modules.update(kodi_modules(RUNTIME))
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: RUNTIME.abort.set())
+
+    sys.path.insert(0, ADDON_DIR)
+    import service
+    service.set_transport(transport)
+    sync = service.NFOSyncService()
+    try:
+        if args.task == 'import':
+            sync.run_import()
+        elif args.task == 'export':
+            sync.run_export()
+        elif args.task == 'export-all':
+            sync.run_export(full=True)
+        elif args.task == 'clean':
+            sync.run_clean()
+    finally:
+        transport.close()
+    return 1 if RUNTIME.abort.is_set() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
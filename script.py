@@ -1,12 +1,14 @@
 import xbmc
 import xbmcgui
-from service import NFOSyncService, logger
+from service import NFOSyncService, format_sync_stats, load_sync_stats, logger
 
 if __name__ == '__main__':
-    options = ['Import (from NFOs)', 'Export (to NFOs)', 'Clean Library']
+    options = ['Import (from NFOs)', 'Export (to NFOs)', 'Export All (to NFOs)', 'Clean Library', 'Show Sync Statistics']
     ret = xbmcgui.Dialog().select('NFO Sync Manual Trigger', options)
 
-    if ret >= 0:
+    if ret == 4:
+        xbmcgui.Dialog().textviewer('NFO Sync Statistics', format_sync_stats(load_sync_stats()), usemono=True)
+    elif ret >= 0:
         service = NFOSyncService()
         if ret == 0:
             logger.log("Manual Trigger: Import")
@@ -15,5 +17,8 @@ if __name__ == '__main__':
             logger.log("Manual Trigger: Export")
             service.run_export()
         elif ret == 2:
+            logger.log("Manual Trigger: Full Export")
+            service.run_export(full=True)
+        elif ret == 3:
             logger.log("Manual Trigger: Clean")
             service.run_clean()
@@ -5,24 +5,149 @@ import xbmcgui
 import xbmcvfs
 import time
 import json
+import sys
+import logging
+import logging.handlers
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import sqlite3
+import hashlib
+import io
+import threading
+import heapq
+import random
+import socket
+import uuid
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
 ADDON_ID = 'service.library.nfosync'
 ADDON = xbmcaddon.Addon()
 
 class Logger:
+    """Writes to kodi.log and, optionally, to a rotating sync log in the profile.
+
+    The log_verbosity setting picks what is written: Quiet keeps warnings,
+    errors and run summaries, Normal adds progress and reports, Debug adds the
+    per-item messages. Those go through debug() with %-style arguments, which
+    are only formatted when the message is actually written.
+    """
+    THRESHOLDS = {'Quiet': xbmc.LOGWARNING, 'Normal': xbmc.LOGINFO, 'Debug': xbmc.LOGDEBUG}
+    FILE_LEVELS = {xbmc.LOGDEBUG: logging.DEBUG, xbmc.LOGINFO: logging.INFO, xbmc.LOGWARNING: logging.WARNING, xbmc.LOGERROR: logging.ERROR}
+    MAX_FILE_BYTES = 1 << 20
+    FILE_BACKUPS = 3
+
+    def __init__(self):
+        self.threshold = xbmc.LOGINFO
+        self.file_log = None
+
+    def configure(self):
+        # Applies the logging settings, called at start and when settings change
+        self.threshold = self.THRESHOLDS.get(ADDON.getSetting('log_verbosity'), xbmc.LOGINFO)
+        if ADDON.getSettingBool('log_file'):
+            if self.file_log is None:
+                try:
+                    handler = logging.handlers.RotatingFileHandler(
+                        get_profile_path('nfosync.log'), maxBytes=self.MAX_FILE_BYTES, backupCount=self.FILE_BACKUPS, encoding='utf-8')
+                except OSError as e:
+                    self.log(f"Could not open the sync log: {e}", xbmc.LOGWARNING)
+                    return
+                handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(message)s'))
+                self.file_log = logging.getLogger(ADDON_ID)
+                self.file_log.propagate = False
+                self.file_log.setLevel(logging.DEBUG)
+                self.file_log.addHandler(handler)
+        elif self.file_log is not None:
+            for handler in list(self.file_log.handlers):
+                self.file_log.removeHandler(handler)
+                handler.close()
+            self.file_log = None
+
     def log(self, msg, level=xbmc.LOGINFO):
+        if level >= self.threshold:
+            self.write(msg, level)
+
+    def debug(self, msg, *args):
+        if self.threshold > xbmc.LOGDEBUG:
+            return
+        # Written as info, Debug verbosity should not need Kodi's debug logging too
+        self.write(msg % args if args else msg, xbmc.LOGINFO)
+
+    def write(self, msg, level):
         try:
             xbmc.log(f"[{ADDON_ID}] {msg}", level)
         except UnicodeEncodeError:
             # Fallback for systems/files with encoding issues
-            sanitized = msg.encode('utf-8', 'replace').decode('utf-8')
-            xbmc.log(f"[{ADDON_ID}] {sanitized}", level)
+            msg = msg.encode('utf-8', 'replace').decode('utf-8')
+            xbmc.log(f"[{ADDON_ID}] {msg}", level)
+        if self.file_log is not None:
+            self.file_log.log(self.FILE_LEVELS.get(level, logging.INFO), msg)
+
+    def progress(self, label, total):
+        return ProgressLog(self, label, total)
+
+    def summary(self, run):
+        # One line per finished run whatever the verbosity, plus the full record in the sync log
+        counts = ', '.join(f"{name} {amount}" for name, amount in sorted(run['counts'].items()))
+        phases = ', '.join(f"{name} {seconds:.1f}s" for name, seconds in sorted(run['phases'].items(), key=lambda phase: -phase[1]))
+        calls = sum(entry['calls'] for entry in run['rpc'].values())
+        accesses = sum(entry['calls'] for entry in run['vfs'].values())
+        status = 'skipped' if run['skipped'] else 'finished' if run['completed'] else 'interrupted'
+        self.write(f"=== {run['task'].capitalize()} {status} in {run['duration']:.1f}s: {counts or 'no items'} | {phases or 'no phases'} | "
+                   f"{calls} JSON-RPC calls, {accesses} file accesses ===", xbmc.LOGINFO if run['completed'] else xbmc.LOGWARNING)
+        if self.file_log is not None:
+            record = {key: value for key, value in run.items() if key not in ('thread', 'stack')}
+            self.file_log.info('summary %s', json.dumps(record, sort_keys=True))
 
     def notify(self, header, message, icon=xbmcgui.NOTIFICATION_INFO, time=5000):
         if ADDON.getSettingBool('show_notifications'):
             xbmcgui.Dialog().notification(header, message, icon, time)
 
+class ProgressLog:
+    """Progress of a long loop, logged at most every EVERY_ITEMS items or
+    EVERY_SECONDS seconds, whichever comes first, with the rate and time left."""
+    EVERY_ITEMS = 1000
+    EVERY_SECONDS = 30
+
+    def __init__(self, logger, label, total):
+        self.logger = logger
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.time()
+        self.next_count = self.EVERY_ITEMS
+        self.next_time = self.started + self.EVERY_SECONDS
+
+    def update(self, count=1):
+        self.done += count
+        if self.done < self.next_count and time.time() < self.next_time:
+            return
+        now = time.time()
+        self.next_count = self.done + self.EVERY_ITEMS
+        self.next_time = now + self.EVERY_SECONDS
+        rate = self.done / max(now - self.started, 0.001)
+        line = f"{self.label}: {self.done}/{self.total}"
+        if self.total:
+            line += f" ({self.done * 100 // self.total}%)"
+        line += f", {rate:.0f} items/sec"
+        if self.total > self.done and rate > 0:
+            line += f", about {format_duration((self.total - self.done) / rate)} left"
+        self.logger.log(line)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds // 60 % 60:02d}m"
+
 logger = Logger()
 
 def get_setting_int(id):
@@ -43,6 +168,1043 @@ def get_last_run(key):
 def set_last_run(key, timestamp):
     ADDON.setSetting(key, str(timestamp))
 
+def get_profile_path(filename=''):
+    profile = xbmcvfs.translatePath(ADDON.getAddonInfo('profile'))
+    if not xbmcvfs.exists(profile):
+        xbmcvfs.mkdirs(profile)
+    return os.path.join(profile, filename)
+
+class NFOStateIndex:
+    """Persistent record of the NFO files last seen for each library item.
+
+    Rows are keyed by (media_type, item_id, nfo_path) and hold the mtime and size
+    observed when the item was last checked, so Smart Sync can diff every NFO
+    against its own previous state instead of a single global timestamp. The
+    time of the check is kept too: an NFO written within the filesystem's time
+    granularity of it can change again without its mtime moving.
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS nfo_state ('
+            'media_type TEXT NOT NULL, item_id INTEGER NOT NULL, nfo_path TEXT NOT NULL, '
+            'file TEXT NOT NULL, mtime INTEGER NOT NULL, size INTEGER NOT NULL, checked INTEGER NOT NULL DEFAULT 0, '
+            'PRIMARY KEY (media_type, item_id, nfo_path))'
+        )
+        # Added later, rows from before have no check time
+        if 'checked' not in {row[1] for row in self.conn.execute('PRAGMA table_info(nfo_state)')}:
+            self.conn.execute('ALTER TABLE nfo_state ADD COLUMN checked INTEGER NOT NULL DEFAULT 0')
+        # Digest of the NFO content that cannot be applied with Set*Details
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS nfo_extra ('
+            'media_type TEXT NOT NULL, item_id INTEGER NOT NULL, nfo_path TEXT NOT NULL, digest TEXT NOT NULL, '
+            'PRIMARY KEY (media_type, item_id, nfo_path))'
+        )
+        # Content hash of the NFO as last imported, for mtime-independent checks
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS nfo_hash ('
+            'media_type TEXT NOT NULL, item_id INTEGER NOT NULL, nfo_path TEXT NOT NULL, content_hash TEXT NOT NULL, '
+            'PRIMARY KEY (media_type, item_id, nfo_path))'
+        )
+        # NFO change watcher lookups
+        self.conn.execute('CREATE INDEX IF NOT EXISTS nfo_state_path ON nfo_state (nfo_path)')
+        self.conn.commit()
+
+    def get(self, media_type, item_id, file_path):
+        rows = self.conn.execute(
+            'SELECT nfo_path, file, mtime, size FROM nfo_state WHERE media_type = ? AND item_id = ?',
+            (media_type, item_id)
+        ).fetchall()
+        # A different media file means the id was reused or the item moved
+        if any(row[1] != file_path for row in rows):
+            self.forget(media_type, item_id)
+            return {}
+        return {row[0]: (row[2], row[3]) for row in rows}
+
+    def record(self, media_type, item_id, file_path, nfo_path, mtime, size):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO nfo_state (media_type, item_id, nfo_path, file, mtime, size, checked) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (media_type, item_id, nfo_path, file_path, mtime, size, int(time.time()))
+        )
+
+    def ambiguous(self, media_type, item_id, granularity):
+        # NFOs whose recorded mtime was within `granularity` seconds of the check
+        return {row[0] for row in self.conn.execute(
+            'SELECT nfo_path FROM nfo_state WHERE media_type = ? AND item_id = ? AND checked > 0 AND mtime >= checked - ?',
+            (media_type, item_id, granularity)
+        )}
+
+    def forget(self, media_type, item_id, nfo_path=None):
+        for table in ('nfo_state', 'nfo_extra', 'nfo_hash'):
+            if nfo_path is None:
+                self.conn.execute(f'DELETE FROM {table} WHERE media_type = ? AND item_id = ?', (media_type, item_id))
+            else:
+                self.conn.execute(f'DELETE FROM {table} WHERE media_type = ? AND item_id = ? AND nfo_path = ?', (media_type, item_id, nfo_path))
+
+    def items_for_nfos(self, nfo_paths):
+        # (media_type, item_id, file, nfo_path) of the items reading these NFOs
+        paths = list(nfo_paths)
+        rows = []
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows += self.conn.execute(
+                f'SELECT media_type, item_id, file, nfo_path FROM nfo_state WHERE nfo_path IN ({", ".join("?" * len(chunk))})',
+                chunk
+            ).fetchall()
+        return rows
+
+    def items_in_directories(self, directories):
+        # Same for every NFO directly inside one of the directories
+        directories = set(directories)
+        rows = self.conn.execute('SELECT media_type, item_id, file, nfo_path FROM nfo_state').fetchall()
+        return [row for row in rows if split_path(row[3])[0] in directories]
+
+    def nfo_directories(self):
+        return {split_path(row[0])[0] for row in self.conn.execute('SELECT DISTINCT nfo_path FROM nfo_state')}
+
+    def get_digest(self, media_type, item_id, nfo_path):
+        row = self.conn.execute(
+            'SELECT digest FROM nfo_extra WHERE media_type = ? AND item_id = ? AND nfo_path = ?',
+            (media_type, item_id, nfo_path)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record_digest(self, media_type, item_id, nfo_path, digest):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO nfo_extra (media_type, item_id, nfo_path, digest) VALUES (?, ?, ?, ?)',
+            (media_type, item_id, nfo_path, digest)
+        )
+
+    def get_content_hash(self, media_type, item_id, nfo_path):
+        row = self.conn.execute(
+            'SELECT content_hash FROM nfo_hash WHERE media_type = ? AND item_id = ? AND nfo_path = ?',
+            (media_type, item_id, nfo_path)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record_content_hash(self, media_type, item_id, nfo_path, content_hash):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO nfo_hash (media_type, item_id, nfo_path, content_hash) VALUES (?, ?, ?, ?)',
+            (media_type, item_id, nfo_path, content_hash)
+        )
+
+    def invalidate(self, media_type, item_id):
+        # Forces a mismatch on the next check without losing the known NFO paths
+        self.conn.execute('UPDATE nfo_state SET mtime = -1 WHERE media_type = ? AND item_id = ?', (media_type, item_id))
+        # and a full refresh rather than an NFO apply or a content hash match
+        for table in ('nfo_extra', 'nfo_hash'):
+            self.conn.execute(f'DELETE FROM {table} WHERE media_type = ? AND item_id = ?', (media_type, item_id))
+
+    def prune(self, media_type, seen_ids):
+        # Drop rows for items that are no longer in the library
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen_ids (item_id INTEGER PRIMARY KEY)')
+        self.conn.execute('DELETE FROM seen_ids')
+        self.conn.executemany('INSERT OR IGNORE INTO seen_ids (item_id) VALUES (?)', ((i,) for i in seen_ids))
+        for table in ('nfo_state', 'nfo_extra', 'nfo_hash'):
+            self.conn.execute(
+                f'DELETE FROM {table} WHERE media_type = ? AND item_id NOT IN (SELECT item_id FROM seen_ids)',
+                (media_type,)
+            )
+        self.conn.execute('DELETE FROM seen_ids')
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+def content_hash(path):
+    with xbmcvfs.File(path) as f:
+        data = bytes(f.readBytes())
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class WatchedSnapshotStore:
+    """Crash-safe, append-only record of the watched status of refreshed items.
+
+    Rows are committed before the refresh that could reset them is dispatched and
+    only deleted once their restore has been sent, so whatever is left in the
+    store after a crash or shutdown is exactly the restore still to be done.
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS watched ('
+            'media_type TEXT NOT NULL, item_id INTEGER NOT NULL, file TEXT, '
+            'playcount INTEGER NOT NULL, resume_position REAL NOT NULL, resume_total REAL NOT NULL, lastplayed TEXT NOT NULL, '
+            'PRIMARY KEY (media_type, item_id))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS watched_file ON watched (media_type, file)')
+        self.conn.commit()
+
+    def add(self, media_type, item_id, state):
+        resume = state.get('resume') or {}
+        self.conn.execute(
+            'INSERT OR REPLACE INTO watched (media_type, item_id, file, playcount, resume_position, resume_total, lastplayed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (media_type, item_id, state.get('file'), state.get('playcount', 0), resume.get('position', 0), resume.get('total', 0), state.get('lastplayed', ''))
+        )
+
+    def count(self, media_type=None):
+        if media_type is None:
+            return self.conn.execute('SELECT COUNT(*) FROM watched').fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM watched WHERE media_type = ?', (media_type,)).fetchone()[0]
+
+    def lookup(self, media_type, item_id, file_path):
+        # Refreshed items can come back under a new id, so fall back to the file
+        row = self.conn.execute(
+            'SELECT item_id, playcount, resume_position, resume_total, lastplayed FROM watched WHERE media_type = ? AND item_id = ?',
+            (media_type, item_id)
+        ).fetchone()
+        if row is None and file_path:
+            row = self.conn.execute(
+                'SELECT item_id, playcount, resume_position, resume_total, lastplayed FROM watched WHERE media_type = ? AND file = ?',
+                (media_type, file_path)
+            ).fetchone()
+        if row is None:
+            return None, None
+        return row[0], {'playcount': row[1], 'resume': {'position': row[2], 'total': row[3]}, 'lastplayed': row[4]}
+
+    def items(self, media_type):
+        # (item_id, file) of the rows still to be restored
+        return self.conn.execute('SELECT item_id, file FROM watched WHERE media_type = ? ORDER BY item_id', (media_type,)).fetchall()
+
+    def done(self, media_type, item_id):
+        self.conn.execute('DELETE FROM watched WHERE media_type = ? AND item_id = ?', (media_type, item_id))
+
+    def clear(self, media_type):
+        self.conn.execute('DELETE FROM watched WHERE media_type = ?', (media_type,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+def split_path(path):
+    # Splits at the last separator, works for local paths and URLs alike
+    idx = max(path.rfind('/'), path.rfind('\\'))
+    return path[:idx], path[idx], path[idx + 1:]
+
+def path_separator(path):
+    return '/' if '/' in path else '\\'
+
+def in_folder(path, folder):
+    # The folder itself or anything below it, never a sibling sharing its prefix
+    return path == folder or path.startswith(folder + path_separator(folder))
+
+class DirectoryStateIndex:
+    """Persistent mtimes of the library's directories.
+
+    A directory's mtime changes when entries are added to or removed from it, so
+    comparing against the recorded value tells which folders may hold new files
+    without walking the sources. Paths are stored without a trailing separator.
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dir_state (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL)')
+        self.conn.commit()
+
+    def all(self):
+        return dict(self.conn.execute('SELECT path, mtime FROM dir_state').fetchall())
+
+    def record(self, path, mtime):
+        self.conn.execute('INSERT OR REPLACE INTO dir_state (path, mtime) VALUES (?, ?)', (path, mtime))
+
+    def forget(self, path):
+        self.conn.execute('DELETE FROM dir_state WHERE path = ?', (path,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class ExportDirtySet:
+    """Persistent set of library items changed since the last export.
+
+    Filled from VideoLibrary.OnUpdate notifications and emptied as the changed
+    items are written out, so it survives restarts between scheduled exports.
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS dirty (media_type TEXT NOT NULL, item_id INTEGER NOT NULL, '
+            'PRIMARY KEY (media_type, item_id))'
+        )
+        self.conn.commit()
+
+    def add(self, media_type, item_id):
+        self.conn.execute('INSERT OR IGNORE INTO dirty (media_type, item_id) VALUES (?, ?)', (media_type, item_id))
+        self.conn.commit()
+
+    def remove(self, media_type, item_id):
+        self.conn.execute('DELETE FROM dirty WHERE media_type = ? AND item_id = ?', (media_type, item_id))
+        self.conn.commit()
+
+    def items(self):
+        return self.conn.execute('SELECT media_type, item_id FROM dirty ORDER BY media_type, item_id').fetchall()
+
+    def clear(self):
+        self.conn.execute('DELETE FROM dirty')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class ImportCheckpoint:
+    """Progress of a Full Refresh, kept until the import completes.
+
+    Items are recorded when they are queued for a refresh and marked done once
+    Kodi reports them refreshed; a media type is marked done when its pass ends.
+    A later import with the same settings resumes from here. The checkpoint is
+    dropped when the import settings change or it is older than MAX_AGE, and a
+    done item is only skipped while its id still points at the same file.
+    """
+    MAX_AGE = 7 * 24 * 3600
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoint (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'media_type TEXT NOT NULL, item_id INTEGER NOT NULL, file TEXT NOT NULL, done INTEGER NOT NULL, '
+            'PRIMARY KEY (media_type, item_id))'
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM checkpoint WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO checkpoint (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def begin(self, settings_key):
+        # Returns the time the refresh being resumed started, or None for a new one
+        started = self.get('started')
+        if started is not None and self.get('settings') == settings_key and time.time() - float(started) < self.MAX_AGE:
+            return float(started)
+        self.clear()
+        self.set('started', time.time())
+        self.set('settings', settings_key)
+        self.conn.commit()
+        return None
+
+    def started(self):
+        return float(self.get('started'))
+
+    def type_done(self, media_type):
+        return self.get('done:' + media_type) is not None
+
+    def finish_type(self, media_type):
+        self.set('done:' + media_type, 1)
+        self.conn.commit()
+
+    def queued(self, media_type, item_id, file_path):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO items (media_type, item_id, file, done) VALUES (?, ?, ?, 0)',
+            (media_type, item_id, file_path)
+        )
+
+    def done(self, media_type, item_id):
+        self.conn.execute('UPDATE items SET done = 1 WHERE media_type = ? AND item_id = ?', (media_type, item_id))
+
+    def done_items(self, media_type):
+        rows = self.conn.execute('SELECT item_id, file FROM items WHERE media_type = ? AND done = 1', (media_type,))
+        return {row[0]: row[1] for row in rows}
+
+    def unconfirmed(self):
+        # Queued but never reported refreshed, Kodi may have dropped them
+        return self.conn.execute('SELECT media_type, item_id FROM items WHERE done = 0').fetchall()
+
+    def clear(self):
+        self.conn.execute('DELETE FROM checkpoint')
+        self.conn.execute('DELETE FROM items')
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# Library fields that map 1:1 to NFO elements and can be written back with
+# Set*Details: json field, NFO tag, kind
+NFO_FIELDS = {
+    'movie': [
+        ('title', 'title', 'text'), ('originaltitle', 'originaltitle', 'text'), ('sorttitle', 'sorttitle', 'text'),
+        ('userrating', 'userrating', 'text'), ('top250', 'top250', 'text'), ('plotoutline', 'outline', 'text'),
+        ('plot', 'plot', 'text'), ('tagline', 'tagline', 'text'), ('runtime', 'runtime', 'minutes'),
+        ('mpaa', 'mpaa', 'text'), ('playcount', 'playcount', 'text'), ('lastplayed', 'lastplayed', 'text'),
+        ('uniqueid', 'uniqueid', 'uniqueid'), ('genre', 'genre', 'list'), ('country', 'country', 'list'),
+        ('set', 'set', 'set'), ('tag', 'tag', 'list'), ('writer', 'credits', 'list'), ('director', 'director', 'list'),
+        ('premiered', 'premiered', 'text'), ('studio', 'studio', 'list'), ('trailer', 'trailer', 'text'),
+        ('resume', 'resume', 'resume'), ('dateadded', 'dateadded', 'text'), ('ratings', 'ratings', 'ratings'),
+    ],
+    'tvshow': [
+        ('title', 'title', 'text'), ('originaltitle', 'originaltitle', 'text'), ('sorttitle', 'sorttitle', 'text'),
+        ('userrating', 'userrating', 'text'), ('plot', 'plot', 'text'), ('mpaa', 'mpaa', 'text'),
+        ('uniqueid', 'uniqueid', 'uniqueid'), ('genre', 'genre', 'list'), ('premiered', 'premiered', 'text'),
+        ('studio', 'studio', 'list'), ('tag', 'tag', 'list'), ('dateadded', 'dateadded', 'text'),
+        ('ratings', 'ratings', 'ratings'),
+    ],
+    'episode': [
+        ('title', 'title', 'text'), ('userrating', 'userrating', 'text'), ('plot', 'plot', 'text'),
+        ('season', 'season', 'text'), ('episode', 'episode', 'text'), ('runtime', 'runtime', 'minutes'),
+        ('playcount', 'playcount', 'text'), ('lastplayed', 'lastplayed', 'text'), ('uniqueid', 'uniqueid', 'uniqueid'),
+        ('writer', 'credits', 'list'), ('director', 'director', 'list'), ('firstaired', 'aired', 'text'),
+        ('resume', 'resume', 'resume'), ('dateadded', 'dateadded', 'text'), ('ratings', 'ratings', 'ratings'),
+    ],
+    'musicvideo': [
+        ('title', 'title', 'text'), ('userrating', 'userrating', 'text'), ('album', 'album', 'text'),
+        ('plot', 'plot', 'text'), ('runtime', 'runtime', 'minutes'), ('playcount', 'playcount', 'text'),
+        ('lastplayed', 'lastplayed', 'text'), ('genre', 'genre', 'list'), ('artist', 'artist', 'list'),
+        ('director', 'director', 'list'), ('studio', 'studio', 'list'), ('tag', 'tag', 'list'),
+        ('premiered', 'premiered', 'text'), ('resume', 'resume', 'resume'), ('dateadded', 'dateadded', 'text'),
+    ],
+}
+
+# Per media type: get method, set method, id key, details result key, NFO root tag
+LIBRARY_DETAILS = {
+    'movie': ('VideoLibrary.GetMovieDetails', 'VideoLibrary.SetMovieDetails', 'movieid', 'moviedetails', 'movie'),
+    'tvshow': ('VideoLibrary.GetTVShowDetails', 'VideoLibrary.SetTVShowDetails', 'tvshowid', 'tvshowdetails', 'tvshow'),
+    'episode': ('VideoLibrary.GetEpisodeDetails', 'VideoLibrary.SetEpisodeDetails', 'episodeid', 'episodedetails', 'episodedetails'),
+    'musicvideo': ('VideoLibrary.GetMusicVideoDetails', 'VideoLibrary.SetMusicVideoDetails', 'musicvideoid', 'musicvideodetails', 'musicvideo'),
+}
+
+# Per media type: list method, list result key, refresh method
+LIBRARY_LISTS = {
+    'movie': ('VideoLibrary.GetMovies', 'movies', 'VideoLibrary.RefreshMovie'),
+    'musicvideo': ('VideoLibrary.GetMusicVideos', 'musicvideos', 'VideoLibrary.RefreshMusicVideo'),
+    'tvshow': ('VideoLibrary.GetTVShows', 'tvshows', 'VideoLibrary.RefreshTVShow'),
+    'episode': ('VideoLibrary.GetEpisodes', 'episodes', 'VideoLibrary.RefreshEpisode'),
+}
+
+# NFO_FIELDS that hold numbers in JSON-RPC
+NFO_INT_FIELDS = {'playcount', 'top250', 'userrating', 'season', 'episode'}
+
+# NFO_FIELDS that Kodi fills from the file or file name when the NFO has none
+NFO_KEPT_FIELDS = {'playcount', 'lastplayed', 'resume', 'dateadded', 'season', 'episode'}
+
+class NFOFieldReader:
+    """Stream-parses an NFO into the library fields listed in NFO_FIELDS.
+
+    Top-level elements are handled one at a time with iterparse and discarded.
+    Every element that does not map to a Set*Details field (actors, artwork,
+    stream details, ...) is folded into a digest instead, so a change to one of
+    those can be told apart from a change to mappable fields only. Mapped fields
+    missing from the NFO read as empty so removing one clears it in the library,
+    except for NFO_KEPT_FIELDS: their absence goes into the digest instead.
+    """
+    def read(self, media_type, nfo_path):
+        # Returns (fields, digest), or (None, None) if the NFO cannot be parsed
+        mapping = {tag: (field, kind) for field, tag, kind in NFO_FIELDS[media_type]}
+        with xbmcvfs.File(nfo_path) as f:
+            data = bytes(f.readBytes())
+
+        fields = {}
+        digest = hashlib.sha1()
+        depth = 0
+        try:
+            for event, element in ET.iterparse(io.BytesIO(data), events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                if element.tag in mapping:
+                    field, kind = mapping[element.tag]
+                    self.collect(fields, field, kind, element)
+                else:
+                    digest.update(ET.tostring(element, encoding='utf-8'))
+                element.clear()
+        except ET.ParseError as e:
+            logger.log(f"Cannot parse {nfo_path}: {e}", xbmc.LOGWARNING)
+            return None, None
+
+        for field, _, kind in NFO_FIELDS[media_type]:
+            if field in fields:
+                continue
+            if field in NFO_KEPT_FIELDS:
+                digest.update(f'<no {field}>'.encode('utf-8'))
+            else:
+                fields[field] = self.empty(field, kind)
+        return fields, digest.hexdigest()
+
+    def empty(self, field, kind):
+        if kind == 'list':
+            return []
+        if kind in ('uniqueid', 'ratings'):
+            return {}
+        if kind == 'minutes' or field in NFO_INT_FIELDS:
+            return 0
+        return ''
+
+    def collect(self, fields, field, kind, element):
+        text = (element.text or '').strip()
+        if kind == 'list':
+            if text:
+                fields.setdefault(field, []).append(text)
+        elif kind == 'minutes':
+            if text.isdigit():
+                fields[field] = int(text) * 60
+        elif kind == 'uniqueid':
+            if text:
+                fields.setdefault(field, {})[element.get('type', 'unknown')] = text
+        elif kind == 'set':
+            name = element.findtext('name')
+            fields[field] = (name if name is not None else text).strip()
+        elif kind == 'ratings':
+            for rating in element.findall('rating'):
+                try:
+                    value = float(rating.findtext('value') or 0)
+                except ValueError:
+                    continue
+                votes = ''.join(c for c in rating.findtext('votes') or '' if c.isdigit())
+                fields.setdefault(field, {})[rating.get('name', 'default')] = {
+                    'rating': value,
+                    'votes': int(votes or 0),
+                    'default': rating.get('default') == 'true'
+                }
+        elif kind == 'resume':
+            try:
+                fields[field] = {
+                    'position': float(element.findtext('position') or 0),
+                    'total': float(element.findtext('total') or 0)
+                }
+            except ValueError:
+                pass
+        elif field in NFO_INT_FIELDS:
+            try:
+                fields[field] = int(float(text or 0))
+            except ValueError:
+                pass
+        else:
+            fields[field] = text
+
+class NFOWriter:
+    """Writes the library fields of a single item into its NFO file.
+
+    Kodi can only export the whole library, so changed items are written here.
+    An existing NFO is updated in place: only the fields listed in NFO_FIELDS are
+    replaced and every other element (artwork, stream details, fields from other
+    tools) is kept. Files whose content would not change are not rewritten.
+    Items without an NFO are left to Kodi's full export, which writes the
+    complete file with actors, artwork and stream details.
+    """
+    def properties(self, media_type):
+        return sorted({field for field, _, _ in NFO_FIELDS[media_type]} | {'file'})
+
+    def nfo_path(self, media_type, file_path):
+        # Existing NFO if there is one, otherwise where Kodi's own export puts it
+        if media_type == 'tvshow':
+            directory = file_path.rstrip('/\\')
+            return directory + path_separator(directory) + 'tvshow.nfo'
+        base = os.path.splitext(file_path)[0] + '.nfo'
+        if media_type == 'movie' and not xbmcvfs.exists(base):
+            directory, sep, _ = split_path(file_path)
+            if xbmcvfs.exists(directory + sep + 'movie.nfo'):
+                return directory + sep + 'movie.nfo'
+        return base
+
+    def export(self, media_type, item_id):
+        # Returns (done, file, nfo_path), nfo_path is only set when the NFO was written.
+        # done is None when the item has no NFO yet and needs a full export.
+        method, _, id_key, result_key, root_tag = LIBRARY_DETAILS[media_type]
+        response = json_rpc(method, {id_key: item_id, 'properties': self.properties(media_type)})
+        details = response.get('result', {}).get(result_key)
+        if not details or not details.get('file'):
+            # Removed from the library in the meantime
+            return True, None, None
+
+        nfo_path = self.nfo_path(media_type, details['file'])
+        if not xbmcvfs.exists(nfo_path):
+            logger.debug("No NFO for %s %s yet, leaving it for a full export", media_type, item_id)
+            return None, details['file'], None
+        with xbmcvfs.File(nfo_path) as f:
+            original = bytes(f.readBytes())
+        try:
+            root = ET.fromstring(original)
+        except ET.ParseError as e:
+            # e.g. URL-only or multi-episode NFOs, never clobber those
+            logger.log(f"Skipping export of {nfo_path}, cannot parse existing NFO: {e}", xbmc.LOGWARNING)
+            return True, details['file'], None
+        if root.tag != root_tag:
+            logger.log(f"Skipping export of {nfo_path}, unexpected root <{root.tag}>", xbmc.LOGWARNING)
+            return True, details['file'], None
+        before = self.serialize(ET.fromstring(original))
+
+        for field, tag, kind in NFO_FIELDS[media_type]:
+            if field in details:
+                self.apply(root, tag, kind, details[field])
+
+        after = self.serialize(root)
+        if after == before:
+            return True, details['file'], None
+
+        with xbmcvfs.File(nfo_path, 'w') as f:
+            if not f.write(after):
+                logger.log(f"Could not write {nfo_path}", xbmc.LOGWARNING)
+                return False, details['file'], None
+        logger.debug("Exported %s %s to %s", media_type, item_id, nfo_path)
+        return True, details['file'], nfo_path
+
+    def apply(self, root, tag, kind, value):
+        if kind == 'list':
+            elements = [self.text_element(tag, v) for v in value if v]
+        elif kind == 'minutes':
+            elements = [self.text_element(tag, int(value) // 60)] if value else []
+        elif kind == 'uniqueid':
+            elements = []
+            # Keep whichever id the NFO already marks as default
+            default_type = next((e.get('type') for e in root.findall(tag) if e.get('default') == 'true'), None)
+            ids = sorted((value or {}).items())
+            if default_type not in dict(ids) and ids:
+                default_type = ids[0][0]
+            for id_type, id_value in ids:
+                element = self.text_element(tag, id_value)
+                element.set('type', id_type)
+                if id_type == default_type:
+                    element.set('default', 'true')
+                elements.append(element)
+        elif kind == 'set':
+            elements = []
+            if value:
+                # Only the name comes from the library, keep <overview> and the rest
+                element = root.find(tag)
+                if element is None:
+                    element = ET.Element(tag)
+                name = element.find('name')
+                if name is None:
+                    # Old style <set>Name</set>
+                    element.text = None
+                    name = ET.Element('name')
+                    element.insert(0, name)
+                name.text = str(value)
+                elements.append(element)
+        elif kind == 'ratings':
+            elements = []
+            if value:
+                # Keep the scale the NFO already uses for each rating
+                scales = {e.get('name'): e.get('max') for e in root.findall(tag + '/rating')}
+                element = ET.Element(tag)
+                for name, rating in sorted(value.items()):
+                    entry = ET.SubElement(element, 'rating', name=name, max=scales.get(name) or '10')
+                    entry.set('default', 'true' if rating.get('default') else 'false')
+                    # Same format as Kodi's own export, the float from JSON-RPC is single precision
+                    entry.append(self.text_element('value', f"{float(rating.get('rating', 0)):f}"))
+                    entry.append(self.text_element('votes', rating.get('votes', 0)))
+                elements.append(element)
+        elif kind == 'resume':
+            value = value or {}
+            element = ET.Element(tag)
+            element.append(self.text_element('position', value.get('position', 0)))
+            element.append(self.text_element('total', value.get('total', 0)))
+            elements = [element]
+        else:
+            elements = [self.text_element(tag, value)] if value not in (None, '') else []
+
+        # Replace in place, keeping the position of the first existing element
+        existing = root.findall(tag)
+        position = list(root).index(existing[0]) if existing else len(root)
+        for element in existing:
+            root.remove(element)
+        for offset, element in enumerate(elements):
+            root.insert(position + offset, element)
+
+    def text_element(self, tag, value):
+        element = ET.Element(tag)
+        element.text = str(value)
+        return element
+
+    def serialize(self, root):
+        self.indent(root)
+        return b'<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n' + ET.tostring(root, encoding='utf-8')
+
+    def indent(self, element, level=0):
+        pad = '\n' + '    ' * level
+        if len(element):
+            if not element.text or not element.text.strip():
+                element.text = pad + '    '
+            for child in element:
+                self.indent(child, level + 1)
+            if not child.tail or not child.tail.strip():
+                child.tail = pad
+        if level and (not element.tail or not element.tail.strip()):
+            element.tail = pad
+
+class NFODirectoryCache:
+    """Per-run cache of directory listings used to resolve NFO candidates.
+
+    Each directory is listed once with xbmcvfs.listdir and every candidate in it
+    is then resolved from memory, instead of an exists() round trip per candidate.
+    Library items are enumerated sorted by path, so a small LRU window is enough.
+    """
+    MAX_DIRECTORIES = 256
+
+    def __init__(self):
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def listing(self, directory, sep):
+        with self.lock:
+            if directory in self.listings:
+                self.listings.move_to_end(directory)
+                return self.listings[directory]
+            parent, _, name = split_path(directory)
+            parent_listing = self.listings.get(parent)
+
+        if parent_listing is not None and name.lower() in parent_listing[1]:
+            # Known to be a file (e.g. tvshow.nfo candidate of a movie), nothing to list
+            entry = (set(), {})
+        else:
+            try:
+                started = time.perf_counter()
+                dirs, files = xbmcvfs.listdir(directory + sep)
+                metrics.vfs(directory, time.perf_counter() - started)
+                entry = ({d.lower() for d in dirs}, {f.lower(): f for f in files})
+            except Exception as e:
+                logger.log(f"Error listing directory {directory}: {e}", xbmc.LOGWARNING)
+                entry = (set(), {})
+
+        with self.lock:
+            self.listings[directory] = entry
+            if len(self.listings) > self.MAX_DIRECTORIES:
+                self.listings.popitem(last=False)
+        return entry
+
+    def resolve(self, path):
+        # Returns the path as it exists on disk, or None if it does not exist
+        directory, sep, name = split_path(path)
+        actual = self.listing(directory, sep)[1].get(name.lower())
+        if actual is None:
+            return None
+        return directory + sep + actual
+
+def share_key(path):
+    # Network paths are grouped per host (smb://nas), everything else is local
+    if '://' in path:
+        scheme, rest = path.split('://', 1)
+        host = rest.split('/', 1)[0].rsplit('@', 1)[-1]
+        return f"{scheme}://{host}"
+    return 'local'
+
+class NFOProbePool:
+    """Bounded thread pools for NFO probing, one per share.
+
+    Items are mapped to the video source (Files.GetSources) they live on and each
+    share gets its own pool of at most `per_share` threads, so a slow NAS only
+    queues up its own probes and never starves a fast local disk.
+    """
+    def __init__(self, sources, per_share):
+        self.per_share = max(1, per_share)
+        # Longest source first so nested sources map to the most specific one
+        self.sources = sorted(
+            ((source['file'].rstrip('/\\'), share_key(source['file'])) for source in sources),
+            key=lambda source: len(source[0]), reverse=True
+        )
+        self.executors = {}
+
+    def share_for(self, file_path):
+        for source_path, key in self.sources:
+            if in_folder(file_path, source_path):
+                return key
+        return share_key(file_path)
+
+    def submit(self, file_path, fn, *args):
+        key = self.share_for(file_path)
+        executor = self.executors.get(key)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.per_share, thread_name_prefix='nfosync-probe')
+            self.executors[key] = executor
+        return executor.submit(fn, *args)
+
+    def wait(self, future, timeout):
+        wait([future], timeout)
+        return future.done()
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
+        self.executors = {}
+
+def item_directory(file_path):
+    # TV shows report their folder (with trailing separator), everything else a file
+    if file_path.endswith(('/', '\\')):
+        return file_path.rstrip('/\\')
+    return split_path(file_path)[0]
+
+def merge_scan_targets(paths, roots, siblings=4):
+    # Folds groups of changed sibling folders into their parent and drops
+    # folders already covered by a changed ancestor. Only folders inside a
+    # source are merged, and never into anything above a source root: Kodi
+    # scans nothing for a path without a content type.
+    roots = {root.rstrip('/\\') for root in roots}
+
+    def inside_source(path):
+        return any(in_folder(path, root) for root in roots)
+
+    targets = set(paths)
+    while True:
+        by_parent = {}
+        for path in targets:
+            if path not in roots:
+                by_parent.setdefault(split_path(path)[0], []).append(path)
+        merged = {parent for parent, children in by_parent.items() if len(children) >= siblings and parent and inside_source(parent)}
+        if not merged:
+            break
+        targets = {path for path in targets if path in roots or split_path(path)[0] not in merged} | merged
+
+    result = []
+    for path in sorted(targets):
+        if not any(path.startswith(kept + path_separator(kept)) for kept in result):
+            result.append(path)
+    return result
+
+def notification_item(data):
+    # (type, id) of the item in a VideoLibrary.OnUpdate/OnRemove notification
+    try:
+        payload = json.loads(data)
+    except (TypeError, ValueError):
+        return None, None, {}
+    item = payload.get('item', payload)
+    return item.get('type'), item.get('id'), payload
+
+def get_video_sources():
+    sources_response = json_rpc('Files.GetSources', {'media': 'video'})
+    if 'result' in sources_response and 'sources' in sources_response['result']:
+        metrics.use_sources(sources_response['result']['sources'])
+        return sources_response['result']['sources']
+    return []
+
+class ShareHealth:
+    """Availability of video sources, probed in parallel and cached briefly.
+
+    Every stale source is checked on its own thread, so offline shares time out
+    side by side instead of one after another. A probe still running after
+    PROBE_TIMEOUT counts as unavailable; results are reused for CACHE_SECONDS.
+    """
+    CACHE_SECONDS = 60
+    PROBE_TIMEOUT = 15
+    MAX_WORKERS = 8
+
+    def __init__(self):
+        self.results = {}
+
+    def check(self, paths):
+        # Returns {path: available}
+        now = time.time()
+        stale = [path for path in paths if now - self.results.get(path, (0, False))[0] > self.CACHE_SECONDS]
+        if stale:
+            executor = ThreadPoolExecutor(max_workers=min(len(stale), self.MAX_WORKERS))
+            futures = {path: executor.submit(xbmcvfs.exists, path) for path in stale}
+            wait(futures.values(), timeout=self.PROBE_TIMEOUT)
+            # Do not wait for probes stuck on a dead share
+            executor.shutdown(wait=False)
+            checked = time.time()
+            for path, future in futures.items():
+                available = future.done() and future.exception() is None and bool(future.result())
+                self.results[path] = (checked, available)
+        return {path: self.results[path][1] for path in paths}
+
+class SyncMetrics:
+    """Timings and counters of the running task, kept for the last MAX_RUNS runs.
+
+    Phases are timed exclusively: entering a phase pauses the one around it, so
+    the phase times of a run add up to at most its wall time. Only the thread that
+    started the run records phases; JSON-RPC calls and vfs probes are recorded
+    from any thread into per-method and per-source latency histograms. File
+    access is keyed by the video source (Files.GetSources) the path lives on,
+    falling back to its host until the sources have been read.
+    """
+    MAX_RUNS = 20
+    # Upper bounds in seconds, anything slower lands in the last bucket
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    BUCKET_LABELS = ('<5ms', '<10ms', '<50ms', '<100ms', '<500ms', '<1s', '<5s', '>=5s')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = []
+        self.sources = []
+
+    def use_sources(self, sources):
+        # Longest source first so nested sources map to the most specific one
+        self.sources = sorted((source['file'].rstrip('/\\') for source in sources), key=len, reverse=True)
+
+    @property
+    def current(self):
+        return self.runs[-1] if self.runs else None
+
+    def start(self, task):
+        run = {
+            'task': task,
+            'started': time.time(),
+            'duration': 0,
+            'completed': False,
+            'skipped': False,
+            'phases': {},
+            'counts': {},
+            'rpc': {},
+            'vfs': {},
+            'thread': threading.get_ident(),
+            'stack': [],
+        }
+        with self.lock:
+            # A task chained from another one (clean after import) pauses its phase
+            if self.runs:
+                self.pause(self.runs[-1])
+            self.runs.append(run)
+        return run
+
+    def finish(self, run, completed=True, skipped=False):
+        with self.lock:
+            self.pause(run)
+            run['stack'] = []
+            if run in self.runs:
+                self.runs.remove(run)
+            if self.runs:
+                self.resume(self.runs[-1])
+        run['duration'] = time.time() - run['started']
+        run['completed'] = completed
+        run['skipped'] = skipped
+        self.save(run)
+        logger.summary(run)
+
+    def pause(self, run):
+        now = time.perf_counter()
+        if run['stack']:
+            name, since = run['stack'][-1]
+            run['phases'][name] = run['phases'].get(name, 0) + now - since
+            run['stack'][-1] = (name, None)
+
+    def resume(self, run):
+        if run['stack']:
+            run['stack'][-1] = (run['stack'][-1][0], time.perf_counter())
+
+    @contextmanager
+    def phase(self, name):
+        run = self.current
+        if run is None or run['thread'] != threading.get_ident():
+            yield
+            return
+        with self.lock:
+            self.pause(run)
+            run['stack'].append((name, time.perf_counter()))
+        try:
+            yield
+        finally:
+            with self.lock:
+                if run['stack']:
+                    self.pause(run)
+                    run['stack'].pop()
+                    self.resume(run)
+
+    def count(self, name, amount=1):
+        run = self.current
+        if run is None or not amount:
+            return
+        with self.lock:
+            run['counts'][name] = run['counts'].get(name, 0) + amount
+
+    def rpc(self, method, seconds, items=1):
+        self.observe('rpc', method, seconds, items)
+
+    def vfs(self, path, seconds):
+        source = next((source for source in self.sources if in_folder(path, source)), None)
+        self.observe('vfs', source or share_key(path), seconds, 1)
+
+    def observe(self, kind, key, seconds, items):
+        run = self.current
+        if run is None:
+            return
+        with self.lock:
+            entry = run[kind].get(key)
+            if entry is None:
+                entry = run[kind][key] = {'calls': 0, 'items': 0, 'seconds': 0, 'max': 0, 'histogram': [0] * len(self.BUCKET_LABELS)}
+            entry['calls'] += 1
+            entry['items'] += items
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            bucket = 0
+            while bucket < len(self.BUCKETS) and seconds >= self.BUCKETS[bucket]:
+                bucket += 1
+            entry['histogram'][bucket] += 1
+
+    def save(self, run):
+        record = {key: value for key, value in run.items() if key not in ('thread', 'stack')}
+        try:
+            history = load_sync_stats()
+            history.append(record)
+            with open(get_profile_path('sync_stats.json'), 'w') as f:
+                json.dump(history[-self.MAX_RUNS:], f)
+        except Exception as e:
+            logger.log(f"Could not save sync statistics: {e}", xbmc.LOGWARNING)
+
+def load_sync_stats():
+    # Recorded runs, oldest first
+    try:
+        with open(get_profile_path('sync_stats.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def format_sync_stats(runs):
+    # Text for the statistics view: an overview of the recorded runs and the details of the latest
+    if not runs:
+        return "No sync statistics recorded yet."
+    lines = ["Recent runs:"]
+    for run in reversed(runs):
+        started = datetime.fromtimestamp(run['started']).strftime('%Y-%m-%d %H:%M')
+        # Runs recorded before skipped runs were told apart have no flag
+        status = ' (skipped)' if run.get('skipped') else '' if run['completed'] else ' (interrupted)'
+        lines.append(f"  {started}  {run['task']:<7} {run['duration']:8.1f}s{status}")
+
+    run = runs[-1]
+    lines += ["", f"Latest {run['task']}, {run['duration']:.1f}s:"]
+    if run['phases']:
+        lines.append("Phases:")
+        for name, seconds in sorted(run['phases'].items(), key=lambda phase: -phase[1]):
+            lines.append(f"  {name:<14} {seconds:8.1f}s")
+    if run['counts']:
+        lines.append("Items:")
+        for name, amount in sorted(run['counts'].items()):
+            lines.append(f"  {name:<14} {amount:8d}")
+    for kind, title in (('rpc', 'JSON-RPC calls'), ('vfs', 'File access per source')):
+        if not run[kind]:
+            continue
+        lines.append(f"{title}:")
+        for key, entry in sorted(run[kind].items(), key=lambda item: -item[1]['seconds']):
+            average = entry['seconds'] / entry['calls'] * 1000
+            items = f", {entry['items']} items" if entry['items'] != entry['calls'] else ''
+            lines.append(f"  {key}: {entry['calls']} calls{items}, {entry['seconds']:.1f}s total, avg {average:.0f}ms, max {entry['max'] * 1000:.0f}ms")
+            histogram = ', '.join(f"{label} {n}" for label, n in zip(SyncMetrics.BUCKET_LABELS, entry['histogram']) if n)
+            lines.append(f"    {histogram}")
+    return '\n'.join(lines)
+
+# Timings of the task in progress, saved to the profile when it finishes
+metrics = SyncMetrics()
+
+class KodiTransport:
+    """JSON-RPC through the Kodi instance the addon runs in."""
+    # Whether library notifications reach the Monitor
+    notifications = True
+
+    def send(self, payload):
+        return json.loads(xbmc.executeJSONRPC(json.dumps(payload)))
+
+# Replaced by the headless runner (remote.py) to drive Kodi over the network
+transport = KodiTransport()
+
+def set_transport(new_transport):
+    global transport
+    transport = new_transport
+
 def json_rpc(method, params=None):
     if params is None:
         params = {}
@@ -52,82 +1214,1115 @@ def json_rpc(method, params=None):
         'params': params,
         'id': 1
     }
-    response = xbmc.executeJSONRPC(json.dumps(payload))
-    return json.loads(response)
+    started = time.perf_counter()
+    response = transport.send(payload)
+    metrics.rpc(method, time.perf_counter() - started)
+    return response
 
 def json_rpc_batch(payloads):
     if not payloads:
         return []
-    # Wrap in single list for batch request
-    json_payload = json.dumps(payloads)
-    response = xbmc.executeJSONRPC(json_payload)
-    return json.loads(response)
+    # Sent as a single batch request
+    started = time.perf_counter()
+    responses = transport.send(payloads)
+    methods = {payload['method'] for payload in payloads}
+    metrics.rpc(methods.pop() if len(methods) == 1 else 'batch', time.perf_counter() - started, len(payloads))
+    return responses
+
+class LibraryPages:
+    """Lazily paginated library query using the JSON-RPC `limits` start/end.
+
+    The first page is fetched up front so `total` is known for reporting; further
+    pages are only requested as the iteration reaches them, so at most one page of
+    items is held in memory by the enumeration itself. A failed or short page ends
+    the iteration early and clears `complete`, so callers never take a truncated
+    enumeration for the whole library.
+    """
+    PAGE_SIZE = 500
+
+    def __init__(self, method, result_key, params, page_size=None):
+        self.method = method
+        self.result_key = result_key
+        self.params = params
+        self.page_size = page_size or self.PAGE_SIZE
+        self.ok, self.first_page, self.total = self.fetch(0)
+        self.complete = self.ok
+
+    def fetch(self, start):
+        params = dict(self.params, limits={'start': start, 'end': start + self.page_size})
+        with metrics.phase('enumerate'):
+            response = json_rpc(self.method, params)
+        if 'result' not in response:
+            logger.log(f"{self.method} failed: {response.get('error')}", xbmc.LOGWARNING)
+            return False, [], 0
+        result = response['result']
+        return True, result.get(self.result_key, []), result.get('limits', {}).get('total', 0)
+
+    def __iter__(self):
+        page, start = self.first_page, 0
+        self.first_page = []
+        while page:
+            yield from page
+            start += len(page)
+            if start >= self.total:
+                break
+            ok, page, _ = self.fetch(start)
+            if not ok or not page:
+                logger.log(f"{self.method} stopped after {start} of {self.total} items", xbmc.LOGWARNING)
+                self.complete = False
+
+def library_total(method):
+    # Number of items in the library for a list method, fetching a single one
+    response = json_rpc(method, {'limits': {'start': 0, 'end': 1}})
+    return response.get('result', {}).get('limits', {}).get('total', 0)
+
+def watched_status_equal(current, data):
+    current_resume = current.get('resume', {})
+    resume = data.get('resume', {})
+    return (
+        current.get('playcount', 0) == data.get('playcount', 0)
+        and current_resume.get('position', 0) == resume.get('position', 0)
+        and current_resume.get('total', 0) == resume.get('total', 0)
+        and current.get('lastplayed', '') == data.get('lastplayed', '')
+    )
+
+class AdaptiveBatchSender:
+    """Sends JSON-RPC write batches sized from the observed round-trip latency.
+
+    Starts small and grows or shrinks each batch so that a single batch takes
+    about TARGET_SECONDS, keeping the JSON-RPC thread responsive on slow boxes
+    and databases while avoiding needless round trips on fast ones.
+    """
+    TARGET_SECONDS = 0.5
+    MIN_SIZE = 10
+    MAX_SIZE = 500
+
+    def __init__(self, initial_size=50, on_sent=None):
+        self.size = initial_size
+        self.batch = []
+        self.sent = 0
+        self.on_sent = on_sent
+
+    def add(self, payload):
+        self.batch.append(payload)
+        if len(self.batch) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        started = time.time()
+        json_rpc_batch(self.batch)
+        elapsed = max(time.time() - started, 0.001)
+        self.sent += len(self.batch)
+
+        per_item = elapsed / len(self.batch)
+        self.size = int(min(self.MAX_SIZE, max(self.MIN_SIZE, self.TARGET_SECONDS / per_item)))
+        self.batch = []
+        if self.on_sent is not None:
+            self.on_sent()
+
+class RefreshDispatcher:
+    """Flow-controlled dispatcher for VideoLibrary.Refresh* calls.
+
+    At most `max_in_flight` refreshes are handed to Kodi at a time. An item stays
+    in flight until Kodi announces it (VideoLibrary.OnUpdate/OnRemove, forwarded
+    from NFOSyncService.onNotification) or ITEM_TIMEOUT expires. Errors in the
+    batch responses are retried with exponential backoff. If no notification at
+    all arrives within NOTIFY_GRACE, completion tracking is dropped and items are
+    sent in windows of `max_in_flight` without waiting.
+    """
+    ITEM_TIMEOUT = 120
+    NOTIFY_GRACE = 30
+    MAX_ATTEMPTS = 3
+    RETRY_DELAY = 2
+
+    def __init__(self, monitor, send, label, max_in_flight, on_failed=None, on_done=None):
+        self.monitor = monitor
+        self.send = send
+        self.label = label
+        self.max_in_flight = max(1, max_in_flight)
+        # Refill in chunks rather than one item per freed slot
+        self.window = max(1, self.max_in_flight // 4)
+        self.on_failed = on_failed
+        self.on_done = on_done
+        self.queue = []
+        self.retries = []
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+        # Completion is only tracked if notifications can arrive at all
+        self.tracking = transport.notifications
+        self.notified = False
+        self.started = None
+        self.first_sent = None
+        self.dispatched = 0
+        self.completed = 0
+        self.failed = 0
+
+    def add(self, media_type, item_id, method, params):
+        self.queue.append((media_type, item_id, method, params, 1))
+        if len(self.queue) >= self.window:
+            with metrics.phase('dispatch'):
+                self.pump()
+
+    def on_notification(self, method, data):
+        if method not in ('VideoLibrary.OnUpdate', 'VideoLibrary.OnRemove'):
+            return
+        media_type, item_id, _ = notification_item(data)
+        key = (media_type, item_id)
+        with self.lock:
+            self.notified = True
+            done = self.in_flight.pop(key, None) is not None
+            if done:
+                self.completed += 1
+        if done and self.on_done is not None:
+            self.on_done(media_type, item_id)
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            if not self.tracking or (not self.notified and self.first_sent is not None and now - self.first_sent > self.NOTIFY_GRACE):
+                if self.tracking:
+                    logger.log(f"No library notifications received for {self.label}, dispatching without completion tracking", xbmc.LOGWARNING)
+                    self.tracking = False
+                # Without notifications, sent is as close to done as it gets
+                untracked = list(self.in_flight)
+                self.completed += len(untracked)
+                self.in_flight.clear()
+            else:
+                untracked = []
+                for key, sent_at in list(self.in_flight.items()):
+                    if now - sent_at > self.ITEM_TIMEOUT:
+                        del self.in_flight[key]
+                        self.completed += 1
+        if self.on_done is not None:
+            for media_type, item_id in untracked:
+                self.on_done(media_type, item_id)
+
+    def send_batch(self, entries):
+        batch = []
+        payloads = {}
+        for entry in entries:
+            media_type, item_id, method, params, attempt = entry
+            self.next_id += 1
+            payloads[self.next_id] = entry
+            batch.append({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': self.next_id})
+
+        if self.started is None:
+            self.started = time.time()
+        logger.debug("Sending batch of %d %s...", len(batch), self.label)
+        responses = self.send(batch)
+        now = time.time()
+        if self.first_sent is None:
+            self.first_sent = now
+
+        # Per-item error capture, everything that was accepted is now in flight
+        errors = {}
+        for response in responses or []:
+            if isinstance(response, dict) and 'error' in response:
+                errors[response.get('id')] = response['error']
+        with self.lock:
+            for request_id, entry in payloads.items():
+                media_type, item_id, method, params, attempt = entry
+                if request_id in errors:
+                    self.retry(entry, errors[request_id])
+                    continue
+                self.dispatched += 1
+                self.in_flight[(media_type, item_id)] = now
+
+    def retry(self, entry, error):
+        media_type, item_id, method, params, attempt = entry
+        if attempt >= self.MAX_ATTEMPTS:
+            logger.log(f"{method} failed for {media_type} {item_id}: {error}", xbmc.LOGWARNING)
+            self.failed += 1
+            if self.on_failed is not None:
+                self.on_failed(media_type, item_id)
+            return
+        due = time.time() + self.RETRY_DELAY * (2 ** (attempt - 1))
+        self.retries.append((due, (media_type, item_id, method, params, attempt + 1)))
+
+    def due_retries(self):
+        now = time.time()
+        due = [entry for at, entry in self.retries if at <= now]
+        self.retries = [(at, entry) for at, entry in self.retries if at > now]
+        return due
+
+    def pump(self, drain=False):
+        # Sends queued items as in-flight slots free up, in batches of at least
+        # `window` items. With drain=True this only returns once nothing is queued,
+        # waiting for a retry or in flight.
+        while not self.monitor.abortRequested():
+            self.expire()
+            self.queue = self.due_retries() + self.queue
+            with self.lock:
+                free = self.max_in_flight - len(self.in_flight)
+            if self.queue and free >= min(len(self.queue), self.window):
+                entries, self.queue = self.queue[:free], self.queue[free:]
+                self.send_batch(entries)
+                continue
+            if not self.queue and (not drain or (not self.retries and not self.in_flight)):
+                return
+            # Let Kodi deliver notifications while we wait for free slots
+            self.monitor.waitForAbort(0.2)
+
+    def finish(self):
+        with metrics.phase('dispatch'):
+            self.pump(drain=True)
+        metrics.count('refreshed', self.dispatched)
+        metrics.count('failed', self.failed)
+        if self.started is not None:
+            elapsed = max(time.time() - self.started, 0.001)
+            logger.log(f"{self.label}: {self.dispatched} refreshed in {elapsed:.1f}s ({self.dispatched / elapsed:.1f} items/sec), {self.failed} failed")
+
+class WatchedStateCapture:
+    """Bulk snapshot of watched and in-progress items for Preserve Watched Status.
+
+    A few paginated, filtered queries replace per-item and per-show lookups. The
+    capture runs on a background thread while NFO change detection is going on;
+    `state` and `episodes_of` block until it has finished. Media types whose query
+    was cut short are looked up per item or per show instead.
+    """
+    WATCHED_FILTER = {'or': [
+        {'field': 'playcount', 'operator': 'greaterthan', 'value': '0'},
+        {'field': 'inprogress', 'operator': 'true', 'value': ''}
+    ]}
+    QUERIES = {
+        'movie': ('VideoLibrary.GetMovies', 'movies', 'movieid', True),
+        # Music video filters have no 'inprogress' field, so these are filtered here
+        'musicvideo': ('VideoLibrary.GetMusicVideos', 'musicvideos', 'musicvideoid', False),
+        'episode': ('VideoLibrary.GetEpisodes', 'episodes', 'episodeid', True),
+    }
+    PROPERTIES = ['playcount', 'resume', 'lastplayed', 'file']
 
-class NFOSyncService(xbmc.Monitor):
     def __init__(self):
+        self.snapshot = None
+        self.incomplete = set()
+        self.episodes_by_show = None
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='nfosync-watched')
+        self.future = executor.submit(self.capture)
+        executor.shutdown(wait=False)
+
+    @staticmethod
+    def watched_state(item):
+        if item.get('playcount', 0) > 0 or item.get('resume', {}).get('position', 0) > 0:
+            return {
+                'playcount': item.get('playcount', 0),
+                'resume': item.get('resume', {}),
+                'lastplayed': item.get('lastplayed', ''),
+                'file': item.get('file'),
+                'tvshowid': item.get('tvshowid')
+            }
+        return None
+
+    def capture(self):
+        snapshot = {}
+        incomplete = set()
+        for media_type, (method, result_key, id_key, use_filter) in self.QUERIES.items():
+            properties = list(self.PROPERTIES)
+            if media_type == 'episode':
+                properties.append('tvshowid')
+            params = {'properties': properties}
+            if use_filter:
+                params['filter'] = self.WATCHED_FILTER
+
+            items = {}
+            pages = LibraryPages(method, result_key, params)
+            for item in pages:
+                state = self.watched_state(item)
+                if state:
+                    items[item[id_key]] = state
+            if not pages.complete:
+                incomplete.add(media_type)
+            snapshot[media_type] = items
+        return snapshot, incomplete
+
+    def load(self):
+        if self.snapshot is None:
+            self.snapshot, self.incomplete = self.future.result()
+            logger.log("Captured watched status for " + ", ".join(f"{len(items)} {media_type}s" for media_type, items in self.snapshot.items()))
+            if self.incomplete:
+                logger.log("Watched status of " + ", ".join(f"{media_type}s" for media_type in sorted(self.incomplete)) + " was only partly captured, looking up the rest per item", xbmc.LOGWARNING)
+        return self.snapshot
+
+    def state(self, media_type, item_id):
+        state = self.load()[media_type].get(item_id)
+        if state is None and media_type in self.incomplete:
+            get_method, _, id_key, result_key, _ = LIBRARY_DETAILS[media_type]
+            response = json_rpc(get_method, {id_key: item_id, 'properties': self.PROPERTIES})
+            state = self.watched_state(response.get('result', {}).get(result_key) or {})
+        return state
+
+    def episodes_of(self, tvshow_id):
+        snapshot = self.load()
+        if 'episode' in self.incomplete:
+            params = {'tvshowid': tvshow_id, 'properties': self.PROPERTIES + ['tvshowid'], 'filter': self.WATCHED_FILTER}
+            episodes = {}
+            for episode in LibraryPages('VideoLibrary.GetEpisodes', 'episodes', params):
+                state = self.watched_state(episode)
+                if state:
+                    episodes[episode['episodeid']] = state
+            return episodes
+        if self.episodes_by_show is None:
+            self.episodes_by_show = {}
+            for episode_id, state in snapshot['episode'].items():
+                self.episodes_by_show.setdefault(state['tvshowid'], {})[episode_id] = state
+        return self.episodes_by_show.get(tvshow_id, {})
+
+class SharedLease:
+    """Lease file on a shared folder, so only one of several Kodi instances that
+    share a (MySQL) library runs a task at a time.
+
+    The holder rewrites the lease every HEARTBEAT seconds; a lease not renewed
+    for EXPIRY seconds belongs to an instance that died and may be taken over.
+    Shared folders have no atomic create, so a claim is confirmed by reading it
+    back after SETTLE seconds (the last writer wins). Finished runs are recorded
+    next to the lease so the other instances can skip work that was just done.
+    Instance clocks are expected to be roughly in sync.
+    """
+    HEARTBEAT = 60
+    EXPIRY = 300
+    SETTLE = 2
+
+    def __init__(self, folder, monitor):
+        self.folder = folder
+        self.monitor = monitor
+        base = folder.rstrip('/\\') + path_separator(folder)
+        self.lease_path = base + 'nfosync.lease'
+        self.runs_path = base + 'nfosync.runs'
+        self.owner = uuid.uuid4().hex
+        self.host = socket.gethostname()
+        self.stop = None
+
+    def read(self, path):
+        try:
+            if not xbmcvfs.exists(path):
+                return {}
+            with xbmcvfs.File(path) as f:
+                return json.loads(bytes(f.readBytes()).decode('utf-8') or '{}')
+        except (ValueError, IOError, OSError) as e:
+            logger.log(f"Could not read {path}: {e}", xbmc.LOGWARNING)
+            return {}
+
+    def write(self, path, data):
+        try:
+            with xbmcvfs.File(path, 'w') as f:
+                return bool(f.write(json.dumps(data)))
+        except (IOError, OSError) as e:
+            logger.log(f"Could not write {path}: {e}", xbmc.LOGWARNING)
+            return False
+
+    def acquire(self):
+        current = self.read(self.lease_path)
+        if current and current.get('owner') != self.owner:
+            if time.time() - current.get('heartbeat', 0) < self.EXPIRY:
+                logger.log(f"Shared lease is held by {current.get('host')}, skipping")
+                return False
+            logger.log(f"Taking over the shared lease of {current.get('host')}, it expired")
+
+        lease = {'owner': self.owner, 'host': self.host, 'heartbeat': time.time()}
+        if not self.write(self.lease_path, lease):
+            return False
+        if self.monitor.waitForAbort(self.SETTLE):
+            return False
+        winner = self.read(self.lease_path)
+        if winner.get('owner') != self.owner:
+            logger.log(f"Shared lease was claimed by {winner.get('host')} at the same time, skipping")
+            return False
+
+        self.stop = threading.Event()
+        threading.Thread(target=self.renew, args=(lease, self.stop), name='nfosync-lease', daemon=True).start()
+        return True
+
+    def renew(self, lease, stop):
+        while not stop.wait(self.HEARTBEAT):
+            lease['heartbeat'] = time.time()
+            self.write(self.lease_path, lease)
+
+    def release(self):
+        if self.stop is None:
+            return
+        self.stop.set()
+        self.stop = None
+        if self.read(self.lease_path).get('owner') == self.owner:
+            xbmcvfs.delete(self.lease_path)
+
+    def last_run(self, task):
+        return self.read(self.runs_path).get(task, {}).get('time', 0)
+
+    def record(self, task, timestamp):
+        # Only called while holding the lease, so no other instance writes concurrently
+        runs = self.read(self.runs_path)
+        runs[task] = {'time': timestamp, 'host': self.host}
+        self.write(self.runs_path, runs)
+
+class PlaybackGate(xbmc.Player):
+    """Lets long tasks give way to playback between chunks of work.
+
+    Playback start and stop arrive as Player callbacks. While something plays,
+    wait_turn() either holds the task until playback stops or, when the task
+    should keep running throttled, spaces chunks THROTTLE_INTERVAL seconds apart.
+    """
+    THROTTLE_INTERVAL = 5
+
+    def __init__(self, monitor):
         super().__init__()
-        self.next_run_import = 0
-        self.next_run_export = 0
-        self.next_run_clean = 0
-        self.update_schedule()
+        self.monitor = monitor
+        self.playing = self.isPlaying()
+        self.last_turn = 0
 
-    def update_schedule(self):
-        # Update Import Schedule
-        if ADDON.getSettingBool('import_enabled'):
-            interval = get_setting_int('import_interval')
-            last_run = get_last_run('last_run_import')
-            if last_run == 0:
-                self.next_run_import = time.time() + 60
+    def onPlayBackStarted(self):
+        self.playing = True
+
+    def onAVStarted(self):
+        self.playing = True
+
+    def onPlayBackStopped(self):
+        self.playing = False
+
+    def onPlayBackEnded(self):
+        self.playing = False
+
+    def onPlayBackError(self):
+        self.playing = False
+
+    def wait_turn(self):
+        # Called between chunks, returns False if Kodi is shutting down
+        if self.playing:
+            if ADDON.getSetting('playback_mode') == 'Run Throttled':
+                remaining = self.last_turn + self.THROTTLE_INTERVAL - time.time()
+                if remaining > 0 and self.monitor.waitForAbort(remaining):
+                    return False
             else:
-                self.next_run_import = last_run + (interval * 3600)
-        else:
-            self.next_run_import = 0
+                logger.log("Playback started, pausing until it stops...")
+                while self.playing:
+                    if self.monitor.waitForAbort(1):
+                        return False
+                logger.log("Playback stopped, resuming")
+        self.last_turn = time.time()
+        return not self.monitor.abortRequested()
+
+class LibraryJobTracker:
+    """Follows video library scans and cleans through the Monitor callbacks.
+
+    mark() snapshots the start/finish counters before a job is triggered and
+    wait() returns as soon as a later finish is reported. Until a start is
+    seen, Library.IsScanningVideo is checked after START_TIMEOUT and then every
+    STATUS_INTERVAL, so an ignored request cannot stall the task; a job that
+    never reports back is given up on after TIMEOUT.
+    """
+    START_TIMEOUT = 5
+    STATUS_INTERVAL = 30
+    TIMEOUT = 4 * 3600
+    WAIT_SLICE = 0.1
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.started = {'scan': 0, 'clean': 0}
+        self.finished = {'scan': 0, 'clean': 0}
+
+    def on_started(self, kind, library):
+        if library == 'video':
+            self.started[kind] += 1
+
+    def on_finished(self, kind, library):
+        if library == 'video':
+            self.finished[kind] += 1
+
+    def mark(self):
+        return dict(self.started), dict(self.finished)
+
+    def wait(self, mark, kinds, timeout=None):
+        # True once a job of one of the given kinds finished after mark()
+        started, finished = mark
+        timeout = self.TIMEOUT if timeout is None else timeout
+        begun = time.time()
+        next_check = begun + self.START_TIMEOUT
+        while not self.monitor.abortRequested():
+            if any(self.finished[kind] > finished[kind] for kind in kinds):
+                return True
+            now = time.time()
+            if now >= next_check and not any(self.started[kind] > started[kind] for kind in kinds):
+                # Nothing reported yet, either the request was ignored or the
+                # job started before mark()
+                if not xbmc.getCondVisibility('Library.IsScanningVideo'):
+                    logger.log("No library job running, nothing to wait for. Proceeding...")
+                    return False
+                next_check = now + self.STATUS_INTERVAL
+            if now - begun > timeout:
+                logger.log(f"Gave up waiting for library {'/'.join(kinds)} after {int(now - begun)}s", xbmc.LOGWARNING)
+                return False
+            self.monitor.waitForAbort(self.WAIT_SLICE)
+        return False
 
-        # Update Export Schedule
-        if ADDON.getSettingBool('export_enabled'):
-            interval = get_setting_int('export_interval')
-            last_run = get_last_run('last_run_export')
-            if last_run == 0:
-                self.next_run_export = time.time() + 60
+# Filesystems where inotify only sees changes made through this machine
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', 'fuse.rclone', '9p'}
+
+def network_mount(path):
+    # True if the path lives on a network filesystem mounted on this machine
+    try:
+        with open('/proc/self/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    best, fstype = '', None
+    for mount_point, kind in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > len(best):
+            best, fstype = mount_point, kind
+    return fstype in NETWORK_FILESYSTEMS
+
+class InotifyWatch:
+    """Recursive inotify watches on local directory trees, through libc (Linux only)."""
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.paths = {}
+
+    @classmethod
+    def create(cls):
+        # None where inotify is not available
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            return cls(ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True))
+        except (OSError, AttributeError) as e:
+            logger.log(f"inotify unavailable, checking folders periodically instead: {e}", xbmc.LOGWARNING)
+            return None
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        self.paths[wd] = path
+
+    def add_tree(self, root):
+        # False if the tree could not be watched completely, it is then left to the sweep
+        added = []
+        try:
+            for directory, _, _ in os.walk(root):
+                self.add(directory)
+                added.append(directory)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logger.log(f"inotify watch limit reached for {root} (fs.inotify.max_user_watches), checking it periodically instead", xbmc.LOGWARNING)
             else:
-                self.next_run_export = last_run + (interval * 3600)
-        else:
-            self.next_run_export = 0
+                logger.log(f"Cannot watch {root}, checking it periodically instead: {e}", xbmc.LOGWARNING)
+            for wd, path in list(self.paths.items()):
+                if path in added:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    del self.paths[wd]
+            return False
+        return True
+
+    def read(self, timeout):
+        # (mask, path) of the events that arrive within timeout
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+            offset += self.EVENT.size + length
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((mask, None))
+            elif wd in self.paths:
+                events.append((mask, os.path.join(self.paths[wd], os.fsdecode(name))))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class NFOWatcher:
+    """Collects NFO changes between imports.
+
+    Local sources are watched with inotify. Network sources, including network
+    filesystems mounted locally, and local trees the watch limit cannot cover
+    are swept every `sweep_interval` seconds by comparing directory mtimes; a
+    folder's mtime only moves when entries are added, removed or renamed, so
+    NFOs rewritten in place there are left to the scheduled import. Changes are
+    batched until none arrived for QUIET seconds, or MAX_DELAY after the first,
+    so a tool rewriting hundreds of NFOs triggers a single import. The first
+    change of a batch sets `wakeup`, so the service can sleep until it is due.
+    """
+    QUIET = 10
+    MAX_DELAY = 120
+    READ_TIMEOUT = 1
+
+    def __init__(self, sources, sweep_interval, per_share, wakeup=None):
+        self.sources = sources
+        self.roots = [source['file'].rstrip('/\\') for source in sources]
+        self.sweep_interval = sweep_interval
+        self.per_share = per_share
+        self.wakeup = wakeup
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.inotify = None
+        self.swept_roots = []
+        self.sweep_dirs = set()
+        self.mtimes = {}
+        self.threads = []
+        self.nfos = set()
+        self.folders = set()
+        self.overflow = False
+        self.first_change = None
+        self.last_change = None
+
+    def start(self, directories):
+        local = [root for root in self.roots if '://' not in root and not root.startswith('multipath') and not network_mount(root)]
+        if local:
+            self.inotify = InotifyWatch.create()
+        for root in self.roots:
+            if root.startswith('multipath'):
+                continue
+            if self.inotify is None or root not in local or not self.inotify.add_tree(root):
+                self.swept_roots.append(root)
+        self.track(directories)
+
+        if self.inotify is not None and self.inotify.paths:
+            self.threads.append(threading.Thread(target=self.watch_loop, name='nfosync-inotify', daemon=True))
+        if self.swept_roots:
+            self.threads.append(threading.Thread(target=self.sweep_loop, name='nfosync-sweep', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        logger.log(f"Watching {len(self.roots) - len(self.swept_roots)} sources for NFO changes, checking {len(self.swept_roots)} every {self.sweep_interval // 60} minutes")
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(5)
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def track(self, directories):
+        # Folders to sweep, usually those holding NFOs plus their parents up to the source
+        with self.lock:
+            for root in self.swept_roots:
+                self.sweep_dirs.add(root)
+            for directory in directories:
+                root = next((root for root in self.swept_roots if in_folder(directory, root)), None)
+                while root is not None and directory != root and directory not in self.sweep_dirs:
+                    self.sweep_dirs.add(directory)
+                    directory = split_path(directory)[0]
+
+    def changed(self, nfo=None, folder=None, overflow=False):
+        now = time.time()
+        with self.lock:
+            if nfo is not None:
+                self.nfos.add(nfo)
+            if folder is not None:
+                self.folders.add(folder)
+            self.overflow = self.overflow or overflow
+            started = self.first_change is None
+            if started:
+                self.first_change = now
+            self.last_change = now
+        if started and self.wakeup is not None:
+            self.wakeup.set()
+
+    def pending(self):
+        with self.lock:
+            return self.first_change is not None
+
+    def due_at(self):
+        # When the pending batch becomes due, None without changes
+        with self.lock:
+            if self.first_change is None:
+                return None
+            return min(self.last_change + self.QUIET, self.first_change + self.MAX_DELAY)
+
+    def due(self):
+        now = time.time()
+        with self.lock:
+            return self.first_change is not None and (now - self.last_change >= self.QUIET or now - self.first_change >= self.MAX_DELAY)
+
+    def take(self):
+        # Returns (nfo paths, changed folders, overflow) and starts a new batch
+        with self.lock:
+            batch = (self.nfos, self.folders, self.overflow)
+            self.nfos, self.folders, self.overflow = set(), set(), False
+            self.first_change = self.last_change = None
+        return batch
+
+    def put_back(self, batch):
+        # A batch that could not be imported yet, retried after the next quiet period
+        nfos, folders, overflow = batch
+        with self.lock:
+            self.nfos |= nfos
+            self.folders |= folders
+            self.overflow = self.overflow or overflow
+            self.first_change = self.first_change or time.time()
+            self.last_change = time.time()
+
+    def watch_loop(self):
+        inotify = self.inotify
+        while not self.stopped.is_set():
+            try:
+                events = inotify.read(self.READ_TIMEOUT)
+            except (OSError, ValueError) as e:
+                if not self.stopped.is_set():
+                    logger.log(f"inotify watch stopped: {e}", xbmc.LOGWARNING)
+                return
+            for mask, path in events:
+                if path is None:
+                    logger.log("Too many NFO changes to follow, a full import will pick them up", xbmc.LOGWARNING)
+                    self.changed(overflow=True)
+                elif mask & inotify.IN_ISDIR:
+                    if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                        inotify.add_tree(path)
+                        self.changed(folder=path)
+                elif path.lower().endswith('.nfo') and mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                    self.changed(nfo=path)
+
+    def sweep_loop(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                directories = sorted(self.sweep_dirs)
+            pool = NFOProbePool(self.sources, self.per_share)
+            try:
+                futures = [(path, pool.submit(path, directory_mtime, path)) for path in directories]
+                for path, future in futures:
+                    while not pool.wait(future, self.READ_TIMEOUT):
+                        if self.stopped.is_set():
+                            return
+                    try:
+                        mtime = future.result()
+                    except Exception:
+                        mtime = 0
+                    # Folders seen for the first time only get their baseline
+                    previous = self.mtimes.get(path)
+                    self.mtimes[path] = mtime
+                    if mtime and previous and mtime != previous:
+                        self.changed(folder=path)
+            finally:
+                pool.shutdown()
+            if self.stopped.wait(self.sweep_interval):
+                return
+
+def directory_mtime(path):
+    return xbmcvfs.Stat(path + path_separator(path)).st_mtime()
+
+def parse_time_window(text):
+    # "02:00-06:00" -> (120, 360) in minutes since midnight, None for any time
+    text = (text or '').strip()
+    if not text:
+        return None
+    try:
+        start, end = text.split('-')
+        window = []
+        for part in (start, end):
+            hours, minutes = part.strip().split(':')
+            window.append(int(hours) * 60 + int(minutes))
+    except ValueError:
+        logger.log(f"Ignoring invalid schedule window '{text}', expected HH:MM-HH:MM", xbmc.LOGWARNING)
+        return None
+    if not all(0 <= minute <= 24 * 60 for minute in window):
+        logger.log(f"Ignoring invalid schedule window '{text}', expected HH:MM-HH:MM", xbmc.LOGWARNING)
+        return None
+    return tuple(window)
+
+def next_window_time(ts, window):
+    # Earliest time at or after ts that falls inside the daily window
+    start, end = window
+    if start == end:
+        return ts
+    moment = datetime.fromtimestamp(ts)
+    minute = moment.hour * 60 + moment.minute
+    if start < end:
+        inside = start <= minute < end
+    else:
+        # Window wraps around midnight, e.g. 22:00-04:00
+        inside = minute >= start or minute < end
+    if inside:
+        return ts
+    opens = moment.replace(hour=start // 60 % 24, minute=start % 60, second=0, microsecond=0)
+    if opens <= moment:
+        opens += timedelta(days=1)
+    return opens.timestamp()
+
+def window_close_time(ts, window):
+    # When the daily window that ts falls in closes
+    moment = datetime.fromtimestamp(ts)
+    end = window[1]
+    closes = moment.replace(hour=end // 60 % 24, minute=end % 60, second=0, microsecond=0)
+    if closes <= moment:
+        closes += timedelta(days=1)
+    return closes.timestamp()
+
+class ScheduledTask:
+    """A recurring task whose interval and last run are kept in the addon settings."""
+    def __init__(self, name, action, enabled, interval_key, last_run_key):
+        self.name = name
+        self.action = action
+        self.enabled = enabled
+        self.interval_key = interval_key
+        self.last_run_key = last_run_key
+        self.due = None
+        self.last_run = None
+        self.first_run = 0
+        self.jitter = 0
+        self.failures = 0
+        self.retry_at = 0
+
+class TaskScheduler:
+    """Priority queue of scheduled tasks, ordered by the time they are next due.
+
+    Due times are derived from the settings on reload(), restricted to the
+    optional daily window and spread by a random delay drawn once per cycle. A
+    task that cannot run is postponed with exponential backoff until it
+    completes and its last run moves. Superseded heap entries are skipped.
+    """
+    FIRST_RUN_DELAY = 60
+    RETRY_DELAY = 60
+    MAX_RETRY_DELAY = 3600
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.tasks = OrderedDict()
+        self.heap = []
+        self.sequence = 0
+        self.window = None
+        self.max_jitter = 0
+
+    def add(self, name, action, enabled, interval_key, last_run_key):
+        self.tasks[name] = ScheduledTask(name, action, enabled, interval_key, last_run_key)
+
+    def in_window(self, ts, jitter=0):
+        # Earliest time in the window, delayed by jitter as long as the window stays open
+        if not self.window or self.window[0] == self.window[1]:
+            return ts + jitter
+        opens = next_window_time(ts, self.window)
+        return max(opens, min(opens + jitter, window_close_time(opens, self.window) - 60))
+
+    def push(self, task):
+        self.sequence += 1
+        heapq.heappush(self.heap, (task.due, self.sequence, task.name))
+
+    def reload(self):
+        self.window = parse_time_window(ADDON.getSetting('schedule_window'))
+        max_jitter = get_setting_int('schedule_jitter') * 60
+        jitter_changed = max_jitter != self.max_jitter
+        self.max_jitter = max_jitter
+        now = time.time()
+
+        self.heap = []
+        for task in self.tasks.values():
+            if not task.enabled():
+                task.due = None
+                task.failures = 0
+                task.retry_at = 0
+                continue
+
+            last_run = get_last_run(task.last_run_key)
+            if last_run != task.last_run:
+                # A new cycle, earlier failures no longer apply
+                task.last_run = last_run
+                task.failures = 0
+                task.retry_at = 0
+                task.jitter = random.uniform(0, max_jitter)
+            elif jitter_changed:
+                task.jitter = random.uniform(0, max_jitter)
 
-        # Update Clean Schedule
-        if ADDON.getSettingBool('clean_enabled') and ADDON.getSetting('clean_schedule_type') == 'On Schedule':
-            interval = get_setting_int('clean_interval')
-            last_run = get_last_run('last_run_clean')
             if last_run == 0:
-                self.next_run_clean = time.time() + 60
+                if not task.first_run:
+                    task.first_run = now + self.FIRST_RUN_DELAY
+                due = task.first_run
             else:
-                self.next_run_clean = last_run + (interval * 3600)
-        else:
-            self.next_run_clean = 0
+                due = last_run + get_setting_int(task.interval_key) * 3600
+            task.due = self.in_window(max(due, task.retry_at), task.jitter)
+            self.push(task)
+
+    def postpone(self, name):
+        task = self.tasks[name]
+        if task.due is None:
+            return
+        delay = min(self.RETRY_DELAY * 2 ** task.failures, self.MAX_RETRY_DELAY)
+        task.failures += 1
+        task.retry_at = time.time() + delay
+        task.due = self.in_window(task.retry_at)
+        self.push(task)
+        logger.log(f"Postponing {task.name} by {delay}s (attempt {task.failures})")
+
+    def peek(self):
+        while self.heap:
+            due, _, name = self.heap[0]
+            if self.tasks[name].due == due:
+                return due, self.tasks[name]
+            heapq.heappop(self.heap)
+        return None, None
+
+    def next_due(self):
+        return self.peek()[0]
+
+    def run_due(self):
+        # Runs every task that is due, earliest first
+        while not self.monitor.abortRequested():
+            due, task = self.peek()
+            if due is None or due > time.time():
+                return
+            heapq.heappop(self.heap)
+            task.action()
+            # Still due means the run was skipped or cut short, try again later
+            if task.due is not None and task.due <= time.time() and task.due == due:
+                self.postpone(task.name)
+
+class SettingsWatch(xbmc.Monitor):
+    """Sets an event on settings changes and abort while the service sleeps.
+
+    Kodi hands callbacks only to the thread that created the monitor, and only
+    while it waits in waitForAbort, so a service sleeping until its next task
+    would not hear about them. This monitor lives and waits on its own thread.
+    """
+    def __init__(self, wakeup):
+        super().__init__()
+        self.wakeup = wakeup
 
-        logger.log(f"Schedule updated. Import: {self.fmt_time(self.next_run_import)}, Export: {self.fmt_time(self.next_run_export)}, Clean: {self.fmt_time(self.next_run_clean)}")
+    def onSettingsChanged(self):
+        self.wakeup.set()
+
+    @classmethod
+    def start(cls, wakeup):
+        def watch():
+            cls(wakeup).waitForAbort()
+            wakeup.set()
+        threading.Thread(target=watch, name='nfosync-settings', daemon=True).start()
+
+class NFOSyncService(xbmc.Monitor):
+    # Items handed to the probe pools at a time, results are consumed in order
+    PROBE_WINDOW = 200
+    # More changed folders than this and a full scan is cheaper
+    MAX_SCAN_TARGETS = 50
+    # Longest sleep, as a safety net should a wake-up ever get lost, and how long
+    # to wait in Kodi afterwards for the callbacks that queued up meanwhile
+    IDLE_WAIT = 3600
+    CALLBACK_WAIT = 0.1
+    # Coarsest mtime resolution expected on the shares (FAT and some NAS keep 2 s)
+    MTIME_GRANULARITY = 2
+    # Restores of at most one in this many library items read them by id, in batches
+    RESTORE_BY_ID_RATIO = 20
+    RESTORE_BY_ID_BATCH = 100
+    # Library updates while an import runs in any process are not changes to
+    # export; an import flag older than this was left by an import that died
+    IMPORT_FLAG_EXPIRY = 6 * 3600
+    # Updates for items an import refreshed still arrive after it gave up waiting
+    LATE_UPDATE_WINDOW = 30 * 60
+
+    def __init__(self):
+        super().__init__()
+        self.state_index = None
+        self.watched_snapshot = None
+        self.dispatcher = None
+        self.dirty_set = None
+        # (media_type, item_id) -> time its refresh was queued by this process
+        self.refreshed_items = {}
+        self.dir_cache = NFODirectoryCache()
+        self.probe_pool = None
+        self.checkpoint = None
+        self.verify_content = False
+        self.settings_changed = False
+        self.wakeup = threading.Event()
+        self.job_tracker = LibraryJobTracker(self)
+        self.playback = PlaybackGate(self)
+        self.share_health = ShareHealth()
+        self.scheduler = TaskScheduler(self)
+        self.lease = None
+        self.watcher = None
+        logger.configure()
+        self.scheduler.add('import', lambda: self.run_scheduled('import', 'last_run_import', self.run_import),
+                           self.import_scheduled, 'import_interval', 'last_run_import')
+        self.scheduler.add('export', self.run_scheduled_export, self.export_scheduled, 'export_interval', 'last_run_export')
+        self.scheduler.add('clean', lambda: self.run_scheduled('clean', 'last_run_clean', self.run_clean),
+                           self.clean_scheduled, 'clean_interval', 'last_run_clean')
+        self.update_schedule()
+
+    def update_schedule(self):
+        self.scheduler.reload()
+        logger.log("Schedule updated. " + ", ".join(
+            f"{task.name.capitalize()}: {self.fmt_time(task.due or 0)}" for task in self.scheduler.tasks.values()
+        ))
+
+    def import_scheduled(self):
+        return ADDON.getSettingBool('import_enabled')
+
+    def export_scheduled(self):
+        return ADDON.getSettingBool('export_enabled')
+
+    def clean_scheduled(self):
+        return ADDON.getSettingBool('clean_enabled') and ADDON.getSetting('clean_schedule_type') == 'On Schedule'
+
+    def onSettingsChanged(self):
+        self.settings_changed = True
+        self.wakeup.set()
+
+    def wait_for_next_task(self):
+        # Sleeps until the next task or batch of NFO changes is due, the settings
+        # change or Kodi shuts down; True on abort. waitForAbort cannot be woken
+        # by a callback, so the sleep is on `wakeup`, set by SettingsWatch and the
+        # watcher, and the callbacks of this monitor are taken right after it.
+        self.wakeup.clear()
+        if self.waitForAbort(self.CALLBACK_WAIT):
+            return True
+        if self.settings_changed:
+            self.settings_changed = False
+            logger.configure()
+            self.update_schedule()
+            self.update_watcher()
+            return False
+        due = [self.scheduler.next_due()]
+        if self.watcher is not None:
+            due.append(self.watcher.due_at())
+        due = [ts for ts in due if ts is not None]
+        remaining = min(due) - time.time() if due else self.IDLE_WAIT
+        if remaining > 0:
+            self.wakeup.wait(min(remaining, self.IDLE_WAIT))
+        return self.abortRequested()
 
     def fmt_time(self, ts):
         if ts == 0: return "Disabled/Manual"
         return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
 
-    def wait_for_scan(self):
-        # Wait a moment for scan to potentially start
-        count = 0
-        while count < 10:
-            if xbmc.getCondVisibility('Library.IsScanningVideo'):
-                break
-            xbmc.sleep(1000)
-            count += 1
+    def run_library_job(self, command, kind='scan'):
+        # Triggers UpdateLibrary/CleanLibrary and returns as soon as Kodi reports it done
+        if not self.playback.wait_turn():
+            return
+        with metrics.phase(kind):
+            mark = self.job_tracker.mark()
+            xbmc.executebuiltin(command)
+            self.job_tracker.wait(mark, (kind,))
 
-        # Wait for scan to finish
-        while xbmc.getCondVisibility('Library.IsScanningVideo') and not self.abortRequested():
-            xbmc.sleep(1000)
+    def onScanStarted(self, library):
+        self.job_tracker.on_started('scan', library)
 
-    def should_refresh(self, file_path, last_run):
-        # Determine NFO path
-        if not file_path: return False
+    def onScanFinished(self, library):
+        self.job_tracker.on_finished('scan', library)
+
+    def onCleanStarted(self, library):
+        self.job_tracker.on_started('clean', library)
+
+    def onCleanFinished(self, library):
+        self.job_tracker.on_finished('clean', library)
 
+    def nfo_candidates(self, media_type, file_path):
         # Determine base path and extension
         base, ext = os.path.splitext(file_path)
         candidates = []
@@ -135,6 +2330,10 @@ class NFOSyncService(xbmc.Monitor):
         # 1. Exact match: /path/movie.mkv -> /path/movie.nfo
         candidates.append(base + '.nfo')
 
+        # Episodes only ever have their own NFO next to the file
+        if media_type == 'episode':
+            return candidates
+
         # 2. Movie NFO in parent dir: /path/movie.mkv -> /path/movie.nfo
         parent_dir = os.path.dirname(file_path)
 
@@ -155,30 +2354,262 @@ class NFOSyncService(xbmc.Monitor):
         else:
              candidates.append(os.path.join(file_path, 'tvshow.nfo'))
 
-        for nfo_path in candidates:
-            if xbmcvfs.exists(nfo_path):
+        return candidates
+
+    def stat_nfo(self, nfo_path):
+        started = time.perf_counter()
+        stats = xbmcvfs.Stat(nfo_path)
+        metrics.vfs(nfo_path, time.perf_counter() - started)
+        return stats.st_mtime(), stats.st_size()
+
+    def probe_nfos(self, media_type, file_path, known, ambiguous, last_run):
+        # Filesystem side of change detection, safe to run on a probe thread.
+        # Known NFOs are stat'ed directly; the other candidates are resolved from
+        # the cached directory listing, so a new NFO ahead of a known one is seen.
+        # Returns (observed, hashes). With content verification on, known NFOs
+        # whose mtime or size moved or whose mtime is ambiguous are hashed, and so
+        # are new NFOs the refresh is about to read; nothing else is ever read.
+        observed = {}
+        hashes = {}
+        missing = False
+        for nfo_path, state in known.items():
+            try:
+                observed[nfo_path] = self.stat_nfo(nfo_path)
+            except Exception as e:
+                logger.log(f"Error checking NFO {nfo_path}: {e}", xbmc.LOGWARNING)
+                observed[nfo_path] = state
+                continue
+            if observed[nfo_path] == (0, 0):
+                missing = True
+            elif self.verify_content and (observed[nfo_path] != state or nfo_path in ambiguous):
                 try:
-                    stats = xbmcvfs.Stat(nfo_path)
-                    mtime = stats.st_mtime()
-
-                    if mtime > last_run:
-                        logger.log(f"DETECTED CHANGE: {nfo_path} (mtime {mtime} > last_run {last_run})")
-                        return True
+                    hashes[nfo_path] = content_hash(nfo_path)
                 except Exception as e:
-                    logger.log(f"Error checking NFO {nfo_path}: {e}", xbmc.LOGWARNING)
-                    pass
+                    logger.log(f"Error hashing NFO {nfo_path}: {e}", xbmc.LOGWARNING)
+
+        # Same threshold as compare_nfo_state: after a removal any NFO found is new
+        threshold = 0 if missing else last_run
+        first = True
+        for candidate in self.nfo_candidates(media_type, file_path):
+            nfo_path = self.dir_cache.resolve(candidate)
+            if nfo_path is None:
+                continue
+            # A new NFO ahead of the known ones is the one Kodi reads from now on
+            replaces = first and bool(known)
+            first = False
+            if nfo_path in known:
+                continue
+            try:
+                observed[nfo_path] = self.stat_nfo(nfo_path)
+            except Exception as e:
+                logger.log(f"Error checking NFO {nfo_path}: {e}", xbmc.LOGWARNING)
+                continue
+            if self.verify_content and (observed[nfo_path][0] > threshold or replaces):
+                # Baseline for later checks, the file is about to be read by the refresh anyway
+                try:
+                    hashes[nfo_path] = content_hash(nfo_path)
+                except Exception as e:
+                    logger.log(f"Error hashing NFO {nfo_path}: {e}", xbmc.LOGWARNING)
+
+        return observed, hashes
+
+    def compare_nfo_state(self, media_type, item_id, file_path, known, observed, hashes, last_run):
+        changed = False
+        missing = False
+        for nfo_path, (old_mtime, old_size) in known.items():
+            mtime, size = observed[nfo_path]
+            if mtime == 0 and size == 0:
+                # NFO was removed or renamed, any replacement found is new to us
+                self.state_index.forget(media_type, item_id, nfo_path)
+                missing = True
+            elif (mtime, size) != (old_mtime, old_size) or nfo_path in hashes:
+                self.state_index.record(media_type, item_id, file_path, nfo_path, mtime, size)
+                if nfo_path in hashes:
+                    if hashes[nfo_path] == self.state_index.get_content_hash(media_type, item_id, nfo_path):
+                        logger.debug("NFO touched but content identical, skipping: %s", nfo_path)
+                        continue
+                    self.state_index.record_content_hash(media_type, item_id, nfo_path, hashes[nfo_path])
+                logger.debug("DETECTED CHANGE: %s (mtime %s -> %s, size %s -> %s)", nfo_path, old_mtime, mtime, old_size, size)
+                changed = True
+
+        if missing:
+            last_run = 0
+
+        # Kodi reads a different NFO than before when one was added ahead of it
+        # or removed, whatever the mtimes say
+        chosen = self.chosen_nfo(media_type, file_path, known)
+        now_chosen = self.chosen_nfo(media_type, file_path, [path for path, state in observed.items() if state != (0, 0)])
+        replaced = chosen is not None and now_chosen not in (None, chosen)
+        if replaced:
+            logger.debug("DETECTED CHANGE: %s replaces %s", now_chosen, chosen)
+            changed = True
+
+        for nfo_path, (mtime, size) in observed.items():
+            if nfo_path in known:
+                continue
+            if self.state_index is not None:
+                self.state_index.record(media_type, item_id, file_path, nfo_path, mtime, size)
+            if mtime > last_run or (replaced and nfo_path == now_chosen):
+                logger.debug("DETECTED CHANGE: %s (mtime %s > last_run %s)", nfo_path, mtime, last_run)
+                changed = True
+                if nfo_path in hashes and self.state_index is not None:
+                    self.state_index.record_content_hash(media_type, item_id, nfo_path, hashes[nfo_path])
+
+        return changed
+
+    def known_nfo_state(self, media_type, item_id, file_path):
+        if self.state_index is None:
+            return {}
+        return self.state_index.get(media_type, item_id, file_path)
+
+    def ambiguous_nfos(self, media_type, item_id):
+        # Only consulted when there are content hashes to check against
+        if self.state_index is None or not self.verify_content:
+            return set()
+        return self.state_index.ambiguous(media_type, item_id, self.MTIME_GRANULARITY)
+
+    def chosen_nfo(self, media_type, file_path, nfo_paths):
+        # The one of nfo_paths Kodi reads, in the same order the candidates are probed
+        paths = {path.lower(): path for path in nfo_paths}
+        for candidate in self.nfo_candidates(media_type, file_path):
+            if candidate.lower() in paths:
+                return paths[candidate.lower()]
+        return None
+
+    def primary_nfo(self, media_type, item_id, file_path):
+        return self.chosen_nfo(media_type, file_path, self.known_nfo_state(media_type, item_id, file_path))
+
+    def apply_nfo_changes(self, media_type, item_id, file_path, preserve_watched):
+        # Applies changed NFO fields with Set*Details. Returns False when the item
+        # needs a full refresh: unknown NFO, parse errors, no previous digest or a
+        # change outside the mappable fields.
+        nfo_path = self.primary_nfo(media_type, item_id, file_path)
+        if nfo_path is None:
+            return False
+        fields, digest = NFOFieldReader().read(media_type, nfo_path)
+        if fields is None:
+            return False
 
-        return False
+        previous = self.state_index.get_digest(media_type, item_id, nfo_path)
+        self.state_index.record_digest(media_type, item_id, nfo_path, digest)
+        if previous != digest:
+            return False
+
+        if preserve_watched:
+            for field in ('playcount', 'lastplayed', 'resume'):
+                fields.pop(field, None)
+        if not fields:
+            return True
+
+        get_method, set_method, id_key, result_key, _ = LIBRARY_DETAILS[media_type]
+        response = json_rpc(get_method, {id_key: item_id, 'properties': sorted(fields)})
+        current = response.get('result', {}).get(result_key)
+        if current is None:
+            return False
+
+        changes = {}
+        for field, value in fields.items():
+            current_value = current.get(field)
+            if field == 'resume':
+                current_value = {'position': float((current_value or {}).get('position', 0)), 'total': float((current_value or {}).get('total', 0))}
+            elif field == 'ratings':
+                current_value = self.normalize_ratings(current_value)
+                value = self.normalize_ratings(value)
+            if current_value != value:
+                if field in ('uniqueid', 'ratings'):
+                    # Set*Details merges these maps, entries are removed by setting them to null
+                    value = dict(value, **{key: None for key in current_value or {} if key not in value})
+                changes[field] = value
+        if not changes:
+            logger.debug("NFO unchanged for library fields: %s", nfo_path)
+            return True
+
+        params = dict(changes)
+        params[id_key] = item_id
+        response = json_rpc(set_method, params)
+        if 'error' in response:
+            logger.log(f"{set_method} failed for {nfo_path}, falling back to refresh: {response['error']}", xbmc.LOGWARNING)
+            return False
+        logger.debug("Applied %s from %s", ', '.join(sorted(changes)), nfo_path)
+        return True
+
+    def normalize_ratings(self, ratings):
+        # Kodi stores ratings as single precision floats
+        return {
+            name: {'rating': round(float(r.get('rating', 0)), 2), 'votes': int(r.get('votes', 0)), 'default': bool(r.get('default'))}
+            for name, r in (ratings or {}).items()
+        }
+
+    def should_refresh(self, media_type, item_id, file_path, last_run):
+        # Determine NFO path
+        if not file_path: return False
+
+        known = self.known_nfo_state(media_type, item_id, file_path)
+        ambiguous = self.ambiguous_nfos(media_type, item_id)
+        observed, hashes = self.probe_nfos(media_type, file_path, known, ambiguous, last_run)
+        return self.compare_nfo_state(media_type, item_id, file_path, known, observed, hashes, last_run)
+
+    def detect_changes(self, media_type, items, id_key, last_run):
+        # Yields (item, changed) in library order. Probing runs on the per-share
+        # pools one window at a time; state lookups and updates stay on this thread.
+        # last_run=None disables Smart Sync and marks every item as changed.
+        if last_run is None:
+            for item in items:
+                yield item, True
+            return
+
+        window = []
+        for item in items:
+            window.append(item)
+            if len(window) >= self.PROBE_WINDOW:
+                yield from self.detect_window_changes(media_type, window, id_key, last_run)
+                if self.abortRequested(): return
+                window = []
+        if window:
+            yield from self.detect_window_changes(media_type, window, id_key, last_run)
+
+    def detect_window_changes(self, media_type, window, id_key, last_run):
+        if not self.playback.wait_turn():
+            return
+        jobs = []
+        with metrics.phase('probe'):
+            for item in window:
+                if not item.get('file'):
+                    jobs.append((item, None, None))
+                    continue
+                known = self.known_nfo_state(media_type, item[id_key], item['file'])
+                ambiguous = self.ambiguous_nfos(media_type, item[id_key])
+                future = self.probe_pool.submit(item['file'], self.probe_nfos, media_type, item['file'], known, ambiguous, last_run)
+                jobs.append((item, known, future))
+
+        for index, (item, known, future) in enumerate(jobs):
+            if future is None:
+                yield item, False
+                continue
+            # Timed separately, the caller's work between items is not probing
+            with metrics.phase('probe'):
+                while not self.probe_pool.wait(future, 0.5):
+                    if self.abortRequested():
+                        for _, _, pending in jobs[index:]:
+                            if pending is not None:
+                                pending.cancel()
+                        return
+                try:
+                    observed, hashes = future.result()
+                except Exception as e:
+                    logger.log(f"Error probing NFOs for {item['file']}: {e}", xbmc.LOGWARNING)
+                    changed = False
+                else:
+                    changed = self.compare_nfo_state(media_type, item[id_key], item['file'], known, observed, hashes, last_run)
+                metrics.count('probed')
+            yield item, changed
 
     def wait_while_scanning(self):
         if xbmc.getCondVisibility('Library.IsScanningVideo'):
             logger.log("Library is currently scanning. Waiting for it to finish...")
-            start_wait = time.time()
             while xbmc.getCondVisibility('Library.IsScanningVideo') and not self.abortRequested():
-                xbmc.sleep(1000)
-                if time.time() - start_wait > 30: # Log every 30s
-                    logger.log("Still waiting for library scan to finish...")
-                    start_wait = time.time()
+                # Not our job, so its finish is simply the next one reported
+                self.job_tracker.wait(self.job_tracker.mark(), ('scan', 'clean'))
             logger.log("Library scan finished. Proceeding...")
 
     def acquire_lock(self):
@@ -189,39 +2620,75 @@ class NFOSyncService(xbmc.Monitor):
             return False
 
         xbmcgui.Window(10000).setProperty('service.library.nfosync.sync_active', 'true')
+
+        # Other instances sharing the library
+        lease = self.shared_lease()
+        if lease is not None and not lease.acquire():
+            xbmcgui.Window(10000).setProperty('service.library.nfosync.sync_active', 'false')
+            return False
         return True
 
     def release_lock(self):
+        if self.lease is not None:
+            self.lease.release()
         xbmcgui.Window(10000).setProperty('service.library.nfosync.sync_active', 'false')
 
-    def are_shares_available(self):
+    def shared_lease(self):
+        folder = ADDON.getSetting('shared_folder')
+        if not folder:
+            return None
+        if self.lease is None or self.lease.folder != folder:
+            self.lease = SharedLease(folder, self)
+        return self.lease
+
+    def record_run(self, task, key, timestamp):
+        set_last_run(key, timestamp)
+        lease = self.shared_lease()
+        if lease is not None:
+            lease.record(task, timestamp)
+
+    def run_scheduled(self, task, key, action):
+        # Skips a scheduled task another instance sharing the library already ran
+        lease = self.shared_lease()
+        if lease is not None:
+            shared = lease.last_run(task)
+            if shared > get_last_run(key):
+                logger.log(f"{task.capitalize()} already ran on another instance at {self.fmt_time(shared)}, skipping")
+                set_last_run(key, shared)
+                self.update_schedule()
+                return
+        action()
+
+    def run_scheduled_export(self):
+        # A changed-items export only covers changes seen by this instance, so every instance runs its own
+        if ADDON.getSetting('export_type') == 'Changed Items Only':
+            self.run_export()
+        else:
+            self.run_scheduled('export', 'last_run_export', self.run_export)
+
+    def available_sources(self):
+        # Returns (available, unavailable) source paths, or None if the sources cannot be read
         try:
-            # Get video sources
-            sources_response = json_rpc('Files.GetSources', {'media': 'video'})
-            if 'result' in sources_response and 'sources' in sources_response['result']:
-                for source in sources_response['result']['sources']:
-                    path = source['file']
-                    # Ignore addons and special paths if needed, but usually we want to check everything
-                    # especially network shares (smb://, nfs://)
-                    # Note: xbmcvfs.exists handles most protocols supported by Kodi
-                    if not xbmcvfs.exists(path):
-                        logger.log(f"Share unavailable: {path} ({source['label']})", xbmc.LOGWARNING)
-                        return False
-            return True
+            sources = get_video_sources()
         except Exception as e:
             logger.log(f"Error checking shares: {e}", xbmc.LOGERROR)
-            # If we fail to check, assume unsafe to clean? Or safe?
-            # Safer to return False
-            return False
+            return None
+        labels = {source['file']: source['label'] for source in sources}
+        status = self.share_health.check(sorted(labels))
+        available = [path for path, up in status.items() if up]
+        unavailable = [path for path, up in status.items() if not up]
+        for path in unavailable:
+            logger.log(f"Share unavailable: {path} ({labels[path]})", xbmc.LOGWARNING)
+        return available, unavailable
 
     def check_preconditions(self):
         if self.acquire_lock():
             try:
-                if xbmc.Player().isPlaying():
-                    logger.log("Media is playing. Postponing task.")
-                    return False
+                # Playback no longer holds tasks back, they pause between chunks instead
                 self.wait_while_scanning()
-                if self.abortRequested(): return False
+                if self.abortRequested():
+                    self.release_lock()
+                    return False
                 return True
             except:
                 self.release_lock()
@@ -232,10 +2699,11 @@ class NFOSyncService(xbmc.Monitor):
 
     def run_import(self):
         if not self.check_preconditions():
-            # Postpone
-            self.next_run_import = time.time() + 60
+            self.scheduler.postpone('import')
             return
 
+        self.mark_import(True)
+        run = metrics.start('import')
         try:
             import_type_str = ADDON.getSetting('import_type')
             logger.log(f"Starting Import. Type: {import_type_str}")
@@ -246,13 +2714,17 @@ class NFOSyncService(xbmc.Monitor):
             # Import (Scan New Only) is index 0 (assuming based on order or string check)
             # labelenum values="Scan New Only|Full Refresh"
             if import_type_str == "Scan New Only":
-                xbmc.executebuiltin('UpdateLibrary(video)')
-                logger.log("Triggered UpdateLibrary (Scan)")
-                self.wait_for_scan()
+                self.scan_for_new_files()
             elif import_type_str == "Full Refresh":
-                self.refresh_library()
+                start_time = self.refresh_library()
 
-            set_last_run('last_run_import', start_time)
+            if self.abortRequested():
+                logger.log("Import interrupted, it will resume from its checkpoint on the next run")
+                return
+
+            self.record_run('import', 'last_run_import', start_time)
+            if self.watcher is not None:
+                self.watcher.track(self.watch_directories())
             logger.log("Import Completed")
             logger.notify("NFO Sync", "Import Completed", xbmcgui.NOTIFICATION_INFO)
 
@@ -264,73 +2736,483 @@ class NFOSyncService(xbmc.Monitor):
                 return
 
         finally:
+            metrics.finish(run, not self.abortRequested())
+            self.mark_import(False)
             self.release_lock()
             self.update_schedule()
 
-    def run_export(self):
+    def run_export(self, full=False):
         if not self.check_preconditions():
-            self.next_run_export = time.time() + 60
+            self.scheduler.postpone('export')
             return
 
+        run = metrics.start('export')
         try:
-            logger.log("Starting Export")
+            export_type = 'Full Export' if full else ADDON.getSetting('export_type')
+            logger.log(f"Starting Export. Type: {export_type}")
             logger.notify("NFO Sync", "Starting Export", xbmcgui.NOTIFICATION_INFO)
             start_time = time.time()
 
-            # ExportLibrary(video, true, true, true, true)
-            xbmc.executebuiltin('ExportLibrary(video,true,true,true,true)')
-            logger.log("Triggered ExportLibrary")
+            if export_type == 'Changed Items Only' and get_last_run('last_run_export') > 0:
+                with metrics.phase('export'):
+                    self.export_changed_items()
+            else:
+                # Anything tracked so far is covered by the full export
+                self.get_dirty_set().clear()
+
+                # ExportLibrary(video, true, true, true, true)
+                xbmc.executebuiltin('ExportLibrary(video,true,true,true,true)')
+                logger.log("Triggered ExportLibrary")
 
-            set_last_run('last_run_export', start_time)
+            if self.abortRequested():
+                return
+            self.record_run('export', 'last_run_export', start_time)
             logger.log("Export Triggered/Completed")
             logger.notify("NFO Sync", "Export Completed", xbmcgui.NOTIFICATION_INFO)
 
         finally:
+            metrics.finish(run, not self.abortRequested())
             self.release_lock()
             self.update_schedule()
 
+    def export_changed_items(self):
+        dirty_set = self.get_dirty_set()
+        items = dirty_set.items()
+        logger.log(f"Exporting {len(items)} items changed since the last export...")
+
+        writer = NFOWriter()
+        exported = 0
+        without_nfo = 0
+        # Just written, so the recorded mtime is ambiguous and the next import hashes it
+        verify_content = ADDON.getSettingBool('import_smart_sync') and ADDON.getSettingBool('import_verify_content')
+        progress = logger.progress('Export', len(items))
+        self.open_state_index()
+        try:
+            for media_type, item_id in items:
+                if not self.playback.wait_turn(): break
+                progress.update()
+                try:
+                    done, file_path, nfo_path = writer.export(media_type, item_id)
+                except Exception as e:
+                    logger.log(f"Error exporting {media_type} {item_id}: {e}", xbmc.LOGWARNING)
+                    continue
+                if done is None:
+                    # Stays dirty, the next full export writes its NFO
+                    without_nfo += 1
+                    continue
+                if not done:
+                    continue
+                if nfo_path and self.state_index is not None:
+                    # Our own write is not a change for Smart Sync to pick up
+                    self.state_index.record(media_type, item_id, file_path, nfo_path, *self.stat_nfo(nfo_path))
+                    if verify_content:
+                        self.state_index.record_content_hash(media_type, item_id, nfo_path, content_hash(nfo_path))
+                    self.state_index.commit()
+                dirty_set.remove(media_type, item_id)
+                exported += 1
+        finally:
+            self.close_state_index()
+
+        logger.log(f"=== Export Report: Changed {len(items)}, Exported {exported}, Without NFO {without_nfo}, Failed {len(items) - exported - without_nfo} ===")
+        metrics.count('exported', exported)
+
     def run_clean(self):
         if not self.check_preconditions():
-            if ADDON.getSetting('clean_schedule_type') == 'On Schedule':
-                self.next_run_clean = time.time() + 60
-            return
-
-        # Check sources if enabled
-        if ADDON.getSettingBool('clean_check_sources') and not self.are_shares_available():
-            logger.log("Clean-up aborted because one or more shares are unavailable.", xbmc.LOGWARNING)
-            logger.notify("NFO Sync", "Clean-up Aborted (Missing Shares)", xbmcgui.NOTIFICATION_WARNING)
-            # Retry later? Or just skip?
-            # If we skip, it will run again on next schedule.
-            # If scheduled type is After Import, it won't run until next import.
-            # If checking preconditions failed we deferred by 60s. Here maybe we just return.
+            self.scheduler.postpone('clean')
             return
 
+        run = metrics.start('clean')
+        skipped = False
         try:
+            # Check sources if enabled, only the sources that are up get cleaned
+            targets = None
+            if ADDON.getSettingBool('clean_check_sources'):
+                sources = self.available_sources()
+                if sources is None or not sources[0]:
+                    logger.log("Clean-up aborted because no shares are available.", xbmc.LOGWARNING)
+                    logger.notify("NFO Sync", "Clean-up Aborted (Missing Shares)", xbmcgui.NOTIFICATION_WARNING)
+                    skipped = True
+                    return
+                if sources[1]:
+                    targets = sources[0]
+
             logger.log("Starting Clean-up")
             logger.notify("NFO Sync", "Cleaning Library", xbmcgui.NOTIFICATION_INFO)
             start_time = time.time()
 
-            xbmc.executebuiltin('CleanLibrary(video)')
-            self.wait_for_scan()
-
-            set_last_run('last_run_clean', start_time)
+            if targets is None:
+                self.run_library_job('CleanLibrary(video)', 'clean')
+            else:
+                logger.log(f"Cleaning {len(targets)} available sources, skipping the unavailable ones")
+                for path in targets:
+                    if self.abortRequested():
+                        return
+                    logger.log(f"Cleaning source {path}")
+                    self.run_library_job(f'CleanLibrary(video,false,{path})', 'clean')
+
+            if self.abortRequested():
+                return
+            self.record_run('clean', 'last_run_clean', start_time)
             logger.log("Clean-up Completed")
             logger.notify("NFO Sync", "Clean-up Completed", xbmcgui.NOTIFICATION_INFO)
 
         finally:
+            metrics.finish(run, not (skipped or self.abortRequested()), skipped)
             self.release_lock()
             self.update_schedule()
 
+    def open_state_index(self):
+        try:
+            self.state_index = NFOStateIndex(get_profile_path('nfo_state.db'))
+        except Exception as e:
+            logger.log(f"Could not open NFO state index, falling back to last run timestamp: {e}", xbmc.LOGWARNING)
+            self.state_index = None
+
+    def close_state_index(self):
+        if self.state_index is not None:
+            # Anything not committed belongs to refreshes that were never sent
+            self.state_index.rollback()
+            self.state_index.close()
+            self.state_index = None
+
+    def open_watched_snapshot(self):
+        self.watched_snapshot = WatchedSnapshotStore(get_profile_path('watched_snapshot.db'))
+
+    def close_watched_snapshot(self):
+        if self.watched_snapshot is not None:
+            # Uncommitted rows belong to refreshes that were never sent
+            self.watched_snapshot.rollback()
+            self.watched_snapshot.close()
+            self.watched_snapshot = None
+
+    def send_refresh_batch(self, batch):
+        if not self.playback.wait_turn():
+            return []
+        # The watched status of everything in the batch must be on disk before
+        # Kodi gets a chance to reset it
+        if self.watched_snapshot is not None:
+            self.watched_snapshot.commit()
+        responses = json_rpc_batch(batch)
+        # Only persist the new NFO state once the refreshes have been queued
+        if self.state_index is not None:
+            self.state_index.commit()
+        if self.checkpoint is not None:
+            self.checkpoint.commit()
+        return responses
+
+    def refresh_failed(self, media_type, item_id):
+        # Make sure the next Smart Sync picks the item up again
+        if self.state_index is not None:
+            self.state_index.invalidate(media_type, item_id)
+            self.state_index.commit()
+
+    def refresh_done(self, media_type, item_id):
+        if self.checkpoint is not None:
+            self.checkpoint.done(media_type, item_id)
+
+    def create_dispatcher(self, label):
+        self.dispatcher = RefreshDispatcher(
+            self, self.send_refresh_batch, label,
+            get_setting_int('import_max_in_flight'),
+            on_failed=self.refresh_failed, on_done=self.refresh_done
+        )
+        return self.dispatcher
+
+    def queue_refresh(self, dispatcher, media_type, item_id, file_path, method):
+        if self.checkpoint is not None:
+            self.checkpoint.queued(media_type, item_id, file_path)
+        self.refreshed_items[(media_type, item_id)] = time.time()
+        dispatcher.add(media_type, item_id, method, {media_type + 'id': item_id, 'ignorenfo': False})
+
+    def open_checkpoint(self):
+        # Resumes an interrupted refresh run with the same settings.
+        # Returns the time the refresh started, which may be an earlier run.
+        settings_key = '|'.join(str(value) for value in (
+            ADDON.getSetting('import_type'),
+            ADDON.getSettingBool('import_smart_sync'),
+            ADDON.getSettingBool('import_preserve_watched'),
+        ))
+        try:
+            self.checkpoint = ImportCheckpoint(get_profile_path('import_checkpoint.db'))
+            started = self.checkpoint.begin(settings_key)
+        except Exception as e:
+            logger.log(f"Could not open import checkpoint, the refresh will not be resumable: {e}", xbmc.LOGWARNING)
+            self.close_checkpoint()
+            return time.time()
+        if started is None:
+            return self.checkpoint.started()
+
+        logger.log(f"Resuming the import started {self.fmt_time(started)}")
+        if self.state_index is not None:
+            # Sent before the interruption but never confirmed, make Smart Sync pick them up again
+            for media_type, item_id in self.checkpoint.unconfirmed():
+                self.state_index.invalidate(media_type, item_id)
+            self.state_index.commit()
+        return started
+
+    def close_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.commit()
+            self.checkpoint.close()
+            self.checkpoint = None
+
+    def pass_done(self, media_type, label):
+        if self.checkpoint is not None and self.checkpoint.type_done(media_type):
+            logger.log(f"{label} were already refreshed by the interrupted import, skipping")
+            return True
+        return False
+
+    def finish_pass(self, media_type):
+        if self.checkpoint is not None and not self.abortRequested():
+            self.checkpoint.finish_type(media_type)
+
+    def finish_listing(self, media_type, pages, seen_ids):
+        # Items after a failed page were never looked at, so their index rows are
+        # kept and the pass stays open for the next run
+        if not pages.complete:
+            logger.log(f"Only part of the {media_type}s could be listed, the pass will run again", xbmc.LOGWARNING)
+            return
+        self.finish_state_index(media_type, seen_ids)
+        self.finish_pass(media_type)
+
+    def resumed_items(self, media_type, smart_last_run):
+        # Smart Sync skips finished items through the state index already
+        if self.checkpoint is None or smart_last_run is not None:
+            return {}
+        return self.checkpoint.done_items(media_type)
+
+    def onNotification(self, sender, method, data):
+        if self.dispatcher is not None:
+            self.dispatcher.on_notification(method, data)
+        if method in ('VideoLibrary.OnUpdate', 'VideoLibrary.OnRemove'):
+            self.track_export_change(method, data)
+        elif sender == ADDON_ID and method in ('Other.ImportStarted', 'Other.ImportFinished'):
+            # A headless runner importing into this Kodi
+            started = str(time.time()) if method == 'Other.ImportStarted' else ''
+            xbmcgui.Window(10000).setProperty('service.library.nfosync.import_active', started)
+
+    def mark_import(self, active):
+        # The Home window is shared by the service and script.py; a headless
+        # runner drives Kodi from outside and announces its import instead
+        xbmcgui.Window(10000).setProperty('service.library.nfosync.import_active', str(time.time()) if active else '')
+        if active:
+            cutoff = time.time() - self.LATE_UPDATE_WINDOW
+            self.refreshed_items = {key: queued for key, queued in self.refreshed_items.items() if queued > cutoff}
+        if not isinstance(transport, KodiTransport):
+            json_rpc('JSONRPC.NotifyAll', {'sender': ADDON_ID, 'message': 'ImportStarted' if active else 'ImportFinished'})
+
+    def import_running(self):
+        started = xbmcgui.Window(10000).getProperty('service.library.nfosync.import_active')
+        try:
+            return time.time() - float(started) < self.IMPORT_FLAG_EXPIRY
+        except ValueError:
+            return False
+
+    def refreshed_recently(self, media_type, item_id):
+        queued = self.refreshed_items.get((media_type, item_id))
+        return queued is not None and time.time() - queued < self.LATE_UPDATE_WINDOW
+
+    def get_dirty_set(self):
+        if self.dirty_set is None:
+            self.dirty_set = ExportDirtySet(get_profile_path('export_state.db'))
+        return self.dirty_set
+
+    def track_export_change(self, method, data):
+        media_type, item_id, payload = notification_item(data)
+        if media_type not in LIBRARY_DETAILS or item_id is None:
+            return
+        try:
+            if method == 'VideoLibrary.OnRemove':
+                self.get_dirty_set().remove(media_type, item_id)
+            elif not (payload.get('added') or self.import_running() or self.refreshed_recently(media_type, item_id)):
+                # Items just scanned in from their NFOs, and changes made by an
+                # import in any process, are already on disk
+                self.get_dirty_set().add(media_type, item_id)
+        except Exception as e:
+            logger.log(f"Error tracking library change for export: {e}", xbmc.LOGWARNING)
+
+    def finish_state_index(self, media_type, seen_ids):
+        if self.state_index is not None and not self.abortRequested():
+            self.state_index.prune(media_type, seen_ids)
+            self.state_index.commit()
+
+    def open_probe_pool(self):
+        sources = []
+        try:
+            sources = get_video_sources()
+        except Exception as e:
+            logger.log(f"Error reading sources, probing with a single pool per host: {e}", xbmc.LOGWARNING)
+        self.probe_pool = NFOProbePool(sources, get_setting_int('import_probe_threads'))
+
+    def close_probe_pool(self):
+        if self.probe_pool is not None:
+            self.probe_pool.shutdown()
+            self.probe_pool = None
+
+    def scan_full_library(self):
+        logger.log("Triggered UpdateLibrary (Scan)")
+        self.run_library_job('UpdateLibrary(video)')
+
+    def stat_directories(self, pool, paths):
+        # Directory mtimes, stat'ed in parallel on the per-share pools
+        mtimes = {}
+        paths = list(paths)
+        for start in range(0, len(paths), self.PROBE_WINDOW):
+            window = paths[start:start + self.PROBE_WINDOW]
+            if not self.playback.wait_turn():
+                return None
+            futures = [pool.submit(path, self.stat_directory, path) for path in window]
+            for path, future in zip(window, futures):
+                while not pool.wait(future, 0.5):
+                    if self.abortRequested():
+                        for pending in futures:
+                            pending.cancel()
+                        return None
+                try:
+                    mtimes[path] = future.result()
+                except Exception as e:
+                    logger.log(f"Error checking directory {path}: {e}", xbmc.LOGWARNING)
+                    mtimes[path] = 0
+        return mtimes
+
+    def stat_directory(self, path):
+        started = time.perf_counter()
+        mtime = xbmcvfs.Stat(path + path_separator(path)).st_mtime()
+        metrics.vfs(path, time.perf_counter() - started)
+        return mtime
+
+    def library_directories(self, roots):
+        # Folders of every library item plus their parents up to the source root
+        directories = set(roots)
+        queries = [
+            ('VideoLibrary.GetMovies', 'movies'),
+            ('VideoLibrary.GetMusicVideos', 'musicvideos'),
+            ('VideoLibrary.GetTVShows', 'tvshows'),
+            ('VideoLibrary.GetEpisodes', 'episodes'),
+        ]
+        for method, result_key in queries:
+            for item in LibraryPages(method, result_key, {'properties': ['file']}):
+                if self.abortRequested():
+                    return directories
+                if not item.get('file'):
+                    continue
+                directory = item_directory(item['file'])
+                # Stacks, plugins and anything else outside the sources are not tracked
+                if not any(in_folder(directory, root) for root in roots):
+                    continue
+                while directory not in directories:
+                    directories.add(directory)
+                    directory = split_path(directory)[0]
+        return directories
+
+    def scan_for_new_files(self):
+        # Scans only the folders whose mtime changed since the last import, merged
+        # up to common parents. Falls back to a full scan when there is no recorded
+        # state yet, a source cannot report mtimes or too much has changed.
+        if not ADDON.getSettingBool('import_targeted_scan'):
+            self.scan_full_library()
+            return
+
+        try:
+            sources = get_video_sources()
+            state = DirectoryStateIndex(get_profile_path('scan_state.db'))
+        except Exception as e:
+            logger.log(f"Targeted scan unavailable, scanning full library: {e}", xbmc.LOGWARNING)
+            self.scan_full_library()
+            return
+
+        pool = NFOProbePool(sources, get_setting_int('import_probe_threads'))
+        try:
+            roots = {source['file'].rstrip('/\\') for source in sources}
+            recorded = state.all()
+            targets = None
+            mtimes = None
+
+            if not recorded:
+                logger.log("No recorded folder state yet, scanning full library.")
+            elif any(root.startswith('multipath://') for root in roots):
+                logger.log("Multi-path sources cannot be checked per folder, scanning full library.")
+            else:
+                mtimes = self.stat_directories(pool, sorted(set(recorded) | roots))
+                if mtimes is None:
+                    return
+                unsupported = [root for root in roots if mtimes.get(root, 0) == 0]
+                if unsupported:
+                    logger.log(f"Cannot read folder times for {', '.join(unsupported)}, scanning full library.")
+                else:
+                    changed = [path for path, mtime in mtimes.items() if mtime and path in recorded and mtime != recorded[path]]
+                    # New sources have no baseline, scan them as a whole
+                    changed += [root for root in roots if root not in recorded]
+                    targets = merge_scan_targets(changed, roots)
+                    if len(targets) > self.MAX_SCAN_TARGETS:
+                        logger.log(f"{len(targets)} folders changed, scanning full library instead.")
+                        targets = None
+
+            if targets is None:
+                self.scan_full_library()
+            elif not targets:
+                logger.log("No folders changed since the last import, skipping scan.")
+            else:
+                logger.log(f"Scanning {len(targets)} changed folders...")
+                for target in targets:
+                    if self.abortRequested():
+                        return
+                    logger.log(f"Triggered UpdateLibrary (Scan) for {target}")
+                    self.run_library_job(f'UpdateLibrary(video,{target}{path_separator(target)})')
+
+            if self.abortRequested():
+                return
+
+            # Record the new baseline. Folders checked above keep the time the scan
+            # was decided on, so a change made since is still seen next time; only
+            # folders of items a scan may have added are stat'ed now.
+            baseline = dict(mtimes or {})
+            if targets is None or targets:
+                directories = self.library_directories(roots)
+                added = self.stat_directories(pool, sorted((directories | set(recorded)) - set(baseline)))
+                if added is None:
+                    return
+                baseline.update(added)
+            for path, mtime in baseline.items():
+                if mtime:
+                    state.record(path, mtime)
+                else:
+                    state.forget(path)
+            state.commit()
+        finally:
+            pool.shutdown()
+            state.close()
+
     def refresh_library(self):
+        self.dir_cache = NFODirectoryCache()
+        if ADDON.getSettingBool('import_smart_sync'):
+            self.open_state_index()
+            self.open_probe_pool()
+            self.verify_content = ADDON.getSettingBool('import_verify_content')
+        if ADDON.getSettingBool('import_preserve_watched'):
+            self.open_watched_snapshot()
+        started = self.open_checkpoint()
+        try:
+            self.refresh_items()
+            if self.checkpoint is not None and not self.abortRequested():
+                self.checkpoint.clear()
+        finally:
+            self.close_checkpoint()
+            self.close_watched_snapshot()
+            self.close_probe_pool()
+            self.close_state_index()
+        return started
+
+    def refresh_items(self):
         logger.log("Starting Library Refresh (JSON-RPC) - Smart Mode")
 
-        BATCH_SIZE = 5000
         last_run = get_last_run('last_run_import')
 
         use_smart_sync = ADDON.getSettingBool('import_smart_sync')
         # Removed experimental rescan option
 
         logger.log(f"Smart Sync Enabled: {use_smart_sync}")
+        smart_last_run = last_run if use_smart_sync and last_run > 0 else None
 
         if use_smart_sync:
             logger.log(f"Checking for NFOs modified since timestamp: {last_run}")
@@ -338,231 +3220,525 @@ class NFOSyncService(xbmc.Monitor):
             logger.log("Smart Sync disabled. Forcing refresh of ALL items.")
 
         preserve_watched = ADDON.getSettingBool('import_preserve_watched')
-        preserved_movies = {}
-        preserved_episodes = {}
-        preserved_musicvideos = {}
+        snapshot = self.watched_snapshot
 
+        apply_nfo = smart_last_run is not None and self.state_index is not None and ADDON.getSettingBool('import_apply_nfo')
+
+        watched = None
         if preserve_watched:
             logger.log("Preserve Watched Status enabled. Capturing current status...")
+            watched = WatchedStateCapture()
 
         # Refresh Movies
-        movies = json_rpc('VideoLibrary.GetMovies', {'properties': ['file', 'playcount', 'resume', 'lastplayed']})
-        if 'result' in movies and 'movies' in movies['result']:
-            batch = []
-            total = len(movies['result']['movies'])
+        movies = LibraryPages('VideoLibrary.GetMovies', 'movies', {'properties': ['file'], 'sort': {'method': 'path'}})
+        if movies.total and not self.pass_done('movie', 'Movies'):
+            dispatcher = self.create_dispatcher('Movies')
+            total = movies.total
             skipped = 0
             count_processed = 0
+            applied = 0
+            seen_ids = []
+            done = self.resumed_items('movie', smart_last_run)
 
             logger.log(f"Analyzing {total} movies for changes...")
 
-            for i, movie in enumerate(movies['result']['movies']):
+            progress = logger.progress('Movies', total)
+            changes = self.detect_changes('movie', movies, 'movieid', smart_last_run)
+            for movie, changed in changes:
                 if self.abortRequested(): break
+                progress.update()
+                seen_ids.append(movie['movieid'])
+
+                # Refreshed before the last import was interrupted
+                if done.get(movie['movieid']) == movie['file']:
+                    skipped += 1
+                    continue
 
                 # Smart Sync Check
-                if use_smart_sync and last_run > 0:
-                    if not self.should_refresh(movie['file'], last_run):
-                        skipped += 1
-                        continue
+                if not changed:
+                    skipped += 1
+                    continue
+
+                if apply_nfo and self.apply_nfo_changes('movie', movie['movieid'], movie['file'], preserve_watched):
+                    applied += 1
+                    continue
 
                 # Preserve Status
                 if preserve_watched:
-                    if movie.get('playcount', 0) > 0 or movie.get('resume', {}).get('position', 0) > 0:
-                        preserved_movies[movie['movieid']] = {
-                            'playcount': movie.get('playcount', 0),
-                            'resume': movie.get('resume', {}),
-                            'lastplayed': movie.get('lastplayed', ''),
-                            'file': movie.get('file')
-                        }
+                    state = watched.state('movie', movie['movieid'])
+                    if state:
+                        snapshot.add('movie', movie['movieid'], state)
 
                 movie_id = movie['movieid']
                 count_processed += 1
 
-                logger.log(f"Queuing refresh for: {movie['label']}")
-                batch.append({
-                    'jsonrpc': '2.0',
-                    'method': 'VideoLibrary.RefreshMovie',
-                    'params': {'movieid': movie_id, 'ignorenfo': False},
-                    'id': i
-                })
+                logger.debug("Queuing refresh for: %s", movie['label'])
+                self.queue_refresh(dispatcher, 'movie', movie_id, movie['file'], 'VideoLibrary.RefreshMovie')
 
-                if len(batch) >= BATCH_SIZE:
-                    logger.log(f"Sending batch of {len(batch)} movies...")
-                    json_rpc_batch(batch)
-                    batch = []
+            dispatcher.finish()
 
-            if batch:
-                logger.log(f"Sending remaining batch of {len(batch)} movies...")
-                json_rpc_batch(batch)
-
-            logger.log(f"=== Movies Report: Total {total}, Processed {count_processed}, Skipped {skipped} ===")
+            self.finish_listing('movie', movies, seen_ids)
+            logger.log(f"=== Movies Report: Total {total}, Processed {count_processed}, Applied {applied}, Skipped {skipped} ===")
+            metrics.count('applied', applied)
+            metrics.count('skipped', skipped)
 
         # Refresh Music Videos
-        musicvideos = json_rpc('VideoLibrary.GetMusicVideos', {'properties': ['file', 'playcount', 'resume', 'lastplayed']})
-        if 'result' in musicvideos and 'musicvideos' in musicvideos['result']:
-            batch = []
-            total = len(musicvideos['result']['musicvideos'])
+        musicvideos = LibraryPages('VideoLibrary.GetMusicVideos', 'musicvideos', {'properties': ['file'], 'sort': {'method': 'path'}})
+        if musicvideos.total and not self.pass_done('musicvideo', 'Music Videos'):
+            dispatcher = self.create_dispatcher('Music Videos')
+            total = musicvideos.total
             skipped = 0
             count_processed = 0
+            applied = 0
+            seen_ids = []
+            done = self.resumed_items('musicvideo', smart_last_run)
 
             logger.log(f"Analyzing {total} Music Videos for changes...")
 
-            for i, mv in enumerate(musicvideos['result']['musicvideos']):
+            progress = logger.progress('Music Videos', total)
+            changes = self.detect_changes('musicvideo', musicvideos, 'musicvideoid', smart_last_run)
+            for mv, changed in changes:
                 if self.abortRequested(): break
+                progress.update()
+                seen_ids.append(mv['musicvideoid'])
+
+                # Refreshed before the last import was interrupted
+                if done.get(mv['musicvideoid']) == mv['file']:
+                    skipped += 1
+                    continue
 
                 # Smart Sync Check
-                if use_smart_sync and last_run > 0:
-                    if not self.should_refresh(mv['file'], last_run):
-                        skipped += 1
-                        continue
+                if not changed:
+                    skipped += 1
+                    continue
+
+                if apply_nfo and self.apply_nfo_changes('musicvideo', mv['musicvideoid'], mv['file'], preserve_watched):
+                    applied += 1
+                    continue
 
                 # Preserve Status
                 if preserve_watched:
-                    if mv.get('playcount', 0) > 0 or mv.get('resume', {}).get('position', 0) > 0:
-                        preserved_musicvideos[mv['musicvideoid']] = {
-                            'playcount': mv.get('playcount', 0),
-                            'resume': mv.get('resume', {}),
-                            'lastplayed': mv.get('lastplayed', ''),
-                            'file': mv.get('file')
-                        }
+                    state = watched.state('musicvideo', mv['musicvideoid'])
+                    if state:
+                        snapshot.add('musicvideo', mv['musicvideoid'], state)
 
                 mv_id = mv['musicvideoid']
                 count_processed += 1
 
-                logger.log(f"Queuing refresh for: {mv['label']}")
-                batch.append({
-                    'jsonrpc': '2.0',
-                    'method': 'VideoLibrary.RefreshMusicVideo',
-                    'params': {'musicvideoid': mv_id, 'ignorenfo': False},
-                    'id': i
-                })
+                logger.debug("Queuing refresh for: %s", mv['label'])
+                self.queue_refresh(dispatcher, 'musicvideo', mv_id, mv['file'], 'VideoLibrary.RefreshMusicVideo')
 
-                if len(batch) >= BATCH_SIZE:
-                    logger.log(f"Sending batch of {len(batch)} Music Videos...")
-                    json_rpc_batch(batch)
-                    batch = []
+            dispatcher.finish()
 
-            if batch:
-                logger.log(f"Sending remaining batch of {len(batch)} Music Videos...")
-                json_rpc_batch(batch)
-
-            logger.log(f"=== Music Videos Report: Total {total}, Processed {count_processed}, Skipped {skipped} ===")
+            self.finish_listing('musicvideo', musicvideos, seen_ids)
+            logger.log(f"=== Music Videos Report: Total {total}, Processed {count_processed}, Applied {applied}, Skipped {skipped} ===")
+            metrics.count('applied', applied)
+            metrics.count('skipped', skipped)
 
         # Refresh TV Shows
-        shows = json_rpc('VideoLibrary.GetTVShows', {'properties': ['file']})
-        if 'result' in shows and 'tvshows' in shows['result']:
-            batch = []
-            total = len(shows['result']['tvshows'])
+        refreshed_show_ids = set()
+        shows = LibraryPages('VideoLibrary.GetTVShows', 'tvshows', {'properties': ['file'], 'sort': {'method': 'path'}})
+        if shows.total and not self.pass_done('tvshow', 'TV Shows'):
+            dispatcher = self.create_dispatcher('TV Shows')
+            total = shows.total
             skipped = 0
             count_processed = 0
+            applied = 0
+            seen_ids = []
+            done = self.resumed_items('tvshow', smart_last_run)
 
             logger.log(f"Analyzing {total} TV Shows for changes...")
 
-            for i, show in enumerate(shows['result']['tvshows']):
+            progress = logger.progress('TV Shows', total)
+            changes = self.detect_changes('tvshow', shows, 'tvshowid', smart_last_run)
+            for show, changed in changes:
                 if self.abortRequested(): break
+                progress.update()
+                seen_ids.append(show['tvshowid'])
 
-                 # Smart Sync Check
-                if use_smart_sync and last_run > 0:
-                    if not self.should_refresh(show['file'], last_run):
-                        skipped += 1
-                        continue
+                # Refreshed before the last import was interrupted
+                if done.get(show['tvshowid']) == show['file']:
+                    skipped += 1
+                    continue
+
+                # Smart Sync Check
+                if not changed:
+                    skipped += 1
+                    continue
+
+                if apply_nfo and self.apply_nfo_changes('tvshow', show['tvshowid'], show['file'], preserve_watched):
+                    applied += 1
+                    continue
 
                 # Preserve Status (Episodes)
                 if preserve_watched:
-                    # Fetch episodes for this show
-                    episodes = json_rpc('VideoLibrary.GetEpisodes', {'tvshowid': show['tvshowid'], 'properties': ['playcount', 'resume', 'lastplayed', 'file']})
-                    if 'result' in episodes and 'episodes' in episodes['result']:
-                         for ep in episodes['result']['episodes']:
-                             if ep.get('playcount', 0) > 0 or ep.get('resume', {}).get('position', 0) > 0:
-                                 preserved_episodes[ep['episodeid']] = {
-                                     'playcount': ep.get('playcount', 0),
-                                     'resume': ep.get('resume', {}),
-                                     'lastplayed': ep.get('lastplayed', ''),
-                                     'file': ep.get('file')
-                                 }
+                    for ep_id, state in watched.episodes_of(show['tvshowid']).items():
+                        snapshot.add('episode', ep_id, state)
 
                 tvshow_id = show['tvshowid']
+                refreshed_show_ids.add(tvshow_id)
                 count_processed += 1
 
-                logger.log(f"Queuing refresh for: {show['label']}")
-                batch.append({
-                    'jsonrpc': '2.0',
-                    'method': 'VideoLibrary.RefreshTVShow',
-                    'params': {'tvshowid': tvshow_id, 'ignorenfo': False},
-                    'id': i
-                })
+                logger.debug("Queuing refresh for: %s", show['label'])
+                self.queue_refresh(dispatcher, 'tvshow', tvshow_id, show['file'], 'VideoLibrary.RefreshTVShow')
+
+            dispatcher.finish()
+
+            self.finish_listing('tvshow', shows, seen_ids)
+            logger.log(f"=== TV Shows Report: Total {total}, Processed {count_processed}, Applied {applied}, Skipped {skipped} ===")
+            metrics.count('applied', applied)
+            metrics.count('skipped', skipped)
+
+        # Refresh Episodes (Smart Sync only)
+        # Shows refreshed above already re-read all of their episodes, for every
+        # other show only episodes whose own NFO changed are refreshed. Episodes of
+        # refreshed shows are still checked so their NFO state is recorded.
+        if smart_last_run is not None and not self.abortRequested():
+            episodes = LibraryPages('VideoLibrary.GetEpisodes', 'episodes', {'properties': ['file', 'tvshowid'], 'sort': {'method': 'path'}})
+            if episodes.total and not self.pass_done('episode', 'Episodes'):
+                dispatcher = self.create_dispatcher('Episodes')
+                total = episodes.total
+                skipped = 0
+                count_processed = 0
+                applied = 0
+                seen_ids = []
+                done = self.resumed_items('episode', smart_last_run)
+
+                def candidates():
+                    for ep in episodes:
+                        seen_ids.append(ep['episodeid'])
+                        yield ep
+
+                logger.log(f"Analyzing {total} Episodes for changes...")
+
+                progress = logger.progress('Episodes', total)
+                changes = self.detect_changes('episode', candidates(), 'episodeid', smart_last_run)
+                for ep, changed in changes:
+                    if self.abortRequested(): break
+                    progress.update()
+
+                    # Refreshed before the last import was interrupted
+                    if done.get(ep['episodeid']) == ep['file']:
+                        skipped += 1
+                        continue
 
-                if len(batch) >= BATCH_SIZE:
-                    logger.log(f"Sending batch of {len(batch)} TV Shows...")
-                    json_rpc_batch(batch)
-                    batch = []
+                    # Smart Sync Check, or covered by the refresh of its show
+                    if not changed or ep.get('tvshowid') in refreshed_show_ids:
+                        skipped += 1
+                        continue
 
-            if batch:
-                logger.log(f"Sending remaining batch of {len(batch)} TV Shows...")
-                json_rpc_batch(batch)
+                    if apply_nfo and self.apply_nfo_changes('episode', ep['episodeid'], ep['file'], preserve_watched):
+                        applied += 1
+                        continue
 
-            logger.log(f"=== TV Shows Report: Total {total}, Processed {count_processed}, Skipped {skipped} ===")
+                    # Preserve Status
+                    if preserve_watched:
+                        state = watched.state('episode', ep['episodeid'])
+                        if state:
+                            snapshot.add('episode', ep['episodeid'], state)
+
+                    ep_id = ep['episodeid']
+                    count_processed += 1
+
+                    logger.debug("Queuing refresh for: %s", ep['label'])
+                    self.queue_refresh(dispatcher, 'episode', ep_id, ep['file'], 'VideoLibrary.RefreshEpisode')
+
+                dispatcher.finish()
+
+                self.finish_listing('episode', episodes, seen_ids)
+                logger.log(f"=== Episodes Report: Total {total}, Processed {count_processed}, Applied {applied}, Skipped {skipped} ===")
+                metrics.count('applied', applied)
+                metrics.count('skipped', skipped)
 
         # Allow basic scan for new items as well
         if not self.abortRequested():
             logger.log("Triggering final UpdateLibrary scan for new files...")
-            xbmc.executebuiltin('UpdateLibrary(video)')
-            self.wait_for_scan()
+            self.scan_for_new_files()
+
+        self.dispatcher = None
 
         # Restore Watched Status
         if preserve_watched:
-            logger.log("Restoring Watched Status...")
-            # Movies
-            if preserved_movies:
-                logger.log(f"Restoring status for {len(preserved_movies)} Movies...")
-                batch = []
-                for mid, data in preserved_movies.items():
-                    batch.append({
-                        'jsonrpc': '2.0',
-                        'method': 'VideoLibrary.SetMovieDetails',
-                        'params': {'movieid': mid, 'playcount': data['playcount'], 'resume': data['resume'], 'lastplayed': data['lastplayed']},
-                        'id': mid
-                    })
-                    if len(batch) >= 100:
-                         json_rpc_batch(batch)
-                         batch = []
-                if batch: json_rpc_batch(batch)
-
-            # Music Videos
-            if preserved_musicvideos:
-                logger.log(f"Restoring status for {len(preserved_musicvideos)} Music Videos...")
-                batch = []
-                for mvid, data in preserved_musicvideos.items():
-                    batch.append({
-                        'jsonrpc': '2.0',
-                        'method': 'VideoLibrary.SetMusicVideoDetails',
-                        'params': {'musicvideoid': mvid, 'playcount': data['playcount'], 'resume': data['resume'], 'lastplayed': data['lastplayed']},
-                        'id': mvid
-                    })
-                    if len(batch) >= 100:
-                         json_rpc_batch(batch)
-                         batch = []
-                if batch: json_rpc_batch(batch)
-
-            # Episodes
-            if preserved_episodes:
-                logger.log(f"Restoring status for {len(preserved_episodes)} Episodes...")
-                batch = []
-                for epid, data in preserved_episodes.items():
-                    batch.append({
-                        'jsonrpc': '2.0',
-                        'method': 'VideoLibrary.SetEpisodeDetails',
-                        'params': {'episodeid': epid, 'playcount': data['playcount'], 'resume': data['resume'], 'lastplayed': data['lastplayed']},
-                        'id': epid
-                    })
-                    if len(batch) >= 100:
-                         json_rpc_batch(batch)
-                         batch = []
-                if batch: json_rpc_batch(batch)
-
-            logger.log("Watched Status Restoration Completed.")
+            snapshot.commit()
+            with metrics.phase('restore'):
+                self.restore_watched_status(snapshot)
+
+    def restore_watched_status(self, snapshot):
+        logger.log("Restoring Watched Status...")
+        restores = [
+            ('Movies', 'movie', 'VideoLibrary.GetMovies', 'movies', 'movieid', 'VideoLibrary.SetMovieDetails'),
+            ('Music Videos', 'musicvideo', 'VideoLibrary.GetMusicVideos', 'musicvideos', 'musicvideoid', 'VideoLibrary.SetMusicVideoDetails'),
+            ('Episodes', 'episode', 'VideoLibrary.GetEpisodes', 'episodes', 'episodeid', 'VideoLibrary.SetEpisodeDetails'),
+        ]
+        for label, media_type, get_method, result_key, id_key, set_method in restores:
+            pending = snapshot.count(media_type)
+            if not pending:
+                continue
+
+            logger.log(f"Checking status for {pending} {label}...")
+            # Rows are removed as they are handled and committed once their writes are sent
+            sender = AdaptiveBatchSender(on_sent=snapshot.commit)
+            unchanged = 0
+            properties = ['playcount', 'resume', 'lastplayed', 'file']
+
+            # Re-read the current status and only write what the refresh changed. A
+            # few items are read by id; whatever is not found under its old id, and
+            # larger restores, are matched by walking the library.
+            if pending * self.RESTORE_BY_ID_RATIO <= library_total(get_method):
+                rows = snapshot.items(media_type)
+                for start in range(0, len(rows), self.RESTORE_BY_ID_BATCH):
+                    if self.abortRequested(): break
+                    chunk = rows[start:start + self.RESTORE_BY_ID_BATCH]
+                    details = self.item_details(media_type, [item_id for item_id, _ in chunk], properties)
+                    for item_id, file_path in chunk:
+                        current = details.get(item_id)
+                        if current is None or (file_path and current.get('file') != file_path):
+                            continue
+                        current[id_key] = item_id
+                        if self.restore_item(snapshot, sender, media_type, id_key, set_method, current) is False:
+                            unchanged += 1
+
+            if snapshot.count(media_type) and not self.abortRequested():
+                for current in LibraryPages(get_method, result_key, {'properties': properties}):
+                    if self.abortRequested(): break
+                    if self.restore_item(snapshot, sender, media_type, id_key, set_method, current) is False:
+                        unchanged += 1
+
+            if self.abortRequested():
+                # Keep whatever was not sent for the next start
+                snapshot.rollback()
+                return
+
+            sender.flush()
+            metrics.count('restored', sender.sent)
+            missing = snapshot.count(media_type)
+            snapshot.clear(media_type)
+            snapshot.commit()
+            logger.log(f"=== {label} Watched Status: Restored {sender.sent}, Unchanged {unchanged}, Not Found {missing} ===")
+
+        logger.log("Watched Status Restoration Completed.")
+
+    def restore_item(self, snapshot, sender, media_type, id_key, set_method, current):
+        # Queues the restore of the snapshot row matching the current item. Returns
+        # True if a write was queued, False if unchanged and None without a row.
+        current_id = current[id_key]
+        item_id, data = snapshot.lookup(media_type, current_id, current.get('file'))
+        if item_id is None:
+            return None
+        snapshot.done(media_type, item_id)
+        if watched_status_equal(current, data):
+            return False
+
+        sender.add({
+            'jsonrpc': '2.0',
+            'method': set_method,
+            'params': {id_key: current_id, 'playcount': data['playcount'], 'resume': data['resume'], 'lastplayed': data['lastplayed']},
+            'id': current_id
+        })
+        return True
+
+    def replay_pending_restore(self):
+        # A crash or shutdown during a refresh leaves the snapshot on disk
+        try:
+            self.open_watched_snapshot()
+            if not self.watched_snapshot.count():
+                return
+            if not self.check_preconditions():
+                logger.log("Unfinished watched status restore found, will be completed by the next import.")
+                return
+            run = metrics.start('restore')
+            try:
+                logger.log(f"Replaying unfinished watched status restore for {self.watched_snapshot.count()} items...")
+                with metrics.phase('restore'):
+                    self.restore_watched_status(self.watched_snapshot)
+            finally:
+                metrics.finish(run, not self.abortRequested())
+                self.release_lock()
+        except Exception as e:
+            logger.log(f"Error replaying watched status restore: {e}", xbmc.LOGERROR)
+        finally:
+            self.close_watched_snapshot()
+
+    def update_watcher(self):
+        # Starts, restarts or stops the NFO watcher to match the settings
+        enabled = ADDON.getSettingBool('watch_enabled')
+        interval = max(1, get_setting_int('watch_sweep_interval')) * 60
+        if self.watcher is not None and (not enabled or self.watcher.sweep_interval != interval):
+            self.watcher.stop()
+            self.watcher = None
+        if not enabled or self.watcher is not None:
+            return
+        try:
+            sources = get_video_sources()
+        except Exception as e:
+            logger.log(f"Cannot watch for NFO changes, sources unavailable: {e}", xbmc.LOGWARNING)
+            return
+        self.watcher = NFOWatcher(sources, interval, get_setting_int('import_probe_threads'), self.wakeup)
+        self.watcher.start(self.watch_directories())
+
+    def watch_directories(self):
+        # Folders holding the NFOs Smart Sync knows about
+        try:
+            index = NFOStateIndex(get_profile_path('nfo_state.db'))
+        except Exception as e:
+            logger.log(f"Could not read NFO state index for the watcher: {e}", xbmc.LOGWARNING)
+            return set()
+        try:
+            return index.nfo_directories()
+        finally:
+            index.close()
+
+    def run_watched_changes(self):
+        if self.watcher is None or not self.watcher.due():
+            return
+        batch = self.watcher.take()
+        nfos, folders, overflow = batch
+        if not self.check_preconditions():
+            self.watcher.put_back(batch)
+            return
+        if overflow:
+            # Changes were lost, only a regular import can catch up
+            self.release_lock()
+            self.run_import()
+            return
+
+        self.mark_import(True)
+        run = metrics.start('watch')
+        try:
+            logger.log(f"NFO watcher: {len(nfos)} NFOs and {len(folders)} folders changed, importing them")
+            self.refresh_watched(nfos, folders)
+            if not self.abortRequested():
+                logger.log("NFO watcher: Import Completed")
+        finally:
+            metrics.finish(run, not self.abortRequested())
+            self.mark_import(False)
+            self.release_lock()
+
+    def watch_targets(self, nfos, folders):
+        # Library items to check per media type, and folders to scan for new items
+        targets = {media_type: {} for media_type in LIBRARY_LISTS}
+        scan = set(folders)
+        unknown = set(nfos)
+        if self.state_index is not None:
+            for media_type, item_id, file_path, nfo_path in self.state_index.items_for_nfos(nfos) + self.state_index.items_in_directories(folders):
+                targets[media_type][item_id] = file_path
+                unknown.discard(nfo_path)
+
+        # NFOs not recorded for any item belong to new items or items that had no NFO yet
+        directories = sorted({split_path(path)[0] for path in unknown})
+        found = set()
+        for start in range(0, len(directories), 50):
+            rules = [{'field': 'path', 'operator': 'is', 'value': directory + path_separator(directory)} for directory in directories[start:start + 50]]
+            for media_type, (method, result_key, _) in LIBRARY_LISTS.items():
+                id_key = LIBRARY_DETAILS[media_type][2]
+                for item in LibraryPages(method, result_key, {'properties': ['file'], 'filter': {'or': rules}}):
+                    if item.get('file'):
+                        targets[media_type][item[id_key]] = item['file']
+                        found.add(item_directory(item['file']))
+        scan.update(directory for directory in directories if directory not in found)
+        return targets, scan
+
+    def item_details(self, media_type, item_ids, properties):
+        get_method, _, id_key, result_key, _ = LIBRARY_DETAILS[media_type]
+        batch = [{'jsonrpc': '2.0', 'method': get_method, 'params': {id_key: item_id, 'properties': properties}, 'id': item_id} for item_id in item_ids]
+        details = {}
+        for response in json_rpc_batch(batch) or []:
+            result = response.get('result', {}).get(result_key) if isinstance(response, dict) else None
+            if result is not None:
+                details[response['id']] = result
+        return details
+
+    def snapshot_watched(self, media_type, item_ids):
+        # Watched status of the items about to be refreshed, episodes for shows
+        properties = ['playcount', 'resume', 'lastplayed', 'file']
+        if media_type == 'tvshow':
+            # One filtered query for all watched episodes, joined to the shows here
+            show_ids = set(item_ids)
+            params = {'properties': properties + ['tvshowid'], 'filter': WatchedStateCapture.WATCHED_FILTER}
+            episodes = LibraryPages('VideoLibrary.GetEpisodes', 'episodes', params)
+            for episode in episodes:
+                if episode.get('tvshowid') in show_ids:
+                    self.watched_snapshot.add('episode', episode['episodeid'], episode)
+            if not episodes.complete:
+                # Look up the shows one by one rather than lose their status
+                for show_id in show_ids:
+                    for episode in LibraryPages('VideoLibrary.GetEpisodes', 'episodes', dict(params, tvshowid=show_id)):
+                        self.watched_snapshot.add('episode', episode['episodeid'], episode)
+            return
+        for item_id, state in self.item_details(media_type, item_ids, properties).items():
+            if state.get('playcount', 0) > 0 or state.get('resume', {}).get('position', 0) > 0:
+                self.watched_snapshot.add(media_type, item_id, state)
+
+    def refresh_watched(self, nfos, folders):
+        # Full Refresh restricted to the items whose NFOs changed, followed by a
+        # scan of the folders that may hold new items
+        self.dir_cache = NFODirectoryCache()
+        self.open_state_index()
+        self.open_probe_pool()
+        self.verify_content = ADDON.getSettingBool('import_verify_content')
+        preserve_watched = ADDON.getSettingBool('import_preserve_watched')
+        if preserve_watched:
+            self.open_watched_snapshot()
+        try:
+            targets, scan = self.watch_targets(nfos, folders)
+            # Without recorded NFO state every target counts as changed
+            last_run = get_last_run('last_run_import') if self.state_index is not None else None
+            apply_nfo = self.state_index is not None and ADDON.getSettingBool('import_apply_nfo')
+            refreshed_shows = set()
+
+            for media_type, label in (('movie', 'Movies'), ('musicvideo', 'Music Videos'), ('tvshow', 'TV Shows'), ('episode', 'Episodes')):
+                if not targets[media_type] or self.abortRequested():
+                    continue
+                id_key = LIBRARY_DETAILS[media_type][2]
+                items = [{id_key: item_id, 'file': file_path} for item_id, file_path in sorted(targets[media_type].items(), key=lambda target: target[1])]
+                changed = [item for item, is_changed in self.detect_changes(media_type, items, id_key, last_run) if is_changed]
+                if changed and media_type == 'episode' and refreshed_shows:
+                    # Their shows were refreshed as a whole already
+                    shows = self.item_details('episode', [item[id_key] for item in changed], ['tvshowid'])
+                    changed = [item for item in changed if shows.get(item[id_key], {}).get('tvshowid') not in refreshed_shows]
+                if apply_nfo:
+                    changed = [item for item in changed if not self.apply_nfo_changes(media_type, item[id_key], item['file'], preserve_watched)]
+                if changed and preserve_watched:
+                    self.snapshot_watched(media_type, [item[id_key] for item in changed])
+
+                dispatcher = self.create_dispatcher(label)
+                for item in changed:
+                    if self.abortRequested(): break
+                    logger.debug("Queuing refresh for: %s", item['file'])
+                    self.queue_refresh(dispatcher, media_type, item[id_key], item['file'], LIBRARY_LISTS[media_type][2])
+                    if media_type == 'tvshow':
+                        refreshed_shows.add(item[id_key])
+                dispatcher.finish()
+                if self.state_index is not None and not self.abortRequested():
+                    self.state_index.commit()
+                logger.log(f"=== {label}: Checked {len(targets[media_type])}, Refreshed {len(changed)} ===")
+
+            targets = merge_scan_targets(scan, self.watcher.roots)
+            if len(targets) > self.MAX_SCAN_TARGETS:
+                self.scan_full_library()
+            else:
+                for target in targets:
+                    if self.abortRequested(): break
+                    logger.log(f"Triggered UpdateLibrary (Scan) for {target}")
+                    self.run_library_job(f'UpdateLibrary(video,{target}{path_separator(target)})')
+
+            if preserve_watched and not self.abortRequested():
+                self.watched_snapshot.commit()
+                with metrics.phase('restore'):
+                    self.restore_watched_status(self.watched_snapshot)
+        finally:
+            self.dispatcher = None
+            self.close_watched_snapshot()
+            self.close_probe_pool()
+            self.close_state_index()
+
     def run(self):
         logger.log("Service Started")
 
+        SettingsWatch.start(self.wakeup)
+        self.replay_pending_restore()
+        self.update_watcher()
+
         # Check and run Sync on Startup (IMPORT ONLY)
         if ADDON.getSettingBool('import_enabled') and ADDON.getSettingBool('import_on_startup'):
             logger.log("Import on Startup Enabled. Waiting 30s for system to settle...")
@@ -571,26 +3747,14 @@ class NFOSyncService(xbmc.Monitor):
                 self.run_import()
 
         while not self.abortRequested():
-            now = time.time()
-
-            # Check Import
-            if self.next_run_import > 0 and now >= self.next_run_import:
-                self.run_import()
-                now = time.time()
-
-            # Check Export
-            if self.next_run_export > 0 and now >= self.next_run_export:
-                self.run_export()
-                now = time.time()
-
-            # Check Clean
-            if self.next_run_clean > 0 and now >= self.next_run_clean:
-                self.run_clean()
-
-            # Check every 10 seconds
-            if self.waitForAbort(10):
+            self.scheduler.run_due()
+            self.run_watched_changes()
+            if self.wait_for_next_task():
                 break
 
+        if self.watcher is not None:
+            self.watcher.stop()
+
 if __name__ == '__main__':
     service = NFOSyncService()
     service.run()
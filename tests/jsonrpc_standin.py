@@ -0,0 +1,182 @@
+"""Local stand-ins for Kodi's JSON-RPC interfaces, for testing remote.py.
+
+StandInTCPServer speaks the raw TCP protocol of port 9090: JSON objects and
+batch arrays written back to back with no framing, plus notifications pushed
+at any time. StandInHTTPServer is the keep-alive HTTP endpoint of port 8080.
+Both answer from a table of method name -> callable(params) and keep what they
+received, so tests can check how the transports put requests on the wire.
+"""
+import http.server
+import json
+import socket
+import threading
+import time
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+def fail(params):
+    raise RPCError(-32602, params.get('message', 'Invalid params'))
+
+def default_methods():
+    return {
+        'JSONRPC.Ping': lambda params: 'pong',
+        'Test.Echo': lambda params: params,
+        'Test.Fail': fail,
+        'Test.Sleep': lambda params: time.sleep(params.get('seconds', 0)) or 'slept',
+    }
+
+def answer(methods, request):
+    # Response to one request, None for a notification sent by the client
+    if not isinstance(request, dict) or 'method' not in request:
+        return {'jsonrpc': '2.0', 'error': {'code': -32600, 'message': 'Invalid request'}, 'id': None}
+    handler = methods.get(request['method'])
+    try:
+        if handler is None:
+            raise RPCError(-32601, 'Method not found')
+        response = {'jsonrpc': '2.0', 'result': handler(request.get('params', {}))}
+    except RPCError as e:
+        response = {'jsonrpc': '2.0', 'error': {'code': e.code, 'message': e.message}}
+    if 'id' not in request:
+        return None
+    response['id'] = request['id']
+    return response
+
+def respond(methods, message):
+    if isinstance(message, list):
+        responses = [response for response in (answer(methods, entry) for entry in message) if response is not None]
+        return responses or None
+    return answer(methods, message)
+
+class StandInTCPServer:
+    """Kodi's TCP JSON-RPC interface on a free local port.
+
+    Every `reorder` messages received on a connection are answered in reverse
+    order. With `chunk_size` set, responses are written a few bytes at a time
+    so they arrive split across reads.
+    """
+    def __init__(self, methods=None, reorder=1, chunk_size=None):
+        self.methods = methods or default_methods()
+        self.reorder = reorder
+        self.chunk_size = chunk_size
+        self.received = []
+        self.clients = []
+        self.lock = threading.Lock()
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.clients.append(conn)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        decoder = json.JSONDecoder()
+        buffer = ''
+        held = []
+        while True:
+            try:
+                data = conn.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data.decode('utf-8')
+            while True:
+                buffer = buffer.lstrip()
+                if not buffer:
+                    break
+                try:
+                    message, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    break
+                buffer = buffer[end:]
+                with self.lock:
+                    self.received.append(message)
+                held.append(message)
+                if len(held) >= self.reorder:
+                    for message in reversed(held):
+                        response = respond(self.methods, message)
+                        if response is not None:
+                            self.write(conn, response)
+                    held = []
+
+    def write(self, conn, message):
+        data = json.dumps(message).encode('utf-8')
+        step = self.chunk_size or len(data)
+        with self.lock:
+            try:
+                for start in range(0, len(data), step):
+                    conn.sendall(data[start:start + step])
+                    if self.chunk_size:
+                        time.sleep(0.001)
+            except OSError:
+                pass
+
+    def notify(self, method, data, sender='xbmc'):
+        message = {'jsonrpc': '2.0', 'method': method, 'params': {'sender': sender, 'data': data}}
+        for conn in list(self.clients):
+            self.write(conn, message)
+
+    def disconnect(self):
+        # Drops every client connection, as a Kodi shutting down would
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+        self.disconnect()
+
+class StandInHTTPServer:
+    """Kodi's HTTP JSON-RPC endpoint on a free local port.
+
+    `posts` holds (client port, request) for every POST, so tests can see how
+    batches were split and over how many connections they were sent.
+    """
+    def __init__(self, methods=None):
+        self.methods = methods or default_methods()
+        self.posts = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server.lock:
+                    server.posts.append((self.client_address[1], request))
+                response = respond(server.methods, request)
+                data = json.dumps(response).encode('utf-8') if response is not None else b''
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
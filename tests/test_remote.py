@@ -0,0 +1,153 @@
+"""Tests for the JSON-RPC transports of remote.py against local stand-in servers.
+
+    python3 -m unittest discover -s tests
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remote
+from jsonrpc_standin import StandInHTTPServer, StandInTCPServer
+
+def request(method, request_id, **params):
+    return {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id}
+
+class TCPTransportTest(unittest.TestCase):
+    def connect(self, server, **kwargs):
+        transport = remote.TCPTransport('127.0.0.1', server.port, **kwargs)
+        self.addCleanup(transport.close)
+        self.addCleanup(server.close)
+        return transport
+
+    def test_out_of_order_responses_are_matched_by_id(self):
+        server = StandInTCPServer(reorder=3)
+        transport = self.connect(server)
+        responses = transport.send([request('Test.Echo', 'a', n=1), request('Test.Echo', 'b', n=2), request('Test.Echo', 'c', n=3)])
+        self.assertEqual([r['id'] for r in responses], ['a', 'b', 'c'])
+        self.assertEqual([r['result']['n'] for r in responses], [1, 2, 3])
+
+    def test_requests_are_pipelined_with_own_ids(self):
+        server = StandInTCPServer(reorder=3)
+        transport = self.connect(server)
+        transport.send([request('JSONRPC.Ping', 7), request('JSONRPC.Ping', 7), request('JSONRPC.Ping', 7)])
+        # Sent one after the other without waiting, so the server held all three
+        sent_ids = [message['id'] for message in server.received]
+        self.assertEqual(len(set(sent_ids)), 3)
+
+    def test_concurrent_callers_with_the_same_id(self):
+        server = StandInTCPServer(reorder=2)
+        transport = self.connect(server)
+        results = {}
+
+        def call(name):
+            results[name] = transport.send(request('Test.Echo', 1, caller=name))
+
+        threads = [threading.Thread(target=call, args=(name,)) for name in ('first', 'second')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        for name in ('first', 'second'):
+            self.assertEqual(results[name]['id'], 1)
+            self.assertEqual(results[name]['result']['caller'], name)
+
+    def test_per_entry_errors(self):
+        server = StandInTCPServer()
+        transport = self.connect(server)
+        responses = transport.send([
+            request('JSONRPC.Ping', 1),
+            request('Test.Fail', 2, message='bad id'),
+            request('No.Such', 3),
+            request('JSONRPC.Ping', 4),
+        ])
+        self.assertEqual([r['id'] for r in responses], [1, 2, 3, 4])
+        self.assertEqual(responses[0]['result'], 'pong')
+        self.assertEqual(responses[1]['error'], {'code': -32602, 'message': 'bad id'})
+        self.assertEqual(responses[2]['error']['code'], -32601)
+        self.assertEqual(responses[3]['result'], 'pong')
+
+    def test_notifications_are_routed_to_the_callback(self):
+        received = []
+        arrived = threading.Event()
+
+        def on_notification(sender, method, data):
+            received.append((sender, method, data))
+            arrived.set()
+
+        server = StandInTCPServer(chunk_size=7)
+        transport = self.connect(server, on_notification=on_notification)
+        # The connection is set up once a request went through
+        self.assertEqual(transport.send(request('JSONRPC.Ping', 1))['result'], 'pong')
+        server.notify('VideoLibrary.OnUpdate', {'item': {'id': 5, 'type': 'movie'}, 'title': 'Amélie'})
+        self.assertTrue(arrived.wait(5))
+        self.assertEqual(received, [('xbmc', 'VideoLibrary.OnUpdate', {'item': {'id': 5, 'type': 'movie'}, 'title': 'Amélie'})])
+        # and a notification is never taken for a response
+        self.assertEqual(transport.send(request('Test.Echo', 1, n=2))['result'], {'n': 2})
+
+    def test_responses_split_across_reads(self):
+        server = StandInTCPServer(chunk_size=3)
+        transport = self.connect(server)
+        responses = transport.send([request('Test.Echo', i, text='€' * 20) for i in range(5)])
+        self.assertEqual([r['id'] for r in responses], list(range(5)))
+        self.assertTrue(all(r['result']['text'] == '€' * 20 for r in responses))
+
+    def test_timeout_is_a_per_entry_error(self):
+        server = StandInTCPServer()
+        transport = self.connect(server, timeout=0.2)
+        response = transport.send(request('Test.Sleep', 9, seconds=1))
+        self.assertEqual(response['id'], 9)
+        self.assertEqual(response['error'], {'code': -32000, 'message': 'timed out'})
+
+    def test_closed_connection(self):
+        server = StandInTCPServer()
+        transport = self.connect(server)
+        self.assertEqual(transport.send(request('JSONRPC.Ping', 1))['result'], 'pong')
+        server.disconnect()
+        transport.reader.join(5)
+        response = transport.send(request('JSONRPC.Ping', 2))
+        self.assertEqual(response['error'], {'code': -32000, 'message': 'connection closed'})
+
+class HTTPTransportTest(unittest.TestCase):
+    def connect(self, server, **kwargs):
+        transport = remote.HTTPTransport('127.0.0.1', server.port, **kwargs)
+        self.addCleanup(transport.close)
+        self.addCleanup(server.close)
+        return transport
+
+    def test_large_batches_are_split_over_pooled_connections(self):
+        server = StandInHTTPServer()
+        transport = self.connect(server, pool_size=4)
+        batch = [request('Test.Sleep', i, seconds=0.05) if i % 50 == 0 else request('Test.Echo', i, n=i) for i in range(200)]
+        responses = transport.send(batch)
+        self.assertEqual([r['id'] for r in responses], list(range(200)))
+        self.assertEqual(len(server.posts), 4)
+        self.assertTrue(all(len(posted) == 50 for _, posted in server.posts))
+        self.assertEqual(len({port for port, _ in server.posts}), 4)
+
+    def test_small_batches_use_one_request(self):
+        server = StandInHTTPServer()
+        transport = self.connect(server, pool_size=4)
+        responses = transport.send([request('JSONRPC.Ping', i) for i in range(transport.SPLIT_SIZE)])
+        self.assertEqual(len(responses), transport.SPLIT_SIZE)
+        self.assertEqual(len(server.posts), 1)
+
+    def test_connections_are_reused(self):
+        server = StandInHTTPServer()
+        transport = self.connect(server, pool_size=4)
+        for i in range(3):
+            self.assertEqual(transport.send(request('JSONRPC.Ping', i))['result'], 'pong')
+        self.assertEqual(len({port for port, _ in server.posts}), 1)
+
+    def test_per_entry_errors_in_split_batches(self):
+        server = StandInHTTPServer()
+        transport = self.connect(server, pool_size=2)
+        batch = [request('Test.Fail', i) if i % 40 == 0 else request('JSONRPC.Ping', i) for i in range(120)]
+        responses = transport.send(batch)
+        self.assertEqual([r['id'] for r in responses], list(range(120)))
+        self.assertEqual([r['id'] for r in responses if 'error' in r], [0, 40, 80])
+
+if __name__ == '__main__':
+    unittest.main()
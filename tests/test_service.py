@@ -0,0 +1,362 @@
+"""Tests for service.py helpers, run on the stand-in xbmc modules of remote.py.
+
+    python3 -m unittest discover -s tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remote
+
+STATE_DIR = tempfile.mkdtemp() + os.sep
+remote.RUNTIME = remote.HeadlessRuntime(None, remote.PathMap([]), STATE_DIR, os.path.join(STATE_DIR, 'settings.json'))
+remote.RUNTIME.settings['log_verbosity'] = 'Quiet'
+sys.modules.update(remote.kodi_modules(remote.RUNTIME))
+
+import service
+
+class MergeScanTargetsTest(unittest.TestCase):
+    def test_siblings_inside_a_source_are_merged(self):
+        root = 'smb://nas/media/Movies'
+        changed = [f'{root}/Movie {i}' for i in range(4)]
+        self.assertEqual(service.merge_scan_targets(changed, [root]), [root])
+
+    def test_few_siblings_are_kept(self):
+        root = 'smb://nas/media/Movies'
+        changed = [f'{root}/Movie {i}' for i in range(3)]
+        self.assertEqual(service.merge_scan_targets(changed, [root]), changed)
+
+    def test_sibling_sources_are_not_merged_into_their_parent(self):
+        roots = [f'smb://nas/media/{name}' for name in ('Movies', 'TV', 'Music Videos', 'Concerts')]
+        self.assertEqual(service.merge_scan_targets(roots, roots), sorted(roots))
+
+    def test_roots_on_different_hosts_stay_apart(self):
+        roots = ['smb://nas/media', 'smb://nas2/media', 'nfs://filer/video', 'smb://nas3/video']
+        self.assertEqual(service.merge_scan_targets(roots, roots), sorted(roots))
+
+    def test_merging_stops_at_the_source_root(self):
+        root = 'smb://nas/media/TV'
+        changed = [f'{root}/Show {show}/Season {season}' for show in range(4) for season in range(4)]
+        self.assertEqual(service.merge_scan_targets(changed, [root]), [root])
+
+    def test_folders_under_a_changed_folder_are_dropped(self):
+        root = '/srv/media/Movies'
+        changed = [root, f'{root}/Movie 1', f'{root}/Movie 2/extras']
+        self.assertEqual(service.merge_scan_targets(changed, [root]), [root])
+
+    def test_folders_outside_the_sources_are_never_merged(self):
+        changed = [f'smb://other/share/Folder {i}' for i in range(4)]
+        self.assertEqual(service.merge_scan_targets(changed, ['smb://nas/media']), changed)
+
+class InFolderTest(unittest.TestCase):
+    def test_folder_and_everything_below_it(self):
+        self.assertTrue(service.in_folder('smb://nas/movies', 'smb://nas/movies'))
+        self.assertTrue(service.in_folder('smb://nas/movies/Arrival/Arrival.mkv', 'smb://nas/movies'))
+        self.assertTrue(service.in_folder('C:\\Movies\\Heat.mkv', 'C:\\Movies'))
+
+    def test_siblings_sharing_the_prefix(self):
+        self.assertFalse(service.in_folder('smb://nas/movies2/Arrival/Arrival.mkv', 'smb://nas/movies'))
+        self.assertFalse(service.in_folder('C:\\Movies 4K\\Heat.mkv', 'C:\\Movies'))
+
+class SyncMetricsTest(unittest.TestCase):
+    def test_file_access_is_keyed_by_the_source_it_is_in(self):
+        metrics = service.SyncMetrics()
+        metrics.use_sources([{'file': 'smb://nas/movies/'}, {'file': 'smb://nas/movies/4k/'}])
+        run = metrics.start('import')
+        metrics.vfs('smb://nas/movies/Arrival', 0.01)
+        metrics.vfs('smb://nas/movies/4k/Dune', 0.01)
+        metrics.vfs('smb://nas/movies2/Heat', 0.01)
+        metrics.finish(run)
+        self.assertEqual(sorted(run['vfs']), ['smb://nas', 'smb://nas/movies', 'smb://nas/movies/4k'])
+
+class StaticLibrary:
+    """Transport answering Get*Details with fixed item details."""
+    def __init__(self, details):
+        self.details = details
+
+    def send(self, payload):
+        result_key = service.LIBRARY_DETAILS['movie'][3]
+        return {'jsonrpc': '2.0', 'result': {result_key: self.details}, 'id': payload.get('id')}
+
+KODI_MOVIE_NFO = """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+<movie>
+    <title>Arrival</title>
+    <ratings>
+        <rating name="imdb" max="10" default="true">
+            <value>6.800000</value>
+            <votes>1234</votes>
+        </rating>
+    </ratings>
+    <set>
+        <name>Villeneuve</name>
+        <overview>Films by Denis Villeneuve</overview>
+    </set>
+    <actor>
+        <name>Amy Adams</name>
+    </actor>
+</movie>
+"""
+
+class NFOWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.video = os.path.join(self.folder, 'Arrival.mkv')
+        self.nfo = os.path.join(self.folder, 'Arrival.nfo')
+        with open(self.nfo, 'w', encoding='utf-8') as f:
+            f.write(KODI_MOVIE_NFO)
+        self.addCleanup(service.set_transport, service.transport)
+
+    def export(self, **details):
+        details = dict({
+            'file': self.video,
+            'title': 'Arrival',
+            'ratings': {'imdb': {'default': True, 'rating': 6.800000190734863, 'votes': 1234}},
+            'set': 'Villeneuve',
+        }, **details)
+        service.set_transport(StaticLibrary(details))
+        return service.NFOWriter().export('movie', 1)
+
+    def read(self):
+        with open(self.nfo, encoding='utf-8') as f:
+            return f.read()
+
+    def test_unchanged_ratings_are_not_rewritten(self):
+        done, _, written = self.export()
+        self.assertTrue(done)
+        self.assertIsNone(written)
+        self.assertEqual(self.read(), KODI_MOVIE_NFO)
+
+    def test_ratings_are_written_like_kodi(self):
+        self.export(ratings={'imdb': {'default': True, 'rating': 7.099999904632568, 'votes': 1300}})
+        self.assertIn('<value>7.100000</value>', self.read())
+        self.assertIn('<votes>1300</votes>', self.read())
+
+    def test_set_keeps_its_overview(self):
+        self.export(set='Denis Villeneuve')
+        self.assertIn('<name>Denis Villeneuve</name>', self.read())
+        self.assertIn('<overview>Films by Denis Villeneuve</overview>', self.read())
+
+    def test_set_is_removed_with_the_movie_leaving_it(self):
+        self.export(set='')
+        self.assertNotIn('<set>', self.read())
+        self.assertIn('<actor>', self.read())
+
+class PagedLibrary:
+    """Transport listing `count` watched movies, failing the page that starts at `fail_at`."""
+    def __init__(self, count, fail_at=None):
+        self.movies = [{'movieid': i, 'file': f'/srv/Movie {i}.mkv', 'playcount': 1, 'label': f'Movie {i}'} for i in range(count)]
+        self.fail_at = fail_at
+
+    def send(self, payload):
+        method, params = payload['method'], payload.get('params', {})
+        if method == 'VideoLibrary.GetMovies':
+            start, end = params['limits']['start'], params['limits']['end']
+            if start == self.fail_at:
+                return {'jsonrpc': '2.0', 'error': {'code': -32100, 'message': 'Failed to execute method.'}, 'id': payload.get('id')}
+            result = {'movies': self.movies[start:end], 'limits': {'start': start, 'end': min(end, len(self.movies)), 'total': len(self.movies)}}
+        elif method == 'VideoLibrary.GetMovieDetails':
+            result = {'moviedetails': self.movies[params['movieid']]}
+        else:
+            result = {'limits': {'total': 0}}
+        return {'jsonrpc': '2.0', 'result': result, 'id': payload.get('id')}
+
+class LibraryPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(service.set_transport, service.transport)
+
+    def test_whole_library_is_complete(self):
+        service.set_transport(PagedLibrary(25))
+        pages = service.LibraryPages('VideoLibrary.GetMovies', 'movies', {}, page_size=10)
+        self.assertEqual(len(list(pages)), 25)
+        self.assertTrue(pages.complete)
+
+    def test_failed_page_is_not_taken_for_the_end(self):
+        service.set_transport(PagedLibrary(25, fail_at=10))
+        pages = service.LibraryPages('VideoLibrary.GetMovies', 'movies', {}, page_size=10)
+        self.assertEqual(len(list(pages)), 10)
+        self.assertFalse(pages.complete)
+
+    def test_watched_status_after_a_failed_page_is_looked_up(self):
+        service.set_transport(PagedLibrary(service.LibraryPages.PAGE_SIZE + 5, fail_at=service.LibraryPages.PAGE_SIZE))
+        watched = service.WatchedStateCapture()
+        self.assertEqual(watched.state('movie', 1)['playcount'], 1)
+        self.assertEqual(watched.state('movie', service.LibraryPages.PAGE_SIZE + 2)['playcount'], 1)
+        self.assertEqual(watched.incomplete, {'movie'})
+
+class IdleKodi:
+    """Transport of a Kodi with an empty library that is not playing anything."""
+    def send(self, payload):
+        if isinstance(payload, list):
+            return [self.send(entry) for entry in payload]
+        return {'jsonrpc': '2.0', 'result': [] if payload['method'] == 'Player.GetActivePlayers' else {}, 'id': payload.get('id')}
+
+def on_update(media_type, item_id, **extra):
+    return json.dumps(dict({'item': {'type': media_type, 'id': item_id}}, **extra))
+
+class ExportChangeTrackingTest(unittest.TestCase):
+    def setUp(self):
+        remote.RUNTIME.transport = IdleKodi()
+        self.sync = service.NFOSyncService()
+        self.sync.get_dirty_set().clear()
+        self.home = service.xbmcgui.Window(10000)
+        self.addCleanup(self.home.setProperty, 'service.library.nfosync.import_active', '')
+
+    def dirty(self):
+        return self.sync.get_dirty_set().items()
+
+    def test_user_edits_are_tracked(self):
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('movie', 1))
+        self.assertEqual(self.dirty(), [('movie', 1)])
+
+    def test_scanned_items_are_not_tracked(self):
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('movie', 1, added=True))
+        self.assertEqual(self.dirty(), [])
+
+    def test_updates_during_an_import_in_another_process_are_ignored(self):
+        # script.py runs its import in its own process, sharing only the Home window
+        other = service.NFOSyncService()
+        other.mark_import(True)
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('movie', 1))
+        other.mark_import(False)
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('movie', 2))
+        self.assertEqual(self.dirty(), [('movie', 2)])
+
+    def test_headless_import_is_announced_by_notification(self):
+        self.sync.onNotification(service.ADDON_ID, 'Other.ImportStarted', None)
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('episode', 3))
+        self.sync.onNotification(service.ADDON_ID, 'Other.ImportFinished', None)
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('episode', 4))
+        self.assertEqual(self.dirty(), [('episode', 4)])
+
+    def test_flag_of_a_dead_import_expires(self):
+        self.home.setProperty('service.library.nfosync.import_active', str(time.time() - self.sync.IMPORT_FLAG_EXPIRY - 1))
+        self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('movie', 5))
+        self.assertEqual(self.dirty(), [('movie', 5)])
+
+    def test_late_updates_for_refreshed_items_are_ignored(self):
+        self.sync.refreshed_items[('movie', 6)] = time.time()
+        self.sync.refreshed_items[('movie', 7)] = time.time() - self.sync.LATE_UPDATE_WINDOW - 1
+        for item_id in (6, 7, 8):
+            self.sync.onNotification('xbmc', 'VideoLibrary.OnUpdate', on_update('movie', item_id))
+        self.assertEqual(self.dirty(), [('movie', 7), ('movie', 8)])
+
+class NFOChangeDetectionTest(unittest.TestCase):
+    def setUp(self):
+        remote.RUNTIME.transport = IdleKodi()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.video = os.path.join(self.folder, 'Arrival.mkv')
+        self.last_run = time.time() - 60
+        self.sync = service.NFOSyncService()
+        self.sync.state_index = service.NFOStateIndex(os.path.join(self.folder, 'nfo_state.db'))
+        self.addCleanup(self.sync.state_index.close)
+        self.movie_nfo = self.write('movie.nfo', self.last_run - 3600)
+        self.sync.should_refresh('movie', 1, self.video, 0)
+
+    def write(self, name, mtime):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<movie><title>Arrival</title></movie>')
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def changed(self):
+        self.sync.dir_cache = service.NFODirectoryCache()
+        return self.sync.should_refresh('movie', 1, self.video, self.last_run)
+
+    def test_unchanged_nfo(self):
+        self.assertFalse(self.changed())
+
+    def test_new_nfo_ahead_of_a_known_one(self):
+        # Copied in with its original mtime, older than the last run
+        self.write('Arrival.nfo', self.last_run - 3600)
+        self.assertTrue(self.changed())
+        self.assertFalse(self.changed())
+        self.assertEqual(self.sync.primary_nfo('movie', 1, self.video), os.path.join(self.folder, 'Arrival.nfo'))
+
+    def test_removed_nfo_falls_back_to_the_next_one(self):
+        os.remove(self.movie_nfo)
+        self.write('Arrival.nfo', self.last_run - 3600)
+        self.changed()
+        self.write('movie.nfo', self.last_run - 3600)
+        self.assertFalse(self.changed())
+        os.remove(os.path.join(self.folder, 'Arrival.nfo'))
+        self.assertTrue(self.changed())
+
+class RunStatusTest(unittest.TestCase):
+    def setUp(self):
+        remote.RUNTIME.transport = IdleKodi()
+        self.sync = service.NFOSyncService()
+        self.sync.check_preconditions = lambda: True
+        self.addCleanup(remote.RUNTIME.abort.clear)
+
+    def test_clean_without_shares_is_recorded_as_skipped(self):
+        remote.RUNTIME.settings['clean_check_sources'] = 'true'
+        self.addCleanup(remote.RUNTIME.settings.pop, 'clean_check_sources')
+        self.sync.available_sources = lambda: None
+        self.sync.run_clean()
+        run = service.load_sync_stats()[-1]
+        self.assertEqual(run['task'], 'clean')
+        self.assertTrue(run['skipped'])
+        self.assertFalse(run['completed'])
+        self.assertIn('(skipped)', service.format_sync_stats([run]))
+
+    def test_aborted_export_is_not_reported_as_completed(self):
+        service.set_last_run('last_run_export', 1000)
+        self.sync.get_dirty_set().add('movie', 1)
+        remote.RUNTIME.abort.set()
+        with mock.patch.object(service.logger, 'log') as log:
+            self.sync.run_export()
+        self.assertNotIn(mock.call("Export Triggered/Completed"), log.call_args_list)
+        run = service.load_sync_stats()[-1]
+        self.assertEqual(run['task'], 'export')
+        self.assertFalse(run['completed'])
+        self.assertEqual(service.get_last_run('last_run_export'), 1000)
+
+class WaitForNextTaskTest(unittest.TestCase):
+    def setUp(self):
+        remote.RUNTIME.transport = IdleKodi()
+        self.sync = service.NFOSyncService()
+        # Nothing scheduled unless a test says so
+        self.sync.scheduler.next_due = lambda: None
+
+    def timed_wait(self, after=None, action=None):
+        if action is not None:
+            timer = threading.Timer(after, action)
+            timer.start()
+            self.addCleanup(timer.cancel)
+        started = time.time()
+        self.assertFalse(self.sync.wait_for_next_task())
+        return time.time() - started
+
+    def test_sleeps_until_the_next_task(self):
+        due = time.time() + 0.5
+        self.sync.scheduler.next_due = lambda: due
+        self.assertGreaterEqual(self.timed_wait(), 0.45)
+
+    def test_settings_change_wakes_it_up(self):
+        self.assertLess(self.timed_wait(0.2, self.sync.onSettingsChanged), 5)
+        # and the next call reloads the schedule straight away
+        self.assertTrue(self.sync.settings_changed)
+        self.assertLess(self.timed_wait(), 1)
+        self.assertFalse(self.sync.settings_changed)
+
+    def test_new_nfo_changes_wake_it_up(self):
+        self.sync.watcher = service.NFOWatcher([], 60, 1, self.sync.wakeup)
+        self.sync.watcher.QUIET = 0.5
+        self.assertLess(self.timed_wait(0.2, lambda: self.sync.watcher.changed(nfo='/srv/Movie/movie.nfo')), 5)
+        # then sleeps until the batch has been quiet long enough
+        self.timed_wait()
+        self.assertTrue(self.sync.watcher.due())
+
+if __name__ == '__main__':
+    unittest.main()